@@ -0,0 +1,215 @@
+# -*- coding:utf-8 -*-
+"""
+新冠数据的时间序列分析：把 data / city 表一次性读入 NumPy 数组，所有指标都用向量化运算得到
+
+数据排成 (城市, 日期) 的矩阵，某天没有数据时沿用前一天的累计值；按国家代码把城市矩阵相加得到国家矩阵。
+每个城市 / 国家计算：
+- new_*：每日新增（相邻两天累计值之差，第一天为当天的累计值）
+- new_*_7d_avg：每日新增的 7 日滑动平均
+- *_per_100k：每 10 万人的累计确诊 / 死亡，只对国家计算，人口使用 city.country_population；
+  city 表没有城市自己的人口，城市的 *_per_100k 全部为 null（不能用整个国家的人口去除城市的病例数）
+- growth_7d：7 天的累计确诊增长率；doubling_days：按这 7 天的增速推算的倍增天数
+  （没有增长或 7 天前累计值为 0 时为 null）
+
+计算结果和编码好的 JSON 响应缓存在进程内，直到 data_version（见 migrations.py，由触发器维护）变化。
+数据未变时每个请求只查询一次 data_version，然后直接返回缓存的响应。
+"""
+import asyncio
+import json
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from coronavirus import models
+
+try:
+    import numpy as np
+except ImportError:  # 未安装 numpy 时不提供分析接口
+    np = None
+
+CITY = "city"
+COUNTRY = "country"
+ROLLING_DAYS = 7
+PER_CAPITA = 100000
+
+
+def available() -> bool:
+    return np is not None
+
+
+def rolling_mean(values, window: int):
+    """沿日期方向的滑动平均，前 window - 1 天为 NaN"""
+    result = np.full(values.shape, np.nan)
+    if values.shape[1] >= window:
+        cumsum = np.cumsum(values, axis=1, dtype=np.float64)
+        result[:, window - 1] = cumsum[:, window - 1] / window
+        result[:, window:] = (cumsum[:, window:] - cumsum[:, :-window]) / window
+    return result
+
+
+def compute_metrics(confirmed, deaths, recovered, populations=None) -> Dict[str, Any]:
+    """参数为 (N, D) 的累计值矩阵和长度 N 的人口，返回指标名 -> (N, D) 矩阵；populations 为 None 时不计算 *_per_100k"""
+    new_confirmed = np.diff(confirmed, axis=1, prepend=0)
+    new_deaths = np.diff(deaths, axis=1, prepend=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if populations is None:
+            scale = np.full((confirmed.shape[0], 1), np.nan)
+        else:
+            scale = np.where(populations > 0, PER_CAPITA / populations, np.nan)[:, None]
+        growth = np.full(confirmed.shape, np.nan)
+        doubling = np.full(confirmed.shape, np.nan)
+        if confirmed.shape[1] > ROLLING_DAYS:
+            ratio = confirmed[:, ROLLING_DAYS:] / confirmed[:, :-ROLLING_DAYS]
+            growth[:, ROLLING_DAYS:] = ratio - 1
+            # 7 天前为 0 时 ratio 为 inf，log 后倍增天数会变成 0，和 growth 一样按没有数据处理
+            doubling[:, ROLLING_DAYS:] = np.where(np.isfinite(ratio) & (ratio > 1),
+                                                  ROLLING_DAYS * np.log(2) / np.log(ratio), np.nan)
+        growth[~np.isfinite(growth)] = np.nan
+        doubling[~np.isfinite(doubling)] = np.nan
+    return {
+        "confirmed": confirmed,
+        "deaths": deaths,
+        "recovered": recovered,
+        "new_confirmed": new_confirmed,
+        "new_deaths": new_deaths,
+        "new_confirmed_7d_avg": rolling_mean(new_confirmed, ROLLING_DAYS),
+        "new_deaths_7d_avg": rolling_mean(new_deaths, ROLLING_DAYS),
+        "confirmed_per_100k": confirmed * scale,
+        "deaths_per_100k": deaths * scale,
+        "growth_7d": growth,
+        "doubling_days": doubling,
+    }
+
+
+def to_list(values) -> List[Any]:
+    """整数矩阵原样输出，浮点保留 4 位小数，NaN / inf 输出为 null"""
+    if values.dtype.kind in "iu":
+        return values.tolist()
+    values = np.round(values, 4)
+    return np.where(np.isfinite(values), values, None).tolist()
+
+
+class Snapshot:
+    """某个数据版本下一个维度（城市或国家）的全部指标，矩阵的每一行对应 names 中的一个名字"""
+
+    def __init__(self, version: int, dates, names: List[str], populations, confirmed, deaths, recovered,
+                 per_capita: bool = True):
+        self.version = version
+        self.dates = dates
+        self.names = names
+        self.index = {name: i for i, name in enumerate(names)}
+        self.populations = populations
+        self.metrics = compute_metrics(confirmed, deaths, recovered, populations if per_capita else None)
+
+    def select(self, names: Optional[Sequence[str]], start: Optional[date], end: Optional[date]) -> Dict[str, Any]:
+        """按名字和日期范围取出结果，名字不存在时抛出 KeyError"""
+        rows = np.array([self.index[name] for name in names], dtype=np.intp) if names else slice(None)
+        lo = np.searchsorted(self.dates, np.datetime64(start, "D")) if start else 0
+        hi = np.searchsorted(self.dates, np.datetime64(end, "D"), side="right") if end else len(self.dates)
+        columns = {metric: to_list(values[rows, lo:hi]) for metric, values in self.metrics.items()}
+        selected = np.array(self.names)[rows].tolist()
+        populations = self.populations[rows].tolist()
+        return {
+            "version": self.version,
+            "dates": np.datetime_as_string(self.dates[lo:hi]).tolist(),
+            "series": [
+                {"name": name, "population": populations[i], **{metric: column[i] for metric, column in columns.items()}}
+                for i, name in enumerate(selected)
+            ],
+        }
+
+
+def build_snapshots(version: int, cities: Sequence[Tuple], rows: Sequence[Tuple]) -> Dict[str, Snapshot]:
+    """cities 为按 id 排序的 (id, province, country_code, country_population)，
+    rows 为 (city_id, date, confirmed, deaths, recovered)"""
+    city_ids = np.array([city[0] for city in cities], dtype=np.int64)
+    provinces = [city[1] for city in cities]
+    codes = np.array([city[2] for city in cities], dtype=object)
+    populations = np.array([city[3] for city in cities], dtype=np.int64)
+
+    ids, days, confirmed, deaths, recovered = zip(*rows) if rows else ((),) * 5
+    days = np.array(days, dtype="datetime64[D]")
+    dates = np.arange(days.min(), days.max() + 1) if len(days) else days
+    row_city = np.searchsorted(city_ids, np.array(ids, dtype=np.int64))
+    row_day = (days - dates[0]).astype(np.intp) if len(days) else np.zeros(0, dtype=np.intp)
+
+    # 同一城市同一天有多条数据时相加
+    values = np.zeros((3, len(city_ids), len(dates)), dtype=np.int64)
+    for k, column in enumerate((confirmed, deaths, recovered)):
+        np.add.at(values[k], (row_city, row_day), np.array(column, dtype=np.int64))
+    # 缺失的日期沿用最近一次的累计值
+    present = np.zeros((len(city_ids), len(dates)), dtype=bool)
+    present[row_city, row_day] = True
+    last = np.maximum.accumulate(np.where(present, np.arange(len(dates)), 0), axis=1)
+    values = np.take_along_axis(values, np.broadcast_to(last, values.shape), axis=2)
+
+    country_codes, inverse = np.unique(codes, return_inverse=True)
+    membership = (inverse[None, :] == np.arange(len(country_codes))[:, None]).astype(np.int64)
+    country_values = membership @ values
+    country_populations = np.zeros(len(country_codes), dtype=np.int64)
+    np.maximum.at(country_populations, inverse, populations)
+
+    return {
+        CITY: Snapshot(version, dates, provinces, populations, *values, per_capita=False),
+        COUNTRY: Snapshot(version, dates, country_codes.tolist(), country_populations, *country_values),
+    }
+
+
+class AnalyticsCache:
+    def __init__(self, max_responses: int = 256):
+        self.max_responses = max_responses
+        self.version: Optional[int] = None
+        self.snapshots: Dict[str, Snapshot] = {}
+        self._responses: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._lock = asyncio.Lock()
+        self.loads = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def snapshot(self, db: AsyncSession, scope: str) -> Snapshot:
+        version = (await db.execute(text("SELECT version FROM data_version WHERE id = 1"))).scalar()
+        if version != self.version:
+            async with self._lock:
+                if version != self.version:
+                    # 读取期间如果又有写入，缓存的数据会比 version 新，下一个请求看到新版本号时会再加载一次
+                    cities = (await db.execute(
+                        select(models.City.id, models.City.province, models.City.country_code,
+                               models.City.country_population).order_by(models.City.id))).all()
+                    rows = (await db.execute(
+                        select(models.Data.city_id, models.Data.date, models.Data.confirmed,
+                               models.Data.deaths, models.Data.recovered)
+                        .where(models.Data.city_id.is_not(None)))).all()
+                    self.snapshots = await asyncio.to_thread(build_snapshots, version, cities, rows)
+                    self.version = version
+                    self._responses.clear()
+                    self.loads += 1
+        return self.snapshots[scope]
+
+    async def response(self, db: AsyncSession, scope: str, names: Optional[Sequence[str]] = None,
+                       start: Optional[date] = None, end: Optional[date] = None) -> bytes:
+        """返回编码好的 JSON，名字不存在时抛出 KeyError"""
+        snapshot = await self.snapshot(db, scope)
+        key = (snapshot.version, scope, tuple(names or ()), start, end)
+        body = self._responses.get(key)
+        if body is not None:
+            self._responses.move_to_end(key)
+            self.hits += 1
+            return body
+        self.misses += 1
+        body = json.dumps(snapshot.select(names, start, end), ensure_ascii=False, separators=(",", ":")).encode()
+        self._responses[key] = body
+        while len(self._responses) > self.max_responses:
+            self._responses.popitem(last=False)
+        return body
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "loads": self.loads,
+            "cached_responses": len(self._responses),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
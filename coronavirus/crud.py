@@ -0,0 +1,114 @@
+# -*- coding:utf-8 -*-
+import base64
+import json
+from datetime import date
+from typing import List, Optional, Tuple
+
+from sqlalchemy import Select, String, select, tuple_, type_coerce
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from coronavirus import models, schemas
+
+
+async def get_city(db: AsyncSession, city_id: int) -> Optional[models.City]:
+    return await db.get(models.City, city_id)
+
+
+async def get_city_by_name(db: AsyncSession, name: str) -> Optional[models.City]:
+    return await db.scalar(select(models.City).where(models.City.province == name))
+
+
+async def get_cities(db: AsyncSession, skip: int = 0, limit: int = 10) -> List[models.City]:
+    result = await db.scalars(select(models.City).order_by(models.City.id).offset(skip).limit(limit))
+    return list(result)
+
+
+async def create_city(db: AsyncSession, city: schemas.CreateCity) -> models.City:
+    db_city = models.City(**city.model_dump())
+    db.add(db_city)
+    await db.commit()
+    await db.refresh(db_city)
+    return db_city
+
+
+async def get_data(db: AsyncSession, city: Optional[str] = None,
+                   skip: int = 0, limit: int = 10) -> List[models.Data]:
+    stmt = select(models.Data)
+    if city:
+        # 外键关联查询，这里不是像Django ORM那样Data.city.province
+        # 按日期排序可以直接按 ux_data_city_date 的顺序读取，不需要额外排序
+        stmt = stmt.join(models.City).where(models.City.province == city) \
+            .order_by(models.Data.date, models.Data.id)
+    else:
+        stmt = stmt.order_by(models.Data.id)
+    stmt = stmt.offset(skip).limit(limit)
+    return list(await db.scalars(stmt))
+
+
+def encode_cursor(data: models.Data) -> str:
+    """分页游标：最后一行的 (date, id)，base64 编码后对客户端不透明"""
+    return base64.urlsafe_b64encode(json.dumps([data.date.isoformat(), data.id]).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[date, int]:
+    """游标格式不正确时抛出 ValueError"""
+    try:
+        day, data_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return date.fromisoformat(day), int(data_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+
+
+async def get_data_page(db: AsyncSession, city_id: Optional[int] = None, after: Optional[Tuple[date, int]] = None,
+                        limit: int = 100) -> List[models.Data]:
+    """按 (date, id) 的 keyset 分页：从游标之后直接在索引上定位，耗时与翻到第几页无关"""
+    stmt = select(models.Data)
+    if city_id is not None:
+        stmt = stmt.where(models.Data.city_id == city_id)
+    if after is not None:
+        stmt = stmt.where(tuple_(models.Data.date, models.Data.id) > tuple_(*after))
+    stmt = stmt.order_by(models.Data.date, models.Data.id).limit(limit)
+    return list(await db.scalars(stmt))
+
+
+def export_data_query(city_id: Optional[int] = None, start: Optional[date] = None,
+                      end: Optional[date] = None) -> Select:
+    """导出用的 Core 查询，日期按数据库中的字符串原样读出，不构造 ORM 对象"""
+    data = models.Data.__table__
+    stmt = select(data.c.id, models.City.__table__.c.province.label("city"), type_coerce(data.c.date, String),
+                  data.c.confirmed, data.c.deaths, data.c.recovered) \
+        .join_from(data, models.City.__table__)
+    if city_id is not None:
+        stmt = stmt.where(data.c.city_id == city_id)
+    stmt = _date_range(stmt, data.c.date, start, end)
+    return stmt.order_by(data.c.date, data.c.id)
+
+
+async def create_city_data(db: AsyncSession, data: schemas.CreateData, city_id: int) -> models.Data:
+    db_data = models.Data(**data.model_dump(), city_id=city_id)
+    db.add(db_data)
+    await db.commit()
+    await db.refresh(db_data)
+    return db_data
+
+
+def _date_range(stmt, column, start: Optional[date], end: Optional[date]):
+    if start is not None:
+        stmt = stmt.where(column >= start)
+    if end is not None:
+        stmt = stmt.where(column <= end)
+    return stmt
+
+
+async def get_city_trend(db: AsyncSession, city_id: int, start: Optional[date] = None,
+                         end: Optional[date] = None) -> List[models.CityDailyRollup]:
+    rollup = models.CityDailyRollup
+    stmt = _date_range(select(rollup).where(rollup.city_id == city_id), rollup.date, start, end)
+    return list(await db.scalars(stmt.order_by(rollup.date)))
+
+
+async def get_country_trend(db: AsyncSession, country_code: str, start: Optional[date] = None,
+                            end: Optional[date] = None) -> List[models.CountryDailyRollup]:
+    rollup = models.CountryDailyRollup
+    stmt = _date_range(select(rollup).where(rollup.country_code == country_code), rollup.date, start, end)
+    return list(await db.scalars(stmt.order_by(rollup.date)))
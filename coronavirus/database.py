@@ -0,0 +1,145 @@
+# -*- coding:utf-8 -*-
+"""
+数据库配置：SQLAlchemy 2.0 异步引擎（aiosqlite）
+
+仓库中的 res/coronavirus.sqlite3 只作为初始数据（SEED_DB_PATH），运行时不会打开它写入。默认的数据文件是
+res/coronavirus.local.sqlite3（已加入 .gitignore），第一次启动时从初始数据复制；环境变量 CORONAVIRUS_DB
+可以指定其他路径，文件不存在时创建空数据库。表结构由 migrations.py 在启动时创建和升级。
+
+SQLite 同一时刻只允许一个写入者，但 WAL 模式下读和写互不阻塞、多个读连接可以并发。因此分成两个引擎：
+- write_engine：只有1个连接的连接池，所有写入排队使用它，开启 WAL、synchronous=NORMAL、busy_timeout
+- read_engine：只读连接池（mode=ro + query_only），默认 CORONAVIRUS_DB_READERS=8 个连接，
+  查询接口使用它，不会在同一个连接上排队。每个连接有独立的页缓存（cache_size）并开启 mmap
+
+uvicorn 多 worker 时每个进程导入本模块，各自拥有一套只读连接池，相当于每个 worker 一个只读副本连接组；
+写入仍由 SQLite 的文件锁在进程之间串行化（busy_timeout 内等待）。
+"""
+import os
+import shutil
+import uuid
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEED_DB_PATH = os.path.join(BASE_DIR, "res", "coronavirus.sqlite3")
+DEFAULT_DB_PATH = os.path.join(BASE_DIR, "res", "coronavirus.local.sqlite3")
+DB_PATH = os.environ.get("CORONAVIRUS_DB", DEFAULT_DB_PATH)
+
+READ_POOL_SIZE = int(os.environ.get("CORONAVIRUS_DB_READERS", "8"))
+# 等待写锁的最长时间（毫秒）
+BUSY_TIMEOUT = int(os.environ.get("CORONAVIRUS_DB_BUSY_TIMEOUT", "5000"))
+
+write_engine = create_async_engine(
+    f"sqlite+aiosqlite:///{DB_PATH}",
+    poolclass=AsyncAdaptedQueuePool,  # aiosqlite 对文件数据库默认使用 NullPool，每次请求都重新打开连接
+    pool_size=1,
+    max_overflow=0,
+    pool_timeout=30,
+)
+
+read_engine = create_async_engine(
+    f"sqlite+aiosqlite:///file:{DB_PATH}?mode=ro&uri=true",
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=READ_POOL_SIZE,
+    max_overflow=0,
+    pool_timeout=30,
+)
+
+
+# 批量导入（ingest.py）使用的同步写引擎，在线程中运行，不阻塞事件循环。与 write_engine 是同一个文件，
+# 两者之间的写入由 SQLite 的写锁串行化。接口提交的导入任务由 ingest.import_executor() 逐个执行，不会争用这一个连接
+bulk_engine = create_engine(
+    f"sqlite:///{DB_PATH}",
+    pool_size=1,
+    max_overflow=0,
+    pool_timeout=30,
+)
+
+
+@event.listens_for(write_engine.sync_engine, "connect")
+@event.listens_for(bulk_engine, "connect")
+def _setup_write_connection(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT}")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+@event.listens_for(read_engine.sync_engine, "connect")
+def _setup_read_connection(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only=ON")
+    cursor.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT}")
+    cursor.execute("PRAGMA cache_size=-16000")  # 16MB
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256MB
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+WriteSession = async_sessionmaker(write_engine, class_=AsyncSession, expire_on_commit=False)
+ReadSession = async_sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+async def get_read_db():
+    async with ReadSession() as session:
+        yield session
+
+
+async def get_write_db():
+    async with WriteSession() as session:
+        yield session
+
+
+def prepare_database_file():
+    """
+    数据文件不存在时创建：默认路径从初始数据复制，其他路径留给迁移创建空表
+
+    先复制到临时文件再 os.link 到目标路径，多个 worker 同时启动时只有一个能创建成功，
+    其他 worker 不会覆盖已经被打开的文件
+    """
+    if os.path.exists(DB_PATH):
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(DB_PATH)), exist_ok=True)
+    if os.path.abspath(DB_PATH) != os.path.abspath(DEFAULT_DB_PATH) or not os.path.exists(SEED_DB_PATH):
+        return
+    tmp_path = f"{DB_PATH}.{uuid.uuid4().hex}.tmp"
+    try:
+        shutil.copyfile(SEED_DB_PATH, tmp_path)
+        try:
+            os.link(tmp_path, DB_PATH)
+        except FileExistsError:
+            pass
+    finally:
+        os.remove(tmp_path)
+
+
+async def run_migrations() -> int:
+    from coronavirus.migrations import migrate
+
+    async with write_engine.connect() as connection:
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        return await connection.run_sync(migrate)
+
+
+async def init_db():
+    """
+    启动时准备数据文件，用写连接把数据库切换到 WAL 模式（持久生效，之后只读连接不会被写入阻塞）并执行迁移。
+    空数据库由迁移按模型创建 city / data 表
+    """
+    prepare_database_file()
+    await run_migrations()
+
+
+async def dispose_engines():
+    await read_engine.dispose()
+    await write_engine.dispose()
+    bulk_engine.dispose()
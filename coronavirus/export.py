@@ -0,0 +1,43 @@
+# -*- coding:utf-8 -*-
+"""
+流式导出 data 表（CSV / NDJSON）
+
+在只读连接上用服务端游标（AsyncConnection.stream）逐批读取 Core 查询的结果行，每批编码后立即发送，
+不构造 ORM 对象或 Pydantic 模型，内存占用只和批大小有关，与导出的总行数无关。
+连接在生成器内部打开：依赖注入的会话在响应开始发送前就已关闭，不能用于 StreamingResponse。
+"""
+import csv
+import io
+import json
+from typing import AsyncIterator
+
+from sqlalchemy import Select
+
+from coronavirus.database import read_engine
+
+CSV = "csv"
+NDJSON = "ndjson"
+MEDIA_TYPES = {CSV: "text/csv", NDJSON: "application/x-ndjson"}
+
+EXPORT_BATCH_SIZE = 2000
+
+
+async def stream_rows(stmt: Select, fmt: str, batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[bytes]:
+    async with read_engine.connect() as connection:
+        result = await connection.stream(stmt.execution_options(yield_per=batch_size))
+        columns = list(result.keys())
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        if fmt == CSV:
+            writer.writerow(columns)
+        async for rows in result.partitions():
+            if fmt == CSV:
+                writer.writerows(rows)
+            else:
+                buffer.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows)
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            # 没有数据行时只有 CSV 表头
+            yield buffer.getvalue().encode()
@@ -0,0 +1,428 @@
+# -*- coding:utf-8 -*-
+"""
+批量导入每日疫情数据（CSV / JSON / JSON Lines）
+
+边读边按批校验，每批在一个事务（BEGIN IMMEDIATE）中写入：
+- city 用 executemany 按 province upsert，只在本次导入第一次遇到该城市时执行。已有城市的 country_code
+  不能通过导入修改（汇总表按国家累加，改国家需要重建汇总，见 migrations.py），这类记录作为无效数据报告
+- data 先用 executemany 写入临时暂存表，再用一条 INSERT ... SELECT 按 (city_id, date) upsert
+  （唯一索引见 migrations.py），数值没有变化的行不会被更新，重复导入同一个文件几乎不产生写入
+- 事务内置 data_version.bulk = 1 暂停逐行触发器，汇总表和 data_version 按批用集合运算更新，
+  省去每行三次触发器写入
+
+字段：province, date (YYYY-MM-DD), confirmed, deaths, recovered（为空时为 0），
+新城市还需要 country, country_code, country_population。
+CSV 第一行为表头；JSON Lines（.jsonl / .ndjson）每行一个对象，流式读取；JSON 为对象数组，会整个读入内存。
+
+命令行（数据库路径同样由 CORONAVIRUS_DB 指定）：
+    python -m coronavirus.ingest data.csv more.jsonl --batch-size 20000
+接口：POST /coronavirus/import 上传文件，在后台任务中导入；GET /coronavirus/import/{job_id} 查看进度。
+后台任务在只有一个线程的 import_executor 中逐个执行（bulk_engine 只有一个连接），排队时状态为 queued
+"""
+import csv
+import io
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy.engine import Connection, Engine
+
+CSV = "csv"
+JSON = "json"
+JSONL = "jsonl"
+FORMATS = {".csv": CSV, ".json": JSON, ".jsonl": JSONL, ".ndjson": JSONL}
+
+DEFAULT_BATCH_SIZE = 10000
+MAX_ERRORS = 100  # 报告中最多保留的错误条数
+MAX_JOBS = 100  # 最多保留的后台任务记录
+
+CITY_UPSERT = """
+INSERT INTO city (province, country, country_code, country_population) VALUES (?, ?, ?, ?)
+ON CONFLICT (province) DO UPDATE SET
+    country = excluded.country,
+    country_population = excluded.country_population,
+    updated_at = CURRENT_TIMESTAMP
+WHERE country_code = excluded.country_code
+    AND (country IS NOT excluded.country OR country_population IS NOT excluded.country_population)
+"""
+
+STAGE_TABLE = """
+CREATE TEMP TABLE IF NOT EXISTS ingest_stage (
+    city_id INTEGER NOT NULL, date VARCHAR NOT NULL,
+    confirmed BIGINT NOT NULL, deaths BIGINT NOT NULL, recovered BIGINT NOT NULL
+)
+"""
+
+TOTALS_TABLE = """
+CREATE TEMP TABLE IF NOT EXISTS ingest_totals (
+    city_id INTEGER NOT NULL, date VARCHAR NOT NULL,
+    confirmed BIGINT NOT NULL, deaths BIGINT NOT NULL, recovered BIGINT NOT NULL,
+    PRIMARY KEY (city_id, date)
+)
+"""
+
+STAGE_INSERT = "INSERT INTO temp.ingest_stage (city_id, date, confirmed, deaths, recovered) VALUES (?, ?, ?, ?, ?)"
+
+# 同一批中重复的 (city_id, date) 以后出现的为准；WHERE true 用于消除 INSERT ... SELECT ... ON CONFLICT 的语法歧义
+DATA_UPSERT = """
+INSERT INTO data (city_id, date, confirmed, deaths, recovered)
+SELECT city_id, date, confirmed, deaths, recovered FROM temp.ingest_stage WHERE true ORDER BY rowid
+ON CONFLICT (city_id, date) DO UPDATE SET
+    confirmed = excluded.confirmed,
+    deaths = excluded.deaths,
+    recovered = excluded.recovered,
+    updated_at = CURRENT_TIMESTAMP
+WHERE confirmed IS NOT excluded.confirmed OR deaths IS NOT excluded.deaths OR recovered IS NOT excluded.recovered
+"""
+
+# 本批涉及的 (city_id, date) 写入后的值；CROSS JOIN 固定以暂存表驱动，按唯一索引查 data
+TOTALS_REFRESH = """
+INSERT INTO temp.ingest_totals (city_id, date, confirmed, deaths, recovered)
+SELECT data.city_id, data.date, data.confirmed, data.deaths, data.recovered
+FROM (SELECT DISTINCT city_id, date FROM temp.ingest_stage) AS stage
+CROSS JOIN data ON data.city_id = stage.city_id AND data.date = stage.date
+"""
+
+# 国家汇总加上城市汇总的变化量（新值 - 汇总表中的旧值），必须在更新城市汇总之前执行
+COUNTRY_ROLLUP_UPSERT = """
+INSERT INTO rollup_country_daily (country_code, date, confirmed, deaths, recovered)
+SELECT city.country_code, totals.date,
+    SUM(totals.confirmed - IFNULL(rollup.confirmed, 0)),
+    SUM(totals.deaths - IFNULL(rollup.deaths, 0)),
+    SUM(totals.recovered - IFNULL(rollup.recovered, 0))
+FROM temp.ingest_totals AS totals
+JOIN city ON city.id = totals.city_id
+LEFT JOIN rollup_city_daily AS rollup ON rollup.city_id = totals.city_id AND rollup.date = totals.date
+GROUP BY city.country_code, totals.date
+ON CONFLICT (country_code, date) DO UPDATE SET
+    confirmed = confirmed + excluded.confirmed,
+    deaths = deaths + excluded.deaths,
+    recovered = recovered + excluded.recovered
+"""
+
+CITY_ROLLUP_UPSERT = """
+INSERT INTO rollup_city_daily (city_id, date, confirmed, deaths, recovered)
+SELECT city_id, date, confirmed, deaths, recovered FROM temp.ingest_totals WHERE true
+ON CONFLICT (city_id, date) DO UPDATE SET
+    confirmed = excluded.confirmed,
+    deaths = excluded.deaths,
+    recovered = excluded.recovered
+"""
+
+
+def detect_format(filename: str) -> str:
+    fmt = FORMATS.get(os.path.splitext(filename or "")[1].lower())
+    if fmt is None:
+        raise ValueError(f"无法根据文件名判断格式: {filename}，支持 {', '.join(FORMATS)}")
+    return fmt
+
+
+def iter_records(file: IO[bytes], fmt: str) -> Iterator[Dict[str, Any]]:
+    """file 为二进制文件对象"""
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="" if fmt == CSV else None)
+    if fmt == CSV:
+        yield from csv.DictReader(text)
+    elif fmt == JSONL:
+        for line in text:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    elif fmt == JSON:
+        records = json.load(text)
+        if not isinstance(records, list):
+            raise ValueError("JSON 文件应为对象数组")
+        yield from records
+    else:
+        raise ValueError(f"不支持的格式: {fmt}")
+
+
+def _count(value: Any, field: str) -> int:
+    """空值为 0；int() 可以直接处理两端有空白的字符串"""
+    if value is None or value == "":
+        return 0
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError(f"{field} 不是整数: {value}")
+        value = int(value)
+    number = int(value)
+    if number < 0:
+        raise ValueError(f"{field} 不能为负数: {number}")
+    return number
+
+
+def validate_batch(batch: List[Tuple[int, Dict[str, Any]]],
+                   dates: Optional[Dict[Any, str]] = None) -> Tuple[Dict[str, tuple], List[tuple], List[str]]:
+    """返回 (province -> city 参数, data 参数（第一项为 province）, 错误信息)。
+    dates 为原始日期 -> 规范化日期的缓存，同一批 / 同一次导入中日期大量重复"""
+    cities: Dict[str, tuple] = {}
+    rows: List[tuple] = []
+    errors: List[str] = []
+    dates = {} if dates is None else dates
+    for line, record in batch:
+        try:
+            if not isinstance(record, dict):
+                raise ValueError("不是对象")
+            province = str(record.get("province") or "").strip()
+            if not province:
+                raise ValueError("缺少 province")
+            raw_date = record.get("date")
+            if not raw_date:
+                raise ValueError("缺少 date")
+            day = dates.get(raw_date)
+            if day is None:
+                day = dates[raw_date] = date.fromisoformat(str(raw_date).strip()).isoformat()
+            row = (province, day, _count(record.get("confirmed"), "confirmed"),
+                   _count(record.get("deaths"), "deaths"), _count(record.get("recovered"), "recovered"))
+            if record.get("country_code"):
+                cities[province] = (province, str(record.get("country") or record["country_code"]).strip(),
+                                    str(record["country_code"]).strip(),
+                                    _count(record.get("country_population"), "country_population"))
+        except (TypeError, ValueError) as e:
+            errors.append(f"第 {line} 条: {e}")
+            continue
+        rows.append(row)
+    return cities, rows, errors
+
+
+class ImportStats:
+    def __init__(self):
+        self.rows = 0  # 读取的记录数
+        self.written = 0  # 插入或更新的 data 行数
+        self.unchanged = 0  # 与库中数据相同而跳过的行数
+        self.invalid = 0
+        self.cities = 0  # 插入或更新的城市数
+        self.batches = 0
+        self.errors: List[str] = []
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.elapsed if self.elapsed > 0 else 0.0
+
+    def add_errors(self, errors: List[str]):
+        self.invalid += len(errors)
+        self.errors.extend(errors[:MAX_ERRORS - len(self.errors)])
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "rows": self.rows,
+            "written": self.written,
+            "unchanged": self.unchanged,
+            "invalid": self.invalid,
+            "cities": self.cities,
+            "batches": self.batches,
+            "seconds": round(self.elapsed, 3),
+            "rows_per_second": round(self.rows_per_second),
+            "errors": self.errors,
+        }
+
+
+class Importer:
+    def __init__(self, connection: Connection, batch_size: int = DEFAULT_BATCH_SIZE,
+                 stats: Optional[ImportStats] = None):
+        """connection 需要是 AUTOCOMMIT 模式，事务由这里控制"""
+        self.connection = connection
+        self.batch_size = batch_size
+        self.stats = stats or ImportStats()
+        self.city_ids: Dict[str, int] = {
+            province: city_id for city_id, province in connection.exec_driver_sql("SELECT id, province FROM city")}
+        self._upserted_cities = set()
+        # 本次导入中换了国家而被拒绝的城市 -> (库中的国家代码, 导入的国家代码)，之后各批中该城市的记录都不导入
+        self.moved_cities: Dict[str, Tuple[str, str]] = {}
+        self._dates: Dict[Any, str] = {}
+        connection.exec_driver_sql(STAGE_TABLE)
+        connection.exec_driver_sql(TOTALS_TABLE)
+
+    def run(self, records: Iterable[Dict[str, Any]]) -> ImportStats:
+        batch = []
+        for line, record in enumerate(records, start=1):
+            batch.append((line, record))
+            if len(batch) >= self.batch_size:
+                self.import_batch(batch)
+                batch = []
+        if batch:
+            self.import_batch(batch)
+        self.stats.finished = time.perf_counter()
+        return self.stats
+
+    def import_batch(self, batch: List[Tuple[int, Dict[str, Any]]]):
+        """一批数据在一个写事务中完成：暂停逐行触发器，executemany 写入暂存表后整批 upsert，再按批更新汇总表"""
+        cities, rows, errors = validate_batch(batch, self._dates)
+        cities = [city for province, city in cities.items() if province not in self._upserted_cities]
+        connection = self.connection
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            connection.exec_driver_sql("UPDATE data_version SET bulk = 1 WHERE id = 1")
+            moved = self.moved_cities
+            if cities:
+                # 已有城市换了国家时，本次导入中该城市的记录都不导入（包括之后各批中不带 country_code 的记录），
+                # 否则国家汇总表会算错
+                for province, country_code in connection.exec_driver_sql(
+                        "SELECT province, country_code FROM city WHERE province IN (SELECT value FROM json_each(?))",
+                        (json.dumps([city[0] for city in cities]),)):
+                    new_code = next(city[2] for city in cities if city[0] == province)
+                    if country_code != new_code:
+                        moved[province] = (country_code, new_code)
+                cities = [city for city in cities if city[0] not in moved]
+            if cities:
+                self.stats.cities += connection.exec_driver_sql(CITY_UPSERT, cities).rowcount
+                for city_id, province in connection.exec_driver_sql(
+                        "SELECT id, province FROM city WHERE province IN (SELECT value FROM json_each(?))",
+                        (json.dumps([city[0] for city in cities]),)):
+                    self.city_ids[province] = city_id
+            params = []
+            for province, day, confirmed, deaths, recovered in rows:
+                if province in moved:
+                    errors.append(f"城市 {province} 属于 {moved[province][0]}，不能通过导入改为 {moved[province][1]}")
+                    continue
+                city_id = self.city_ids.get(province)
+                if city_id is None:
+                    errors.append(f"城市 {province} 不存在，需要提供 country_code 和 country_population")
+                    continue
+                params.append((city_id, day, confirmed, deaths, recovered))
+            written = 0
+            if params:
+                connection.exec_driver_sql("DELETE FROM temp.ingest_stage")
+                connection.exec_driver_sql("DELETE FROM temp.ingest_totals")
+                connection.exec_driver_sql(STAGE_INSERT, params)
+                written = connection.exec_driver_sql(DATA_UPSERT).rowcount
+                if written:
+                    connection.exec_driver_sql(TOTALS_REFRESH)
+                    connection.exec_driver_sql(COUNTRY_ROLLUP_UPSERT)
+                    connection.exec_driver_sql(CITY_ROLLUP_UPSERT)
+            connection.exec_driver_sql("UPDATE data_version SET bulk = 0, version = version + ? WHERE id = 1",
+                                       (1 if written or cities else 0,))
+            connection.exec_driver_sql("COMMIT")
+        except BaseException:
+            connection.exec_driver_sql("ROLLBACK")
+            raise
+        self._upserted_cities.update(city[0] for city in cities)
+        self.stats.rows += len(batch)
+        self.stats.written += written
+        self.stats.unchanged += len(params) - written
+        self.stats.add_errors(errors)
+        self.stats.batches += 1
+
+
+def import_file(engine: Engine, file: IO[bytes], fmt: str, batch_size: int = DEFAULT_BATCH_SIZE,
+                stats: Optional[ImportStats] = None) -> ImportStats:
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        return Importer(connection, batch_size, stats).run(iter_records(file, fmt))
+
+
+class ImportJob:
+    def __init__(self, filename: str, fmt: str, path: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.format = fmt
+        self.path = path
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.stats = ImportStats()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"id": self.id, "filename": self.filename, "format": self.format, "status": self.status,
+                "error": self.error, **self.stats.as_dict()}
+
+
+jobs: "OrderedDict[str, ImportJob]" = OrderedDict()
+
+# 导入任务逐个执行：同一时刻只有一个导入占用 bulk_engine 的连接，其余的在这里排队，不会等待连接池超时
+_import_executor: Optional[ThreadPoolExecutor] = None
+_import_executor_lock = threading.Lock()
+
+
+def import_executor() -> ThreadPoolExecutor:
+    """只有一个线程的导入线程池，第一次使用时创建，关闭后再次使用时重新创建"""
+    global _import_executor
+    with _import_executor_lock:
+        if _import_executor is None:
+            _import_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="coronavirus-import")
+        return _import_executor
+
+
+def create_job(filename: str, fmt: str, path: Optional[str] = None) -> ImportJob:
+    job = ImportJob(filename, fmt, path)
+    jobs[job.id] = job
+    while len(jobs) > MAX_JOBS:
+        jobs.popitem(last=False)
+    return job
+
+
+def submit_job(job: ImportJob, batch_size: int = DEFAULT_BATCH_SIZE):
+    """把任务加入 import_executor 的队列，前面的任务完成后才开始"""
+    import_executor().submit(run_job, job, job.path, batch_size)
+
+
+def shutdown_import_executor():
+    """等待正在执行的导入完成，取消排队中的任务并删除它们的上传文件"""
+    global _import_executor
+    with _import_executor_lock:
+        executor, _import_executor = _import_executor, None
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+    for job in list(jobs.values()):
+        if job.status == "queued":
+            job.status = "cancelled"
+            if job.path and os.path.exists(job.path):
+                os.remove(job.path)
+
+
+def run_job(job: ImportJob, path: str, batch_size: int = DEFAULT_BATCH_SIZE):
+    """后台任务（在 import_executor 中运行）：导入 path 后删除该文件"""
+    from coronavirus.database import bulk_engine
+
+    job.status = "running"
+    job.stats.started = time.perf_counter()
+    try:
+        with open(path, "rb") as file:
+            import_file(bulk_engine, file, job.format, batch_size, job.stats)
+        job.status = "done"
+    except Exception as e:
+        job.stats.finished = time.perf_counter()
+        job.status = "failed"
+        job.error = str(e)
+    finally:
+        os.remove(path)
+
+
+def main():
+    import argparse
+
+    from coronavirus.database import DB_PATH, bulk_engine, prepare_database_file
+    from coronavirus.migrations import migrate
+
+    parser = argparse.ArgumentParser(description="批量导入每日疫情数据")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--format", choices=[CSV, JSON, JSONL], help="不指定时按扩展名判断")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    prepare_database_file()
+    with bulk_engine.connect() as connection:
+        migrate(connection.execution_options(isolation_level="AUTOCOMMIT"))
+    for path in args.files:
+        with open(path, "rb") as file:
+            stats = import_file(bulk_engine, file, args.format or detect_format(path), args.batch_size)
+        print(f"{path} -> {DB_PATH}: {stats.rows} 条，写入 {stats.written}，未变化 {stats.unchanged}，"
+              f"无效 {stats.invalid}，城市 {stats.cities}，{stats.batches} 批，"
+              f"{stats.elapsed:.2f} 秒，{stats.rows_per_second:,.0f} 条/秒")
+        for error in stats.errors:
+            print("  " + error)
+    bulk_engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# -*- coding:utf-8 -*-
+import shutil
+import tempfile
+from datetime import date
+from typing import List
+
+from fastapi import APIRouter, Depends, File, HTTPException, Query, Response, UploadFile
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from coronavirus import analytics, crud, export, ingest, schemas
+from coronavirus.database import dispose_engines, get_read_db, get_write_db, init_db
+
+# 查询使用只读连接池（多个连接并发读），创建使用单连接的写连接池
+application = APIRouter(on_startup=[init_db], on_shutdown=[ingest.shutdown_import_executor, dispose_engines])
+
+analytics_cache = analytics.AnalyticsCache()
+
+
+@application.post("/create_city", response_model=schemas.ReadCity)
+async def create_city(city: schemas.CreateCity, db: AsyncSession = Depends(get_write_db)):
+    db_city = await crud.get_city_by_name(db, name=city.province)
+    if db_city:
+        raise HTTPException(status_code=400, detail="City already registered")
+    return await crud.create_city(db=db, city=city)
+
+
+@application.get("/get_city/{city}", response_model=schemas.ReadCity)
+async def get_city(city: str, db: AsyncSession = Depends(get_read_db)):
+    db_city = await crud.get_city_by_name(db, name=city)
+    if db_city is None:
+        raise HTTPException(status_code=404, detail="City not found")
+    return db_city
+
+
+@application.get("/get_cities", response_model=List[schemas.ReadCity])
+async def get_cities(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_read_db)):
+    return await crud.get_cities(db, skip=skip, limit=limit)
+
+
+@application.post("/create_data", response_model=schemas.ReadData)
+async def create_data_for_city(city: str, data: schemas.CreateData, db: AsyncSession = Depends(get_write_db)):
+    db_city = await crud.get_city_by_name(db, name=city)
+    if db_city is None:
+        raise HTTPException(status_code=404, detail="City not found")
+    return await crud.create_city_data(db=db, data=data, city_id=db_city.id)
+
+
+@application.get("/get_data", response_model=List[schemas.ReadData])
+async def get_data(city: str = None, skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_read_db)):
+    return await crud.get_data(db, city=city, skip=skip, limit=limit)
+
+
+async def _city_id(db: AsyncSession, city: str = None):
+    if not city:
+        return None
+    db_city = await crud.get_city_by_name(db, name=city)
+    if db_city is None:
+        raise HTTPException(status_code=404, detail="City not found")
+    return db_city.id
+
+
+@application.get("/get_data_page", response_model=schemas.DataPage)
+async def get_data_page(city: str = None, cursor: str = Query(None, description="上一页返回的 next_cursor"),
+                        limit: int = Query(100, ge=1, le=1000), db: AsyncSession = Depends(get_read_db)):
+    """按 (date, id) 排序的游标分页，每页耗时与翻到第几页无关（get_data 的 skip 越大越慢）"""
+    try:
+        after = crud.decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    items = await crud.get_data_page(db, city_id=await _city_id(db, city), after=after, limit=limit)
+    return schemas.DataPage(items=items, next_cursor=crud.encode_cursor(items[-1]) if len(items) == limit else None)
+
+
+@application.get("/export_data")
+async def export_data(city: str = None, start: date = None, end: date = None,
+                      format: str = Query(export.CSV, pattern=f"^({export.CSV}|{export.NDJSON})$"),
+                      db: AsyncSession = Depends(get_read_db)):
+    """流式导出（CSV 或 NDJSON），按 (date, id) 排序"""
+    stmt = crud.export_data_query(city_id=await _city_id(db, city), start=start, end=end)
+    return StreamingResponse(export.stream_rows(stmt, format), media_type=export.MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="coronavirus_data.{format}"'})
+
+@application.get("/get_city_trend/{city}", response_model=List[schemas.DailyTotal])
+async def get_city_trend(city: str, start: date = None, end: date = None, db: AsyncSession = Depends(get_read_db)):
+    db_city = await crud.get_city_by_name(db, name=city)
+    if db_city is None:
+        raise HTTPException(status_code=404, detail="City not found")
+    return await crud.get_city_trend(db, city_id=db_city.id, start=start, end=end)
+
+
+@application.get("/get_country_trend/{country_code}", response_model=List[schemas.DailyTotal])
+async def get_country_trend(country_code: str, start: date = None, end: date = None,
+                            db: AsyncSession = Depends(get_read_db)):
+    return await crud.get_country_trend(db, country_code=country_code, start=start, end=end)
+
+
+@application.get("/analytics")
+async def get_analytics(scope: str = Query(analytics.CITY, pattern=f"^({analytics.CITY}|{analytics.COUNTRY})$"),
+                        name: List[str] = Query(None, description="城市名（province）或国家代码，可重复，不传时返回全部"),
+                        start: date = None, end: date = None, db: AsyncSession = Depends(get_read_db)):
+    """每日新增、7日滑动平均、每10万人累计数（只有 scope=country 有值）、7日增长率和倍增天数，按列返回（dates 与各指标数组一一对应）"""
+    if not analytics.available():
+        raise HTTPException(status_code=501, detail="numpy is not installed")
+    try:
+        body = await analytics_cache.response(db, scope, names=name, start=start, end=end)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"{e.args[0]} not found")
+    return Response(body, media_type="application/json")
+
+
+@application.get("/analytics_stats")
+async def get_analytics_stats():
+    return analytics_cache.stats()
+
+
+def _save_upload(file: UploadFile) -> str:
+    with tempfile.NamedTemporaryFile(prefix="coronavirus-import-", delete=False) as temp:
+        shutil.copyfileobj(file.file, temp, 1024 * 1024)
+    return temp.name
+
+
+@application.post("/import", status_code=202)
+async def import_data(file: UploadFile = File(...),
+                      format: str = Query(None, pattern=f"^({ingest.CSV}|{ingest.JSON}|{ingest.JSONL})$",
+                                          description="不指定时按文件扩展名判断"),
+                      batch_size: int = Query(ingest.DEFAULT_BATCH_SIZE, ge=1, le=100000)):
+    """上传 CSV / JSON / JSON Lines 文件，在后台逐个批量导入（前面有任务时状态为 queued），返回的 id 用于查询进度"""
+    try:
+        fmt = format or ingest.detect_format(file.filename)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    path = await run_in_threadpool(_save_upload, file)
+    job = ingest.create_job(file.filename, fmt, path)
+    ingest.submit_job(job, batch_size)
+    return job.as_dict()
+
+
+@application.get("/import/{job_id}")
+async def get_import_job(job_id: str):
+    job = ingest.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    return job.as_dict()
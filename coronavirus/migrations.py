@@ -0,0 +1,210 @@
+# -*- coding:utf-8 -*-
+"""
+coronavirus 数据库的迁移，用 PRAGMA user_version 记录已经执行到的版本
+
+0. 版本为 0 时先按 models.py 创建缺少的 city / data 表（空数据库），已有的表不动
+1. data 表的覆盖索引：
+   - ix_data_city_date (city_id, date, confirmed, deaths, recovered)：按城市查时间序列只读索引，不回表
+   - ix_data_date (date)：按日期范围查询
+2. 按天汇总的物化表，由触发器在 data 插入 / 更新 / 删除时增量维护：
+   - rollup_city_daily (city_id, date)
+   - rollup_country_daily (country_code, date)
+   国家级趋势查询只读汇总表，行数只和天数（× 国家数）有关，不再随 data 表变大。
+   修改 city.country_code 不会触发重新汇总，需要把 user_version 改回 1 重新执行迁移 2
+3. data_version：data / city 表每次增删改时加一的计数器，缓存（analytics.py）用它判断数据是否变化，
+   其他 worker 或直接用 sqlite3 写入也能感知到
+4. 批量导入（ingest.py）需要的结构：
+   - ux_data_city_date (city_id, date) 唯一索引，按它 upsert。已有重复数据时迁移中止（不会删除数据），
+     报错中列出重复的 (city_id, date) 和各自的 id，手动处理后重新执行迁移。
+     迁移 1 的覆盖索引 ix_data_city_date 保留，按城市查时间序列仍然只读索引不回表
+   - data_version.bulk 标志：为 1 时迁移 2、3 的逐行触发器不执行，由导入程序按批维护汇总表和版本号。
+     导入程序只在自己的写事务内把它置为 1，提交前恢复为 0，其他连接永远看不到 bulk = 1
+
+迁移在写连接上用 BEGIN IMMEDIATE 执行，多个 worker 同时启动时只有一个会真正执行，其余的等待写锁后
+发现版本已是最新直接返回。也可以手动执行：python -m coronavirus.migrations
+"""
+from typing import Callable, List, Union
+
+from sqlalchemy.engine import Connection
+
+BULK_OFF = "(SELECT bulk FROM data_version WHERE id = 1) = 0"
+
+_ROLLUP_ADD_NEW = """
+            INSERT INTO rollup_city_daily (city_id, date, confirmed, deaths, recovered)
+            SELECT NEW.city_id, NEW.date, NEW.confirmed, NEW.deaths, NEW.recovered
+            WHERE NEW.city_id IS NOT NULL
+            ON CONFLICT (city_id, date) DO UPDATE SET
+                confirmed = confirmed + excluded.confirmed,
+                deaths = deaths + excluded.deaths,
+                recovered = recovered + excluded.recovered;
+            INSERT INTO rollup_country_daily (country_code, date, confirmed, deaths, recovered)
+            SELECT country_code, NEW.date, NEW.confirmed, NEW.deaths, NEW.recovered
+            FROM city WHERE id = NEW.city_id
+            ON CONFLICT (country_code, date) DO UPDATE SET
+                confirmed = confirmed + excluded.confirmed,
+                deaths = deaths + excluded.deaths,
+                recovered = recovered + excluded.recovered;"""
+
+_ROLLUP_SUBTRACT_OLD = """
+            UPDATE rollup_city_daily SET
+                confirmed = confirmed - OLD.confirmed,
+                deaths = deaths - OLD.deaths,
+                recovered = recovered - OLD.recovered
+            WHERE OLD.city_id IS NOT NULL AND city_id = OLD.city_id AND date = OLD.date;
+            UPDATE rollup_country_daily SET
+                confirmed = confirmed - OLD.confirmed,
+                deaths = deaths - OLD.deaths,
+                recovered = recovered - OLD.recovered
+            WHERE country_code = (SELECT country_code FROM city WHERE id = OLD.city_id) AND date = OLD.date;"""
+
+_VERSION_BUMP = """
+            UPDATE data_version SET version = version + 1 WHERE id = 1;"""
+
+
+def _trigger(name: str, event: str, body: str, bulk_guard: bool) -> str:
+    when = f"\n        WHEN {BULK_OFF}" if bulk_guard else ""
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS {name} {event}{when}
+        BEGIN{body}
+        END
+        """
+
+
+def _rollup_triggers(bulk_guard: bool = False) -> List[str]:
+    return [
+        _trigger("tr_data_rollup_insert", "AFTER INSERT ON data", _ROLLUP_ADD_NEW, bulk_guard),
+        _trigger("tr_data_rollup_delete", "AFTER DELETE ON data", _ROLLUP_SUBTRACT_OLD, bulk_guard),
+        # 更新等价于先减去旧值再加上新值
+        _trigger("tr_data_rollup_update", "AFTER UPDATE OF city_id, date, confirmed, deaths, recovered ON data",
+                 _ROLLUP_SUBTRACT_OLD + _ROLLUP_ADD_NEW, bulk_guard),
+    ]
+
+
+def _version_triggers(bulk_guard: bool = False) -> List[str]:
+    return [
+        _trigger(f"tr_{table}_version_{event.lower()}", f"AFTER {event} ON {table}", _VERSION_BUMP, bulk_guard)
+        for table in ("data", "city") for event in ("INSERT", "UPDATE", "DELETE")
+    ]
+
+
+def _check_no_duplicate_data(connection: Connection):
+    """创建 ux_data_city_date 之前检查重复数据，有重复时抛出 RuntimeError 列出它们"""
+    duplicates = connection.exec_driver_sql(
+        "SELECT city_id, date, GROUP_CONCAT(id) FROM data WHERE city_id IS NOT NULL "
+        "GROUP BY city_id, date HAVING COUNT(*) > 1 ORDER BY city_id, date").all()
+    if duplicates:
+        shown = "\n".join(f"  city_id={city_id} date={day} id=[{ids}]" for city_id, day, ids in duplicates[:50])
+        more = f"\n  ... 共 {len(duplicates)} 组" if len(duplicates) > 50 else ""
+        raise RuntimeError(f"data 表有 {len(duplicates)} 组 (city_id, date) 重复的数据，无法创建唯一索引 "
+                           f"ux_data_city_date，请删除或合并后重新执行迁移：\n{shown}{more}")
+
+
+TRIGGER_NAMES = ["tr_data_rollup_insert", "tr_data_rollup_delete", "tr_data_rollup_update"] + [
+    f"tr_{table}_version_{event}" for table in ("data", "city") for event in ("insert", "update", "delete")]
+
+# 迁移步骤为 SQL 语句，或者在同一个事务中执行的检查函数
+MIGRATIONS: List[List[Union[str, Callable[[Connection], None]]]] = [
+    # 1: data 表的覆盖索引
+    [
+        "CREATE INDEX IF NOT EXISTS ix_data_city_date ON data (city_id, date, confirmed, deaths, recovered)",
+        "CREATE INDEX IF NOT EXISTS ix_data_date ON data (date)",
+    ],
+    # 2: 按城市 / 国家的每日汇总表和维护它们的触发器
+    [
+        """
+        CREATE TABLE IF NOT EXISTS rollup_city_daily (
+            city_id INTEGER NOT NULL,
+            date VARCHAR NOT NULL,
+            confirmed BIGINT NOT NULL DEFAULT 0,
+            deaths BIGINT NOT NULL DEFAULT 0,
+            recovered BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (city_id, date)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS rollup_country_daily (
+            country_code VARCHAR(100) NOT NULL,
+            date VARCHAR NOT NULL,
+            confirmed BIGINT NOT NULL DEFAULT 0,
+            deaths BIGINT NOT NULL DEFAULT 0,
+            recovered BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (country_code, date)
+        ) WITHOUT ROWID
+        """,
+        "DELETE FROM rollup_city_daily",
+        "DELETE FROM rollup_country_daily",
+        """
+        INSERT INTO rollup_city_daily (city_id, date, confirmed, deaths, recovered)
+        SELECT city_id, date, SUM(confirmed), SUM(deaths), SUM(recovered)
+        FROM data WHERE city_id IS NOT NULL GROUP BY city_id, date
+        """,
+        """
+        INSERT INTO rollup_country_daily (country_code, date, confirmed, deaths, recovered)
+        SELECT city.country_code, data.date, SUM(data.confirmed), SUM(data.deaths), SUM(data.recovered)
+        FROM data JOIN city ON city.id = data.city_id GROUP BY city.country_code, data.date
+        """,
+        *_rollup_triggers(),
+        "ANALYZE",
+    ],
+    # 3: 数据版本计数器
+    [
+        """
+        CREATE TABLE IF NOT EXISTS data_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0)",
+        *_version_triggers(),
+    ],
+    # 4: 批量导入：(city_id, date) 唯一，逐行触发器可以在导入事务内暂停
+    [
+        _check_no_duplicate_data,
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_data_city_date ON data (city_id, date)",
+        "ALTER TABLE data_version ADD COLUMN bulk INTEGER NOT NULL DEFAULT 0",
+        *[f"DROP TRIGGER IF EXISTS {name}" for name in TRIGGER_NAMES],
+        *_rollup_triggers(bulk_guard=True),
+        *_version_triggers(bulk_guard=True),
+        "ANALYZE",
+    ],
+]
+
+
+def migrate(connection: Connection) -> int:
+    """执行未执行过的迁移，返回迁移后的版本号。connection 需要是 AUTOCOMMIT 模式，事务由这里控制"""
+    from coronavirus import models
+
+    connection.exec_driver_sql("BEGIN IMMEDIATE")
+    try:
+        version = connection.exec_driver_sql("PRAGMA user_version").scalar()
+        if version == 0:
+            models.Base.metadata.create_all(connection, tables=[models.City.__table__, models.Data.__table__])
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                if callable(statement):
+                    statement(connection)
+                else:
+                    connection.exec_driver_sql(statement)
+            # PRAGMA 不支持参数绑定
+            connection.exec_driver_sql(f"PRAGMA user_version = {int(number)}")
+            version = number
+        connection.exec_driver_sql("COMMIT")
+    except BaseException:
+        connection.exec_driver_sql("ROLLBACK")
+        raise
+    return version
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    from coronavirus.database import DB_PATH, prepare_database_file, run_migrations, write_engine
+
+    async def main():
+        prepare_database_file()
+        try:
+            print(f"{DB_PATH}: version {await run_migrations()}")
+        finally:
+            await write_engine.dispose()
+
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+# -*- coding:utf-8 -*-
+import datetime
+from typing import List, Optional
+
+from sqlalchemy import BigInteger, Date, DateTime, ForeignKey, Index, String, func
+from sqlalchemy.orm import Mapped, mapped_column, relationship
+
+from .database import Base
+
+
+class City(Base):
+    __tablename__ = 'city'  # 数据表的表名
+
+    id: Mapped[int] = mapped_column(primary_key=True, index=True, autoincrement=True)
+    province: Mapped[str] = mapped_column(String(100), unique=True, nullable=False, comment='省/直辖市')
+    country: Mapped[str] = mapped_column(String(100), nullable=False, comment='国家')
+    country_code: Mapped[str] = mapped_column(String(100), nullable=False, comment='国家代码')
+    country_population: Mapped[int] = mapped_column(BigInteger, nullable=False, comment='国家人口')
+    created_at: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime, server_default=func.now(), comment='创建时间')
+    updated_at: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime, server_default=func.now(),
+                                                           onupdate=func.now(), comment='更新时间')
+
+    # 'Data' 是关联的类名；back_populates 指定反向访问的属性名称
+    data: Mapped[List["Data"]] = relationship(back_populates='city')
+
+    def __repr__(self):
+        return f'{self.country}_{self.province}'
+
+
+class Data(Base):
+    __tablename__ = 'data'
+
+    id: Mapped[int] = mapped_column(primary_key=True, index=True, autoincrement=True)
+    # ForeignKey里的字符串格式不是类名.属性名，而是表名.字段名
+    city_id: Mapped[Optional[int]] = mapped_column(ForeignKey('city.id'), comment='所属省/直辖市')
+    date: Mapped[datetime.date] = mapped_column(Date, nullable=False, comment='数据日期')
+    confirmed: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False, comment='确诊数量')
+    deaths: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False, comment='死亡数量')
+    recovered: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False, comment='痊愈数量')
+    created_at: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime, server_default=func.now(), comment='创建时间')
+    updated_at: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime, server_default=func.now(),
+                                                           onupdate=func.now(), comment='更新时间')
+
+    city: Mapped[Optional[City]] = relationship(back_populates='data')
+
+    # 与 migrations.py 中创建的索引一致
+    __table_args__ = (
+        Index('ux_data_city_date', 'city_id', 'date', unique=True),
+        Index('ix_data_city_date', 'city_id', 'date', 'confirmed', 'deaths', 'recovered'),
+        Index('ix_data_date', 'date'),
+    )
+
+    def __repr__(self):
+        return f'{repr(self.date)}：确诊{self.confirmed}例'
+
+
+class CityDailyRollup(Base):
+    """按城市、日期汇总的物化表，由 data 表上的触发器维护，只读"""
+    __tablename__ = 'rollup_city_daily'
+
+    city_id: Mapped[int] = mapped_column(primary_key=True)
+    date: Mapped[datetime.date] = mapped_column(Date, primary_key=True)
+    confirmed: Mapped[int] = mapped_column(BigInteger, default=0)
+    deaths: Mapped[int] = mapped_column(BigInteger, default=0)
+    recovered: Mapped[int] = mapped_column(BigInteger, default=0)
+
+
+class CountryDailyRollup(Base):
+    """按国家代码、日期汇总的物化表，由 data 表上的触发器维护，只读"""
+    __tablename__ = 'rollup_country_daily'
+
+    country_code: Mapped[str] = mapped_column(String(100), primary_key=True)
+    date: Mapped[datetime.date] = mapped_column(Date, primary_key=True)
+    confirmed: Mapped[int] = mapped_column(BigInteger, default=0)
+    deaths: Mapped[int] = mapped_column(BigInteger, default=0)
+    recovered: Mapped[int] = mapped_column(BigInteger, default=0)
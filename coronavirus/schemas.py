@@ -0,0 +1,53 @@
+# -*- coding:utf-8 -*-
+from datetime import date as date_, datetime
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class CreateData(BaseModel):
+    date: date_
+    confirmed: int = 0
+    deaths: int = 0
+    recovered: int = 0
+
+
+class CreateCity(BaseModel):
+    province: str
+    country: str
+    country_code: str
+    country_population: int
+
+
+class ReadData(CreateData):
+    id: int
+    city_id: int
+    updated_at: datetime
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class ReadCity(CreateCity):
+    id: int
+    updated_at: datetime
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class DataPage(BaseModel):
+    items: List[ReadData]
+    next_cursor: Optional[str] = None  # 为空表示没有下一页
+
+
+class DailyTotal(BaseModel):
+    date: date_
+    confirmed: int
+    deaths: int
+    recovered: int
+
+    class Config:
+        from_attributes = True
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+WebSocket 广播的 CPU 开销基准测试
+
+不经过网络：每个连接是真实的 starlette WebSocket，ASGI send 模拟 uvicorn（websockets 实现）的工作——
+文本消息编码为 UTF-8，再用 websockets 构造服务端帧。测量每次广播（直到所有连接都发送完）的 CPU 时间：
+- before：原来的 ConnectionManager，逐个 await send_text / send_json，每个连接各自序列化
+- queued：ws_manager 的发送队列，但每个连接各自序列化（相当于引入帧缓存之前的 ws_manager）
+- after：ws_manager.ConnectionManager，每种帧格式只序列化一次，所有连接共用同一个 ASGI 消息；
+  msgpack / cbor 为二进制帧，服务端不必再对每个连接做 UTF-8 编码（需要安装 msgpack / cbor2）
+
+依赖 req.txt 中的 websockets（uvicorn 默认的 WebSocket 实现，用来构造帧）和 msgpack / cbor2，
+未安装 msgpack / cbor2 时只测试 text 格式
+
+--burst N 时另外测试突发负载：连续广播 N 条消息，比较逐条发送和批量发送（batch=True）的帧数与 CPU 时间
+
+用法:
+    python bench_ws_broadcast.py
+    python bench_ws_broadcast.py --connections 1000 10000 --rounds 20
+    python bench_ws_broadcast.py --connections 1000 --burst 50
+"""
+import argparse
+import asyncio
+import time
+from typing import Any, Callable, Dict, List
+
+from starlette.websockets import WebSocket
+from websockets.frames import Frame, Opcode
+
+from ws_manager import CBOR, MSGPACK, TEXT, ConnectionManager, available_formats, encode_frame
+
+
+class LegacyConnectionManager:
+    """official_websocket_server_v3 原来的实现"""
+
+    def __init__(self):
+        self.active_connections: List[WebSocket] = []
+
+    async def connect(self, websocket: WebSocket):
+        await websocket.accept()
+        self.active_connections.append(websocket)
+
+    async def broadcast(self, message: str):
+        for connection in self.active_connections:
+            await connection.send_text(message)
+
+    async def broadcast_json(self, message: Any):
+        for connection in self.active_connections:
+            await connection.send_json(message)
+
+
+class PerConnectionEncodeManager(ConnectionManager):
+    """发送队列相同，但每个连接各自序列化一次"""
+
+    def _fanout(self, room, message):
+        targets = self.active_connections if room is None else self.rooms.get(room, ())
+        for connection in list(targets):
+            connection.enqueue(encode_frame(message, connection.frame_format))
+
+
+class FrameCounter:
+    """只统计帧数和字节数的 ASGI send"""
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    async def send(self, message: Dict[str, Any]):
+        if message["type"] != "websocket.send":
+            return
+        data = message.get("bytes")
+        if data is None:
+            data = message["text"].encode("utf-8")
+        Frame(Opcode.BINARY, data).serialize(mask=False)
+        self.frames += 1
+        self.bytes += len(data)
+
+
+class Delivery:
+    """统计已发出的帧数，全部发完时通知"""
+
+    def __init__(self):
+        self.target = 0
+        self.sent = 0
+        self.done = asyncio.Event()
+
+    def expect(self, count: int):
+        self.target = count
+        self.sent = 0
+        self.done.clear()
+
+    async def send(self, message: Dict[str, Any]):
+        if message["type"] != "websocket.send":
+            return
+        if message.get("bytes") is not None:
+            Frame(Opcode.BINARY, message["bytes"]).serialize(mask=False)
+        else:
+            Frame(Opcode.TEXT, message["text"].encode("utf-8")).serialize(mask=False)
+        self.sent += 1
+        if self.sent >= self.target:
+            self.done.set()
+
+
+def make_websocket(send: Callable[[Dict[str, Any]], Any]) -> WebSocket:
+    connected = [False]
+
+    async def receive():
+        if not connected[0]:
+            connected[0] = True
+            return {"type": "websocket.connect"}
+        await asyncio.Event().wait()
+
+    scope = {"type": "websocket", "path": "/ws", "headers": [], "query_string": b""}
+    return WebSocket(scope, receive, send)
+
+
+async def measure(rounds: int, connections: int, delivery: Delivery,
+                  broadcast: Callable[[], Any]) -> Dict[str, float]:
+    cpu = wall = 0.0
+    for _ in range(rounds):
+        delivery.expect(connections)
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        await broadcast()
+        await delivery.done.wait()
+        cpu += time.process_time() - cpu_start
+        wall += time.perf_counter() - wall_start
+    return {"cpu_ms": cpu / rounds * 1000, "wall_ms": wall / rounds * 1000}
+
+
+async def bench(connections: int, rounds: int):
+    text = "Client #1700000000000 says: " + "你好，WebSocket 广播测试 " * 4
+    payload = {"client_id": 1700000000000, "event": "message", "text": text}
+    results = []
+
+    delivery = Delivery()
+    legacy = LegacyConnectionManager()
+    for _ in range(connections):
+        await legacy.connect(make_websocket(delivery.send))
+    results.append(("before  str  send_text", await measure(rounds, connections, delivery,
+                                                             lambda: legacy.broadcast(text))))
+    results.append(("before  dict send_json", await measure(rounds, connections, delivery,
+                                                             lambda: legacy.broadcast_json(payload))))
+
+    delivery = Delivery()
+    queued = PerConnectionEncodeManager(queue_size=rounds + 1, max_connections=0)
+    for i in range(connections):
+        await queued.connect(make_websocket(delivery.send), i)
+    results.append(("queued  str  text", await measure(rounds, connections, delivery,
+                                                        lambda: queued.broadcast(text))))
+    results.append(("queued  dict text", await measure(rounds, connections, delivery,
+                                                        lambda: queued.broadcast(payload))))
+    for connection in list(queued.active_connections):
+        queued.disconnect(connection)
+
+    for frame_format in (TEXT, MSGPACK, CBOR):
+        if frame_format not in available_formats():
+            print(f"跳过 {frame_format}：未安装对应的包")
+            continue
+        delivery = Delivery()
+        manager = ConnectionManager(queue_size=rounds + 1, max_connections=0)
+        for i in range(connections):
+            await manager.connect(make_websocket(delivery.send), i, frame_format=frame_format)
+        if frame_format == TEXT:
+            results.append(("after   str  text", await measure(rounds, connections, delivery,
+                                                               lambda: manager.broadcast(text))))
+        results.append((f"after   dict {frame_format}", await measure(rounds, connections, delivery,
+                                                                       lambda: manager.broadcast(payload))))
+        for connection in list(manager.active_connections):
+            manager.disconnect(connection)
+
+    print(f"\n{connections} 个连接，每项 {rounds} 次广播的平均值")
+    for label, result in results:
+        print(f"{label:>24}: CPU {result['cpu_ms']:8.2f} ms/次  "
+              f"({result['cpu_ms'] * 1000 / connections:5.2f} us/连接)  耗时 {result['wall_ms']:8.2f} ms")
+
+
+async def bench_burst(connections: int, burst: int):
+    """连续广播 burst 条消息（模拟聊天室中多人同时发言），统计全部送达时的帧数和 CPU 时间"""
+    print(f"\n{connections} 个连接，突发 {burst} 条广播")
+    for batch in (False, True):
+        counter = FrameCounter()
+        manager = ConnectionManager(queue_size=burst + 1, max_connections=0)
+        for i in range(connections):
+            await manager.connect(make_websocket(counter.send), i, batch=batch)
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        for i in range(burst):
+            await manager.broadcast(f"Client #{i} says: hello")
+        while any(connection.queue for connection in manager.active_connections):
+            await asyncio.sleep(0.001)
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+        label = f"batch (<= {manager.batch_max_messages} 条 / {manager.batch_window * 1000:g} ms)" if batch else "逐条发送"
+        print(f"{label:>24}: 帧数 {counter.frames:8d}  字节 {counter.bytes:10d}  "
+              f"CPU {cpu * 1000:8.2f} ms  耗时 {wall * 1000:8.2f} ms")
+        for connection in list(manager.active_connections):
+            manager.disconnect(connection)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WebSocket 广播的 CPU 开销基准测试")
+    parser.add_argument("--connections", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--burst", type=int, default=0, help="突发广播的消息数，0 表示不测试")
+    args = parser.parse_args()
+    for connections in args.connections:
+        asyncio.run(bench(connections, args.rounds))
+        if args.burst:
+            asyncio.run(bench_burst(connections, args.burst))
+
+
+if __name__ == "__main__":
+    main()
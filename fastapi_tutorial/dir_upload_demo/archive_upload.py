@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+归档上传：/upload 接收单个 tar 流并边接收边解压
+
+上万个小文件逐个作为 multipart part 上传时，浏览器和服务端的开销主要花在每个 part 上。
+客户端打包成一个 tar（可选 gzip/bzip2/xz 压缩，安装 zstandard 后也支持 zstd）后作为请求体发送：
+- 解压线程通过 RequestStreamReader 按需从 request.stream() 拉取数据，tarfile 以流模式（r|*）顺序读取，
+  整个归档不会缓存在内存或磁盘上，接收速度受解压速度约束（背压）
+- 只解出普通文件和目录，符号链接、硬链接、设备文件等条目被跳过
+- 条目路径经 safe_relative_path 校验，绝对路径、包含 .. 的路径和保留路径都会被拒绝，不会写到上传目录之外
+"""
+import asyncio
+import io
+import os
+import tarfile
+import zlib
+from typing import Any, AsyncIterator, Dict, Optional, Set
+
+from stream_upload import UploadRejected, safe_relative_path
+
+try:
+    import zstandard
+except ImportError:  # 未安装 zstandard 时不支持 zstd 压缩的归档
+    zstandard = None
+
+# 解压时表示归档本身损坏的异常
+ARCHIVE_ERRORS = (tarfile.TarError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+# 按归档处理的请求 Content-Type
+ARCHIVE_CONTENT_TYPES = {
+    b"application/x-tar", b"application/tar",
+    b"application/gzip", b"application/x-gzip", b"application/x-compressed-tar",
+    b"application/x-bzip2", b"application/x-xz",
+    b"application/zstd", b"application/x-zstd",
+    b"application/octet-stream",
+}
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class UnsupportedArchive(UploadRejected):
+    """归档的压缩格式不受支持，应返回 415"""
+
+
+class RequestStreamReader(io.RawIOBase):
+    """
+    把 request.stream() 包装成阻塞读取的文件对象，供工作线程中的 tarfile 使用
+
+    每次缓冲区读完时才通过 run_coroutine_threadsafe 在事件循环中取下一块数据，因此只能在工作线程中读取。
+    """
+
+    def __init__(self, chunks: AsyncIterator[bytes], loop: asyncio.AbstractEventLoop):
+        self._chunks = chunks
+        self._loop = loop
+        self._buffer = memoryview(b"")
+        self._eof = False
+        self.bytes_received = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def _fill(self) -> bool:
+        while not self._buffer and not self._eof:
+            try:
+                chunk = asyncio.run_coroutine_threadsafe(self._chunks.__anext__(), self._loop).result()
+            except StopAsyncIteration:
+                self._eof = True
+                break
+            self.bytes_received += len(chunk)
+            self._buffer = memoryview(chunk)
+        return bool(self._buffer)
+
+    def peek(self, size: int) -> bytes:
+        """读取开头的 size 个字节但不消耗（只用于识别压缩格式）"""
+        data = b""
+        while len(data) < size and self._fill():
+            data += bytes(self._buffer)
+            self._buffer = memoryview(b"")
+        self._buffer = memoryview(data)
+        return data[:size]
+
+    def readinto(self, b) -> int:
+        if not self._fill():
+            return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def open_archive_stream(reader: RequestStreamReader) -> io.RawIOBase:
+    """识别 zstd 压缩并解压，gzip/bzip2/xz 由 tarfile 的 r|* 模式自行识别"""
+    if reader.peek(4) != ZSTD_MAGIC:
+        return reader
+    if zstandard is None:
+        raise UnsupportedArchive("服务端未安装 zstandard，不支持 zstd 压缩的归档")
+    return zstandard.ZstdDecompressor().stream_reader(reader)
+
+
+def extract_archive(reader: RequestStreamReader, upload_dir: str, blob_store=None,
+                    max_files: Optional[int] = None, saved_paths: Optional[Set[str]] = None) -> Dict[str, Any]:
+    """
+    边读取边解压归档到 upload_dir（阻塞调用，应在线程池中执行）
+
+    传入 blob_store 时文件写入去重存储再链接到目标位置。
+    传入 saved_paths 时把写入的文件和创建的目录（完整路径）加入其中。
+    单个条目出错时记录到 errors 并继续，归档本身损坏时抛出 UploadRejected。
+    """
+    result = {"saved_files": 0, "deduplicated_files": 0, "total_files": 0, "bytes_written": 0,
+              "skipped": [], "errors": []}
+    made_dirs = {upload_dir}
+
+    saved_paths = set() if saved_paths is None else saved_paths
+
+    def ensure_dir(path: str):
+        if path not in made_dirs:
+            os.makedirs(path, exist_ok=True)
+            made_dirs.add(path)
+            while path != upload_dir and path not in saved_paths:
+                saved_paths.add(path)
+                path = os.path.dirname(path)
+
+    try:
+        with tarfile.open(fileobj=open_archive_stream(reader), mode="r|*") as tar:
+            for member in tar:
+                if member.isdir() and os.path.normpath(member.name) == ".":
+                    continue
+                try:
+                    relative_path = safe_relative_path(member.name)
+                except ValueError as e:
+                    result["errors"].append({"path": member.name, "error": str(e)})
+                    continue
+                full_path = os.path.join(upload_dir, *relative_path.split("/"))
+
+                if member.isdir():
+                    try:
+                        ensure_dir(full_path)
+                    except OSError as e:
+                        result["errors"].append({"path": relative_path, "error": str(e)})
+                    continue
+                if not member.isfile():
+                    result["skipped"].append({"path": relative_path, "reason": "不支持的条目类型（符号链接、硬链接、设备文件等）"})
+                    continue
+
+                result["total_files"] += 1
+                if max_files is not None and result["total_files"] > max_files:
+                    raise UploadRejected(f"归档中的文件数超过上限 {max_files}")
+                try:
+                    ensure_dir(os.path.dirname(full_path))
+                    src = tar.extractfile(member)
+                    if blob_store is not None:
+                        if blob_store.write_stream(src, full_path):
+                            result["deduplicated_files"] += 1
+                    else:
+                        with open(full_path, "wb") as dst:
+                            while chunk := src.read(1024 * 1024):
+                                dst.write(chunk)
+                    result["saved_files"] += 1
+                    result["bytes_written"] += member.size
+                    saved_paths.add(full_path)
+                except OSError as e:
+                    result["errors"].append({"path": relative_path, "error": str(e)})
+    except ARCHIVE_ERRORS as e:
+        raise UploadRejected(f"归档格式错误: {e}")
+
+    result["bytes_received"] = reader.bytes_received
+    return result
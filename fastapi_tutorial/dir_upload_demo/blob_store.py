@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+按内容寻址的去重存储
+
+同一个文件夹（如构建产物）反复上传时，大部分文件内容没有变化。这里把文件内容按 SHA-256 保存在
+UPLOAD_DIR/.blobs/<前2位>/<其余62位> 中，上传目录里的文件都是指向 blob 的硬链接：
+- 内容已存在的文件只需创建一个硬链接，不再写入数据
+- 客户端可以先调用预检接口查询服务端已有哪些哈希，这些文件只提交路径和哈希（/upload 的 blobs 字段、分块上传的 sha256）
+- 上传目录中的文件被删除后，不再被引用的 blob（链接数为1）超过 grace_seconds 后由 gc() 清理。
+  上传接口不会先清空上传目录，新文件原子地替换旧文件，上传成功后才删除本次没有的文件，
+  内容没变的文件一直链接着 blob；宽限期用于复用最近删除的文件的内容。
+  链接数变化会更新 inode 的 ctime，因此用 ctime 判断 blob 不再被引用了多久
+
+blob 设为只读（0o444），由于硬链接共享 inode，上传目录中的文件同样是只读的，
+避免原地修改某个文件时影响其他引用同一内容的文件。
+硬链接要求上传目录、.blobs 和临时文件在同一文件系统上。
+"""
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+from typing import BinaryIO, Iterable, List, Optional, Tuple
+
+HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+READ_CHUNK = 1024 * 1024
+# 临时文件超过该时间（秒）仍未提交时由 gc() 清理
+TEMP_MAX_AGE = 3600
+
+
+def hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(READ_CHUNK):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class BlobStore:
+    def __init__(self, root: str, grace_seconds: float = 3600):
+        self.root = root
+        self.grace_seconds = grace_seconds
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    @staticmethod
+    def valid_hash(digest: str) -> bool:
+        return bool(HASH_PATTERN.match(digest))
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def has(self, digest: str) -> bool:
+        return self.valid_hash(digest) and os.path.isfile(self.blob_path(digest))
+
+    def missing(self, digests: Iterable[str]) -> List[str]:
+        """返回存储中还没有的哈希（保持原顺序、去重）"""
+        result = []
+        seen = set()
+        for digest in digests:
+            digest = digest.lower()
+            if digest not in seen:
+                seen.add(digest)
+                if not self.has(digest):
+                    result.append(digest)
+        return result
+
+    def new_temp(self) -> Tuple[BinaryIO, str]:
+        """在存储的临时目录中创建文件，写完后用 adopt() 提交"""
+        fd, path = tempfile.mkstemp(dir=self.tmp_dir, suffix=".tmp")
+        return os.fdopen(fd, "wb"), path
+
+    def link(self, digest: str, dest_path: str):
+        """把 blob 链接到 dest_path：先在同目录创建临时链接再改名，目标已存在时原子替换"""
+        tmp_link = os.path.join(os.path.dirname(dest_path), f".{uuid.uuid4().hex}.link")
+        os.link(self.blob_path(digest), tmp_link)
+        try:
+            os.replace(tmp_link, dest_path)
+        except OSError:
+            os.remove(tmp_link)
+            raise
+
+    def adopt(self, path: str, dest_path: str, digest: Optional[str] = None) -> bool:
+        """
+        把已写好的文件 path 收入存储并放到 dest_path，path 随后不再存在
+
+        内容已存在时直接链接已有 blob 并删除 path，返回 True；否则 path 本身成为新的 blob，返回 False
+        """
+        digest = digest or hash_file(path)
+        blob = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        os.chmod(path, 0o444)
+        while True:
+            try:
+                os.link(path, blob)
+            except FileExistsError:
+                try:
+                    self.link(digest, dest_path)
+                except FileNotFoundError:
+                    # 已有的 blob 刚好被 gc 清理，重新把 path 收入存储
+                    continue
+                os.remove(path)
+                return True
+            os.replace(path, dest_path)
+            return False
+
+    def save_fileobj(self, fileobj: BinaryIO, dest_path: str) -> bool:
+        """保存已接收的文件对象：先只读计算哈希，内容已存在时不写数据，返回是否去重"""
+        sha256 = hashlib.sha256()
+        fileobj.seek(0)
+        while chunk := fileobj.read(READ_CHUNK):
+            sha256.update(chunk)
+        digest = sha256.hexdigest()
+        if self.has(digest):
+            try:
+                self.link(digest, dest_path)
+                return True
+            except FileNotFoundError:
+                # blob 刚好被 gc 清理，按新内容写入
+                pass
+
+        fileobj.seek(0)
+        tmp, tmp_path = self.new_temp()
+        try:
+            with tmp:
+                shutil.copyfileobj(fileobj, tmp, READ_CHUNK)
+            return self.adopt(tmp_path, dest_path, digest)
+        except BaseException:
+            self.discard_temp(tmp_path)
+            raise
+
+    def write_stream(self, fileobj: BinaryIO, dest_path: str) -> bool:
+        """保存只能顺序读取一次的数据流（如 tar 条目）：边写临时文件边计算哈希，返回是否去重"""
+        sha256 = hashlib.sha256()
+        tmp, tmp_path = self.new_temp()
+        try:
+            with tmp:
+                while chunk := fileobj.read(READ_CHUNK):
+                    sha256.update(chunk)
+                    tmp.write(chunk)
+            return self.adopt(tmp_path, dest_path, sha256.hexdigest())
+        except BaseException:
+            self.discard_temp(tmp_path)
+            raise
+
+    @staticmethod
+    def discard_temp(tmp_path: str):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+    def gc(self) -> int:
+        """删除不再被引用（链接数为1）超过 grace_seconds 的 blob 和过期的临时文件，返回删除的 blob 数"""
+        removed = 0
+        now = time.time()
+        for entry in os.scandir(self.root):
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            if entry.path == self.tmp_dir:
+                for tmp in os.scandir(entry.path):
+                    try:
+                        if now - tmp.stat().st_mtime > TEMP_MAX_AGE:
+                            os.remove(tmp.path)
+                    except OSError:
+                        continue
+                continue
+            for blob in os.scandir(entry.path):
+                try:
+                    st = blob.stat(follow_symlinks=False)
+                    if st.st_nlink == 1 and now - st.st_ctime > self.grace_seconds:
+                        os.remove(blob.path)
+                        removed += 1
+                except OSError:
+                    continue
+        return removed
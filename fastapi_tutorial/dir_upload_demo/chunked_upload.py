@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+分块上传（可断点续传）
+
+一次 multipart POST 上传整个文件夹时，网络中断就只能从头再来。这里把上传拆成会话：
+1. 创建会话：提交文件清单（相对路径和大小），服务端为每个文件预分配 <会话目录>/<序号>.part
+2. 上传分块：每个文件按固定的 chunk_size 切块，每块单独 PUT 并附带 SHA-256 校验值，
+   服务端校验通过后按偏移写入 .part 文件，并把已收到的块追加记录到 received.log
+   分块之间互不依赖，客户端可以乱序、并行上传
+3. 查询状态：返回每个文件已收到的块，客户端断线重连后只需补传缺失的块
+4. 完成会话：所有块到齐后把每个 .part 文件 os.replace 到 UPLOAD_DIR 下的最终位置，
+   同一文件系统内的改名是原子的，UPLOAD_DIR 中不会出现写了一半的文件。
+   每移动完一个文件就记录到 moved.log，中途出错（如磁盘满、权限不足）时会话保持未完成，
+   重试完成时跳过已移动的文件；全部移动成功后会话才标记为完成并删除
+
+会话数据保存在 UPLOAD_SESSION_DIR（默认 upload_sessions，与 UPLOAD_DIR 分开，不受 /upload 删除旧文件的影响，
+但需要在同一文件系统上，否则 os.replace 会失败），超过 UPLOAD_SESSION_TTL 秒（默认24小时）未更新的会话会在创建新会话时清理。
+使用去重存储（blob_store）时：
+- 创建会话时文件可以附带 sha256，存储中已有该内容的文件直接链接到 .part，无需上传任何分块（chunks 为 0）
+- 完成会话时其余文件计算哈希（与客户端提供的 sha256 不一致时拒绝完成），收入存储后再链接到 UPLOAD_DIR
+
+注意：received.log 追加前没有 fsync，进程崩溃不影响续传，操作系统崩溃后可能需要重传最后几个块。
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from blob_store import BlobStore, hash_file
+from stream_upload import safe_relative_path
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class UploadSessionError(Exception):
+    """会话操作失败，status_code 为应返回的 HTTP 状态码"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class UploadSession:
+    def __init__(self, session_id: str, session_dir: str, manifest: Dict[str, Any]):
+        self.session_id = session_id
+        self.session_dir = session_dir
+        self.chunk_size: int = manifest["chunk_size"]
+        self.files: List[Dict[str, Any]] = manifest["files"]
+        self.created_at: float = manifest["created_at"]
+        self.received: List[set] = [set() for _ in self.files]
+        # 已移动到上传目录的文件序号 -> 是否去重
+        self.moved: Dict[int, bool] = {}
+        self.completing = False
+        self.completed = False
+        # 正在 pwrite 的分块数；完成会话要等它归零，否则写入可能落到已收入 blob 存储的文件上
+        self.writing = 0
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+
+    @staticmethod
+    def chunk_count(size: int, chunk_size: int) -> int:
+        return (size + chunk_size - 1) // chunk_size
+
+    def part_path(self, file_index: int) -> str:
+        return os.path.join(self.session_dir, f"{file_index}.part")
+
+    @property
+    def log_path(self) -> str:
+        return os.path.join(self.session_dir, "received.log")
+
+    @property
+    def moved_log_path(self) -> str:
+        return os.path.join(self.session_dir, "moved.log")
+
+    def expected_length(self, file_index: int, chunk_index: int) -> int:
+        size = self.files[file_index]["size"]
+        return min(self.chunk_size, size - chunk_index * self.chunk_size)
+
+    def missing(self) -> int:
+        return sum(f["chunks"] - len(received) for f, received in zip(self.files, self.received))
+
+    def status(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "session_id": self.session_id,
+                "chunk_size": self.chunk_size,
+                "completed": self.completed,
+                "missing_chunks": self.missing(),
+                "files": [
+                    {**f, "index": i, "received": sorted(received)}
+                    for i, (f, received) in enumerate(zip(self.files, self.received))
+                ],
+            }
+
+
+class ChunkedUploadStore:
+    """分块上传会话的存储（所有方法都是阻塞调用，应在线程池中执行）"""
+
+    def __init__(self, session_root: str, upload_dir: str, ttl_seconds: float = 24 * 3600,
+                 blob_store: Optional[BlobStore] = None):
+        self.session_root = session_root
+        self.upload_dir = upload_dir
+        self.blob_store = blob_store
+        self.ttl_seconds = ttl_seconds
+        self._sessions: Dict[str, UploadSession] = {}
+        self._lock = threading.Lock()
+        os.makedirs(session_root, exist_ok=True)
+
+    def create(self, files: List[Dict[str, Any]], chunk_size: Optional[int] = None) -> Dict[str, Any]:
+        """创建会话，files 为 [{"path": 相对路径, "size": 字节数, "sha256": 可选的内容哈希}]"""
+        self.cleanup_expired()
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+            raise UploadSessionError(400, f"chunk_size 必须在 {MIN_CHUNK_SIZE} 到 {MAX_CHUNK_SIZE} 之间")
+
+        normalized = []
+        seen = set()
+        for f in files:
+            try:
+                path = safe_relative_path(str(f["path"]))
+            except ValueError as e:
+                raise UploadSessionError(400, str(e))
+            if path in seen:
+                raise UploadSessionError(400, f"重复的文件路径: {path}")
+            if f["size"] < 0:
+                raise UploadSessionError(400, f"文件大小不能为负数: {path}")
+            seen.add(path)
+            info = {"path": path, "size": f["size"], "chunks": UploadSession.chunk_count(f["size"], chunk_size)}
+            digest = (f.get("sha256") or "").lower()
+            if self.blob_store is not None and BlobStore.valid_hash(digest):
+                info["sha256"] = digest
+            normalized.append(info)
+
+        session_id = uuid.uuid4().hex
+        session_dir = os.path.join(self.session_root, session_id)
+        os.makedirs(session_dir)
+        manifest = {"chunk_size": chunk_size, "files": normalized, "created_at": time.time()}
+        session = UploadSession(session_id, session_dir, manifest)
+        # 预分配 .part 文件（稀疏文件，不实际占用空间），分块按偏移写入
+        for i, f in enumerate(normalized):
+            if "sha256" in f and self._link_existing_blob(f, session.part_path(i)):
+                continue
+            with open(session.part_path(i), "wb") as part:
+                part.truncate(f["size"])
+        open(session.log_path, "wb").close()
+        # manifest 最后写入，作为会话创建完成的标志
+        manifest_tmp = os.path.join(session_dir, "manifest.json.tmp")
+        with open(manifest_tmp, "w", encoding="utf-8") as fp:
+            json.dump(manifest, fp, ensure_ascii=False)
+        os.replace(manifest_tmp, os.path.join(session_dir, "manifest.json"))
+
+        with self._lock:
+            self._sessions[session_id] = session
+        return session.status()
+
+    def _link_existing_blob(self, info: Dict[str, Any], part_path: str) -> bool:
+        """存储中已有该内容时把 blob 链接为 .part 文件（链接同时防止 blob 被 gc 清理），无需再上传"""
+        if not self.blob_store.has(info["sha256"]):
+            return False
+        try:
+            os.link(self.blob_store.blob_path(info["sha256"]), part_path)
+        except OSError:
+            return False
+        info["size"] = os.path.getsize(part_path)
+        info["chunks"] = 0
+        info["deduplicated"] = True
+        return True
+
+    def get(self, session_id: str) -> UploadSession:
+        """获取会话，进程重启后从会话目录恢复"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                return session
+            try:
+                uuid.UUID(hex=session_id)
+            except ValueError:
+                raise UploadSessionError(404, f"会话不存在: {session_id}")
+            session_dir = os.path.join(self.session_root, session_id)
+            try:
+                with open(os.path.join(session_dir, "manifest.json"), encoding="utf-8") as fp:
+                    manifest = json.load(fp)
+            except (OSError, ValueError):
+                raise UploadSessionError(404, f"会话不存在: {session_id}")
+            session = UploadSession(session_id, session_dir, manifest)
+            with open(session.log_path, encoding="utf-8") as fp:
+                for line in fp:
+                    fields = line.split()
+                    # 忽略崩溃时写了一半的最后一行
+                    if len(fields) == 2 and line.endswith("\n"):
+                        file_index, chunk_index = int(fields[0]), int(fields[1])
+                        session.received[file_index].add(chunk_index)
+            try:
+                with open(session.moved_log_path, encoding="utf-8") as fp:
+                    for line in fp:
+                        fields = line.split()
+                        if len(fields) == 2 and line.endswith("\n"):
+                            session.moved[int(fields[0])] = fields[1] == "1"
+            except FileNotFoundError:
+                pass
+            self._sessions[session_id] = session
+            return session
+
+    def write_chunk(self, session_id: str, file_index: int, chunk_index: int, data: bytes,
+                    checksum: str) -> Dict[str, Any]:
+        """校验并写入一个分块，重复上传同一分块是幂等的"""
+        session = self.get(session_id)
+        if not 0 <= file_index < len(session.files):
+            raise UploadSessionError(404, f"文件序号不存在: {file_index}")
+        if not 0 <= chunk_index < session.files[file_index]["chunks"]:
+            raise UploadSessionError(404, f"分块序号不存在: {chunk_index}")
+        expected = session.expected_length(file_index, chunk_index)
+        if len(data) != expected:
+            raise UploadSessionError(400, f"分块大小应为 {expected} 字节，实际为 {len(data)} 字节")
+        if hashlib.sha256(data).hexdigest() != checksum.lower():
+            raise UploadSessionError(422, "分块校验值不匹配")
+
+        # 不同分块写入不同偏移，可以并行，写入前后各加一次锁：
+        # 已收到的分块不再写入（重试的 PUT 直接返回），其余的计入 writing，complete 等它们写完才开始
+        with session.lock:
+            if session.completed or session.completing:
+                raise UploadSessionError(409, "会话已完成")
+            if chunk_index in session.received[file_index]:
+                return {"file_index": file_index, "chunk_index": chunk_index, "missing_chunks": session.missing()}
+            session.writing += 1
+        try:
+            try:
+                fd = os.open(session.part_path(file_index), os.O_WRONLY)
+            except FileNotFoundError:
+                # 会话已删除，.part 文件已被移走
+                raise UploadSessionError(409, "会话已结束")
+            try:
+                os.pwrite(fd, data, chunk_index * session.chunk_size)
+            finally:
+                os.close(fd)
+            with session.lock:
+                if chunk_index not in session.received[file_index]:
+                    with open(session.log_path, "a", encoding="utf-8") as log:
+                        log.write(f"{file_index} {chunk_index}\n")
+                    session.received[file_index].add(chunk_index)
+                return {"file_index": file_index, "chunk_index": chunk_index, "missing_chunks": session.missing()}
+        finally:
+            with session.lock:
+                session.writing -= 1
+                if not session.writing:
+                    session.idle.notify_all()
+
+    def complete(self, session_id: str) -> Dict[str, Any]:
+        """
+        所有分块到齐后把文件原子地移动到上传目录，并删除会话
+
+        移动中途出错时会话保持未完成，已移动的文件记录在 moved.log 中，再次调用会跳过它们继续移动
+        """
+        session = self.get(session_id)
+        with session.lock:
+            if session.completed:
+                raise UploadSessionError(409, "会话已完成")
+            if session.completing:
+                raise UploadSessionError(409, "会话正在完成")
+            missing = session.missing()
+            if missing:
+                raise UploadSessionError(409, f"还有 {missing} 个分块未上传")
+            # 同一分块的并发重传可能还在写，等它们写完；completing 置位后不会再有新的写入
+            session.completing = True
+            while session.writing:
+                session.idle.wait()
+
+        try:
+            self._move_files(session)
+            with session.lock:
+                session.completed = True
+        finally:
+            with session.lock:
+                session.completing = False
+
+        self.discard(session_id)
+        return {
+            "session_id": session_id,
+            "saved_files": len(session.files),
+            "deduplicated_files": sum(session.moved.values()),
+            "total_bytes": sum(f["size"] for f in session.files),
+            "upload_dir": os.path.abspath(self.upload_dir),
+        }
+
+    def _move_files(self, session: UploadSession):
+        """把尚未移动的 .part 文件移动到上传目录，每移动一个记录一个"""
+        # 先计算并校验所有新内容的哈希，校验失败时不移动任何文件
+        digests: Dict[int, str] = {}
+        if self.blob_store is not None:
+            for i, f in enumerate(session.files):
+                if f.get("deduplicated") or i in session.moved:
+                    continue
+                digests[i] = hash_file(session.part_path(i))
+                if f.get("sha256") and f["sha256"] != digests[i]:
+                    raise UploadSessionError(422, f"文件 {f['path']} 的内容与 sha256 不一致")
+
+        made_dirs = set()
+        with open(session.moved_log_path, "a", encoding="utf-8") as moved_log:
+            for i, f in enumerate(session.files):
+                if i in session.moved:
+                    continue
+                full_path = os.path.join(self.upload_dir, *f["path"].split("/"))
+                parent = os.path.dirname(full_path)
+                try:
+                    if parent not in made_dirs:
+                        os.makedirs(parent, exist_ok=True)
+                        made_dirs.add(parent)
+                    if i in digests:
+                        deduplicated = self.blob_store.adopt(session.part_path(i), full_path, digests[i])
+                    else:
+                        os.replace(session.part_path(i), full_path)
+                        deduplicated = bool(f.get("deduplicated"))
+                except OSError as e:
+                    raise UploadSessionError(500, f"移动文件 {f['path']} 时出错: {e}，可以重试完成会话")
+                moved_log.write(f"{i} {int(deduplicated)}\n")
+                moved_log.flush()
+                session.moved[i] = deduplicated
+
+    def discard(self, session_id: str):
+        """删除会话及其已上传的分块"""
+        session = self.get(session_id)
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        shutil.rmtree(session.session_dir, ignore_errors=True)
+
+    def cleanup_expired(self):
+        """删除超过 ttl_seconds 未更新的会话"""
+        now = time.time()
+        try:
+            entries = list(os.scandir(self.session_root))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                updated_at = os.stat(os.path.join(entry.path, "received.log")).st_mtime
+            except OSError:
+                try:
+                    updated_at = entry.stat().st_mtime
+                except OSError:
+                    continue
+            if now - updated_at > self.ttl_seconds:
+                with self._lock:
+                    self._sessions.pop(entry.name, None)
+                shutil.rmtree(entry.path, ignore_errors=True)
@@ -1,11 +1,25 @@
+import asyncio
+import json
 import os
 import shutil
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, UploadFile, HTTPException, Request, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from typing import List
+from multipart.multipart import parse_options_header
+from starlette.requests import ClientDisconnect
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional, Set
 from pathlib import Path
 
+from stream_upload import StreamingUploadParser, UploadRejected, safe_relative_path
+from chunked_upload import ChunkedUploadStore, UploadSessionError, MAX_CHUNK_SIZE
+from blob_store import BlobStore
+from archive_upload import ARCHIVE_CONTENT_TYPES, RequestStreamReader, UnsupportedArchive, extract_archive
+
 app = FastAPI()
 
 # test pass, trae debug
@@ -24,9 +38,162 @@ app.add_middleware(
 UPLOAD_DIR = "uploads"
 Path(UPLOAD_DIR).mkdir(parents=True, exist_ok=True)
 
+# 同时写入的文件数，环境变量 UPLOAD_WRITE_WORKERS 控制（默认8）
+UPLOAD_WRITE_WORKERS = max(1, int(os.environ.get("UPLOAD_WRITE_WORKERS", "8")))
+# 单次 /upload 请求最多接收的文件数，环境变量 UPLOAD_MAX_FILES 控制
+UPLOAD_MAX_FILES = int(os.environ.get("UPLOAD_MAX_FILES", "100000"))
+write_executor = ThreadPoolExecutor(max_workers=UPLOAD_WRITE_WORKERS, thread_name_prefix="upload-write")
+# 同时解压的归档数，环境变量 UPLOAD_ARCHIVE_WORKERS 控制（默认2）。解压一个归档会占用线程直到整个请求体
+# 接收完，使用独立的线程池，多个归档上传不会占满写入线程池、拖慢其他上传接口；超出的归档上传排队等待
+UPLOAD_ARCHIVE_WORKERS = max(1, int(os.environ.get("UPLOAD_ARCHIVE_WORKERS", "2")))
+archive_executor = ThreadPoolExecutor(max_workers=UPLOAD_ARCHIVE_WORKERS, thread_name_prefix="upload-archive")
+
+# 按内容寻址的去重存储，上传目录中的文件都是指向其中 blob 的硬链接，删除上传目录中的旧文件时保留
+BLOB_DIR_NAME = ".blobs"
+# 不再被引用的 blob 保留 BLOB_GRACE_SECONDS 秒（默认1小时）后才清理
+blob_store = BlobStore(os.path.join(UPLOAD_DIR, BLOB_DIR_NAME), float(os.environ.get("BLOB_GRACE_SECONDS", "3600")))
+
+def remove_old_upload_dir(path: str):
+    shutil.rmtree(path, ignore_errors=True)
+    # 旧文件删除后，清理不再被引用的 blob
+    removed = blob_store.gc()
+    if removed:
+        print(f"清理了 {removed} 个不再引用的 blob")
+
+def remove_in_background(path: str):
+    """在后台线程中删除目录，不阻塞请求"""
+    threading.Thread(target=remove_old_upload_dir, args=(path,), daemon=True).start()
+
+# 清理上次运行未删完的旧上传目录
+for old_dir in Path(".").glob(f"{UPLOAD_DIR}.old-*"):
+    remove_in_background(str(old_dir))
+
+def prune_upload_dir(keep: Set[str]):
+    """
+    上传成功后删除上传目录中不属于本次上传的文件（keep 为本次写入的文件和目录的完整路径），保留去重存储
+
+    新文件都是原子地替换到最终位置的，不需要先清空目录：内容没变的文件在整个上传期间一直链接着 blob，
+    blob 不会因为链接数变为1而被 gc 清理，下次上传仍能复用。
+    多余的文件先逐个移到旧目录，再在后台删除，无需等待删除完成；上传失败时不调用，旧文件保留
+    """
+    old_dir = f"{UPLOAD_DIR}.old-{uuid.uuid4().hex}"
+    os.makedirs(old_dir)
+    stale = 0
+    for dir_path, dir_names, file_names in os.walk(UPLOAD_DIR, topdown=False):
+        if dir_path == UPLOAD_DIR:
+            file_names = [name for name in file_names if name != BLOB_DIR_NAME]
+        elif os.path.relpath(dir_path, UPLOAD_DIR).split(os.sep)[0] == BLOB_DIR_NAME:
+            continue
+        for name in file_names:
+            path = os.path.join(dir_path, name)
+            if path in keep:
+                continue
+            stale += 1
+            try:
+                os.rename(path, os.path.join(old_dir, str(stale)))
+            except OSError:
+                pass
+        if dir_path != UPLOAD_DIR and dir_path not in keep:
+            try:
+                os.rmdir(dir_path)  # 只删除空目录
+            except OSError:
+                pass
+    remove_in_background(old_dir)
+
+def parent_dirs(paths: Set[str]) -> Set[str]:
+    """paths 加上它们在上传目录中的各级父目录，prune_upload_dir 不会删除这些目录"""
+    result = set(paths)
+    for path in paths:
+        parent = os.path.dirname(path)
+        while parent not in result and parent != UPLOAD_DIR and parent.startswith(UPLOAD_DIR + os.sep):
+            result.add(parent)
+            parent = os.path.dirname(parent)
+    return result
+
+def make_dirs(dirs):
+    """按路径顺序创建目录，父目录先于子目录创建，每个目录只创建一次"""
+    for dir_path in sorted(dirs):
+        os.makedirs(dir_path, exist_ok=True)
+
+def save_upload_file(file: UploadFile, full_path: str) -> bool:
+    """把已接收的上传文件保存到目标位置（在写入线程池中执行），内容已存在时只创建硬链接，返回是否去重"""
+    deduplicated = blob_store.save_fileobj(file.file, full_path)
+    print(f"成功保存文件: {full_path}{' (内容已存在)' if deduplicated else ''}")
+    return deduplicated
+
 @app.post("/upload")
-async def upload_folder(files: List[UploadFile] = File(...), paths: str = Form(None)):
+async def upload_folder(request: Request):
+    # 请求体为 tar 归档（可压缩）时边接收边解压，不按 multipart 表单处理
+    content_type, _ = parse_options_header(request.headers.get("content-type", ""))
+    if content_type in ARCHIVE_CONTENT_TYPES:
+        return await upload_archive(request)
+    
+    # File(...) 参数解析表单时最多只接受 1000 个文件，这里手动解析，上限由 UPLOAD_MAX_FILES 控制
+    async with request.form(max_files=UPLOAD_MAX_FILES, max_fields=UPLOAD_MAX_FILES) as form:
+        files = [item for item in form.getlist("files") if not isinstance(item, str)]
+        paths = form.get("paths")
+        blobs = parse_blobs_field(form.get("blobs"))
+        if not files and not blobs:
+            raise HTTPException(status_code=422, detail="没有上传文件")
+        return await save_uploaded_files(files, paths if isinstance(paths, str) else None, blobs)
+
+def parse_blobs_field(value) -> List[Dict[str, str]]:
+    """
+    blobs 字段：只提交路径和哈希、不提交内容的文件，JSON 数组 [{"path": 相对路径, "sha256": 内容哈希}]。
+    客户端先用 /blobs/check 预检，服务端已有的内容放在这里，只上传 missing 中的文件
+    """
+    if not isinstance(value, str) or not value:
+        return []
+    try:
+        entries = json.loads(value)
+        blobs = [{"path": str(entry["path"]), "sha256": str(entry["sha256"]).lower()} for entry in entries]
+    except (ValueError, TypeError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"blobs 字段格式错误: {e}")
+    for entry in blobs:
+        if not BlobStore.valid_hash(entry["sha256"]):
+            raise HTTPException(status_code=400, detail=f"无效的 sha256: {entry['sha256']}")
+    return blobs
+
+async def upload_archive(request: Request):
+    """解压 tar/tar.gz/tar.bz2/tar.xz/tar.zst 请求体到上传目录，整个归档不在内存或磁盘上缓存"""
+    print(f"接收到归档上传请求: {request.headers.get('content-type')}")
+    loop = asyncio.get_running_loop()
+    
+    # 解压线程按需从请求体拉取数据
+    reader = RequestStreamReader(request.stream(), loop)
+    saved_paths: Set[str] = set()
+    try:
+        result = await loop.run_in_executor(archive_executor, extract_archive, reader, UPLOAD_DIR, blob_store,
+                                            UPLOAD_MAX_FILES, saved_paths)
+    except UnsupportedArchive as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except UploadRejected as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # 删除上次上传中、这次归档里没有的文件（可选，根据需求调整）
+    await loop.run_in_executor(write_executor, prune_upload_dir, saved_paths)
+    
+    for error in result["errors"]:
+        print(f"保存文件 {error['path']} 时出错: {error['error']}")
+    
+    response_data = {
+        "message": "文件夹上传处理完成",
+        **result,
+        "upload_dir": os.path.abspath(UPLOAD_DIR)
+    }
+    print(f"返回响应: {response_data}")
+    
+    return response_data
+
+def link_blob(digest: str, full_path: str):
+    """把已有的 blob 链接到目标位置（在写入线程池中执行）"""
+    blob_store.link(digest, full_path)
+    print(f"成功链接文件: {full_path} (内容已存在)")
+    return True
+
+async def save_uploaded_files(files: List[UploadFile], paths: Optional[str], blobs: List[Dict[str, str]] = ()):
     saved_count = 0
+    deduplicated_count = 0
     
     # 打印接收到的请求信息，用于调试
     print(f"接收到上传请求")
@@ -56,44 +223,67 @@ async def upload_folder(files: List[UploadFile] = File(...), paths: str = Form(N
     # 打印解析后的路径信息
     print(f"解析后的路径列表: {path_list}")
     
-    # 清空上传目录（可选，根据需求调整）
-    shutil.rmtree(UPLOAD_DIR, ignore_errors=True)
-    Path(UPLOAD_DIR).mkdir(exist_ok=True)
+    loop = asyncio.get_running_loop()
+    
+    # 只提交哈希的文件要求服务端已有对应内容，有缺失时整个请求失败，客户端改为上传这些文件的内容
+    missing = await loop.run_in_executor(write_executor, blob_store.missing, [entry["sha256"] for entry in blobs])
+    if missing:
+        raise HTTPException(status_code=409, detail={"message": "服务端没有这些内容，需要上传文件", "missing": missing})
     
     # 确保文件和路径数量一致
     if len(path_list) > 0 and len(files) != len(path_list):
         print(f"警告: 文件数量 ({len(files)}) 与路径数量 ({len(path_list)}) 不匹配")
     
-    # 处理文件上传
+    # 确定每个文件的保存路径
+    targets = []
     for i, file in enumerate(files):
+        # 获取相对路径
+        relative_path = path_list[i] if i < len(path_list) else file.filename
+        print(f"处理文件 {i}: {file.filename}, 使用路径: {relative_path}")
         try:
-            # 获取相对路径
-            relative_path = path_list[i] if i < len(path_list) else file.filename
-            print(f"处理文件 {i}: {file.filename}, 使用路径: {relative_path}")
-            
             # 构建完整保存路径
-            full_path = Path(UPLOAD_DIR) / relative_path
-            
-            # 确保目录存在
-            full_path.parent.mkdir(parents=True, exist_ok=True)
-            
-            # 保存文件
-            with open(full_path, "wb") as buffer:
-                # 使用分块写入以支持大文件
-                while content := await file.read(1024 * 1024):  # 1MB chunks
-                    buffer.write(content)
-            
-            saved_count += 1
-            print(f"成功保存文件: {full_path}")
-        except Exception as e:
-            # 记录错误但继续处理其他文件
+            full_path = os.path.join(UPLOAD_DIR, *safe_relative_path(str(relative_path)).split("/"))
+            targets.append((file, full_path))
+        except ValueError as e:
             print(f"保存文件 {file.filename} 时出错: {str(e)}")
+    linked = []
+    for entry in blobs:
+        try:
+            linked.append((entry, os.path.join(UPLOAD_DIR, *safe_relative_path(entry["path"]).split("/"))))
+        except ValueError as e:
+            print(f"链接文件 {entry['path']} 时出错: {str(e)}")
+    
+    # 确保目录存在：相同的父目录只创建一次
+    await loop.run_in_executor(write_executor, make_dirs,
+                               {os.path.dirname(full_path) for _, full_path in targets + linked})
+    
+    # 保存文件：阻塞的文件读写放到写入线程池，最多同时写 UPLOAD_WRITE_WORKERS 个文件
+    results = await asyncio.gather(
+        *(loop.run_in_executor(write_executor, save_upload_file, file, full_path) for file, full_path in targets),
+        *(loop.run_in_executor(write_executor, link_blob, entry["sha256"], full_path) for entry, full_path in linked),
+        return_exceptions=True
+    )
+    saved_paths = set()
+    names = [file.filename for file, _ in targets] + [entry["path"] for entry, _ in linked]
+    for name, (_, full_path), result in zip(names, targets + linked, results):
+        if isinstance(result, Exception):
+            # 记录错误但继续处理其他文件
+            print(f"保存文件 {name} 时出错: {str(result)}")
+        else:
+            saved_count += 1
+            deduplicated_count += result
+            saved_paths.add(full_path)
+    
+    # 删除上次上传中、这次没有的文件（可选，根据需求调整）
+    await loop.run_in_executor(write_executor, prune_upload_dir, parent_dirs(saved_paths))
     
     # 构建响应数据
     response_data = {
         "message": "文件夹上传处理完成",
         "saved_files": saved_count,
-        "total_files": len(files),
+        "deduplicated_files": deduplicated_count,
+        "linked_files": len(linked),
+        "total_files": len(files) + len(blobs),
         "upload_dir": os.path.abspath(UPLOAD_DIR)
     }
     
@@ -102,6 +292,129 @@ async def upload_folder(files: List[UploadFile] = File(...), paths: str = Form(N
     
     return response_data
 
+@app.post("/upload_stream")
+async def upload_folder_stream(request: Request):
+    """
+    流式上传：与 /upload 接收相同的表单（files + paths），但不经过 UploadFile 临时文件，
+    边接收边把每个文件写到 UPLOAD_DIR 下的最终位置，磁盘只写一次，内存占用与上传大小无关。
+    paths 字段需要放在文件之前，否则按各文件 part 的 filename（相对路径）保存。
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=400, detail="需要 multipart/form-data 请求")
+    
+    print(f"接收到流式上传请求")
+    
+    # 解析和写文件都是阻塞操作，按数据块放到线程池执行，不阻塞事件循环
+    upload = StreamingUploadParser(UPLOAD_DIR, params[b"boundary"], blob_store)
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await run_in_threadpool(upload.write, chunk)
+        await run_in_threadpool(upload.finalize)
+    except UploadRejected as e:
+        await run_in_threadpool(upload.abort)
+        raise HTTPException(status_code=400, detail=str(e))
+    except ClientDisconnect:
+        await run_in_threadpool(upload.abort)
+        print(f"客户端断开连接，已保存 {len(upload.saved_files)} 个文件")
+        raise
+    
+    for error in upload.errors:
+        print(f"保存文件 {error['path']} 时出错: {error['error']}")
+    
+    # 删除上次上传中、这次没有的文件（可选，根据需求调整）
+    saved_paths = {os.path.join(UPLOAD_DIR, *path.split("/")) for path in upload.saved_files}
+    await asyncio.get_running_loop().run_in_executor(write_executor, prune_upload_dir, parent_dirs(saved_paths))
+    
+    response_data = {
+        "message": "文件夹上传处理完成",
+        "saved_files": len(upload.saved_files),
+        "deduplicated_files": upload.deduplicated_files,
+        "total_files": upload.total_files,
+        "bytes_written": upload.bytes_written,
+        "errors": upload.errors,
+        "upload_dir": os.path.abspath(UPLOAD_DIR)
+    }
+    print(f"返回响应: {response_data}")
+    
+    return response_data
+
+# 分块上传会话，会话数据与 UPLOAD_DIR 分开保存
+chunked_store = ChunkedUploadStore(
+    os.environ.get("UPLOAD_SESSION_DIR", "upload_sessions"),
+    UPLOAD_DIR,
+    float(os.environ.get("UPLOAD_SESSION_TTL", str(24 * 3600))),
+    blob_store,
+)
+
+class UploadFileInfo(BaseModel):
+    path: str = Field(..., description="文件相对路径，如 folder/sub/a.txt")
+    size: int = Field(..., ge=0, description="文件大小（字节）")
+    sha256: Optional[str] = Field(None, description="文件内容的 SHA-256，服务端已有该内容时无需上传")
+
+class BlobCheck(BaseModel):
+    hashes: List[str] = Field(..., description="文件内容的 SHA-256 列表")
+
+class UploadSessionCreate(BaseModel):
+    files: List[UploadFileInfo]
+    chunk_size: Optional[int] = Field(None, description="分块大小（字节），默认 8MB")
+
+async def run_chunked(func, *args):
+    """在写入线程池中执行会话操作，并把会话错误转换为对应的 HTTP 状态码"""
+    try:
+        return await asyncio.get_running_loop().run_in_executor(write_executor, func, *args)
+    except UploadSessionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+@app.post("/upload_sessions")
+async def create_upload_session(body: UploadSessionCreate):
+    """创建分块上传会话，返回会话 id、分块大小和每个文件的分块数"""
+    return await run_chunked(chunked_store.create, [f.model_dump() for f in body.files], body.chunk_size)
+
+@app.get("/upload_sessions/{session_id}")
+async def get_upload_session(session_id: str):
+    """查询会话状态：每个文件已收到的分块序号（received），用于断点续传"""
+    session = await run_chunked(chunked_store.get, session_id)
+    return session.status()
+
+@app.put("/upload_sessions/{session_id}/files/{file_index}/chunks/{chunk_index}")
+async def upload_chunk(session_id: str, file_index: int, chunk_index: int, request: Request,
+                       checksum: str = Header(..., alias="X-Chunk-SHA256", description="分块内容的 SHA-256（十六进制）")):
+    """上传一个分块（请求体为分块的原始字节），分块可以乱序、并行上传，重复上传是幂等的"""
+    data = bytearray()
+    async for chunk in request.stream():
+        data += chunk
+        if len(data) > MAX_CHUNK_SIZE:
+            raise HTTPException(status_code=413, detail=f"分块不能超过 {MAX_CHUNK_SIZE} 字节")
+    return await run_chunked(chunked_store.write_chunk, session_id, file_index, chunk_index, bytes(data), checksum)
+
+@app.post("/upload_sessions/{session_id}/complete")
+async def complete_upload_session(session_id: str):
+    """所有分块到齐后，把文件原子地移动到上传目录"""
+    result = await run_chunked(chunked_store.complete, session_id)
+    print(f"分块上传完成: {result}")
+    return {"message": "文件夹上传处理完成", **result}
+
+@app.post("/blobs/check")
+async def check_blobs(body: BlobCheck):
+    """上传前预检：返回服务端已有的哈希（present）和需要上传的哈希（missing），客户端可跳过已有内容的文件"""
+    missing = await asyncio.get_running_loop().run_in_executor(write_executor, blob_store.missing, body.hashes)
+    missing_set = set(missing)
+    present = [digest for digest in dict.fromkeys(h.lower() for h in body.hashes) if digest not in missing_set]
+    return {"present": present, "missing": missing}
+
+@app.delete("/upload_sessions/{session_id}")
+async def delete_upload_session(session_id: str):
+    """放弃会话，删除已上传的分块"""
+    await run_chunked(chunked_store.discard, session_id)
+    return {"session_id": session_id, "deleted": True}
+
+@app.on_event("shutdown")
+def shutdown_write_executor():
+    archive_executor.shutdown(wait=True)
+    write_executor.shutdown(wait=True)
+
 # 提供静态文件访问（用于访问前端页面）
 app.mount("/", StaticFiles(directory=".", html=True), name="static")
 
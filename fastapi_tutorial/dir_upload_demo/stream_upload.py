@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+流式 multipart 上传解析
+
+File(...) 参数会先由 Starlette 把每个 part 写入 SpooledTemporaryFile（超过 1MB 落盘），
+处理函数再从临时文件读出写到目标位置，每个字节要写两次磁盘。
+这里直接用 python-multipart 的 MultipartParser 解析 request.stream() 的数据块，
+文件 part 的数据在回调中直接写入 UPLOAD_DIR 下的最终位置：
+- 磁盘只写一次，内存中只保留当前数据块，与上传总大小无关
+- 文件的相对路径优先取文件 part 之前出现的 paths 字段（JSON 列表，与 /upload 相同），
+  否则取 part 的 filename（前端以 webkitRelativePath 作为 filename 发送）
+- 相对路径必须位于上传目录内，绝对路径和包含 .. 的路径会被拒绝
+"""
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional
+
+import multipart
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import parse_options_header
+
+# 普通字段（如 paths）的最大字节数，超过视为请求无效
+MAX_FIELD_SIZE = 16 * 1024 * 1024
+
+# 上传目录顶层的保留名称（去重存储目录），上传文件不能写入其中
+RESERVED_NAMES = {".blobs"}
+
+
+class UploadRejected(ValueError):
+    """请求格式不正确，应返回 400"""
+
+
+def safe_relative_path(relative_path: str) -> str:
+    """规范化上传文件的相对路径（以 / 分隔），不允许跳出上传目录"""
+    normalized = os.path.normpath(relative_path.replace("\\", "/").lstrip("/"))
+    parts = normalized.replace("\\", "/").split("/")
+    if not relative_path or normalized == "." or os.path.isabs(normalized) or ".." in parts:
+        raise ValueError(f"非法的文件路径: {relative_path!r}")
+    if parts[0] in RESERVED_NAMES:
+        raise ValueError(f"保留的文件路径: {relative_path!r}")
+    return "/".join(parts)
+
+
+def parse_paths_field(value: str) -> List[str]:
+    """解析 paths 字段：JSON 列表或单个路径，与 /upload 的处理一致"""
+    if value.startswith('[') and value.endswith(']'):
+        return json.loads(value)
+    return [value]
+
+
+class StreamingUploadParser:
+    """
+    把 multipart 请求体按数据块喂给 write()，文件 part 边解析边写入 upload_dir
+
+    传入 blob_store 时文件先写入去重存储的临时文件并同时计算哈希，写完后收入存储再链接到目标位置，
+    内容已存在时丢弃临时文件。
+    write/finalize/abort 都是阻塞调用，应在线程池中执行。
+    单个文件出错（路径非法、无法写入）时跳过该文件并记录到 errors，继续处理后续文件。
+    """
+
+    def __init__(self, upload_dir: str, boundary: bytes, blob_store=None):
+        self.upload_dir = upload_dir
+        self.blob_store = blob_store
+        self.path_list: List[str] = []
+        self.saved_files: List[str] = []
+        self.errors: List[Dict[str, str]] = []
+        self.total_files = 0
+        self.bytes_written = 0
+        self.deduplicated_files = 0
+        # 已创建的目录，同一父目录只创建一次
+        self._made_dirs = set()
+
+        self._header_field = bytearray()
+        self._header_value = bytearray()
+        self._headers: Dict[bytes, bytes] = {}
+        self._field_name: Optional[str] = None
+        self._field_value: Optional[bytearray] = None
+        self._file = None
+        self._file_path: Optional[str] = None
+        self._file_rel: Optional[str] = None
+        self._temp_path: Optional[str] = None
+        self._sha256 = None
+        self._in_file = False
+
+        self._parser = multipart.MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+
+    def write(self, chunk: bytes):
+        try:
+            self._parser.write(chunk)
+        except MultipartParseError as e:
+            raise UploadRejected(f"multipart 格式错误: {e}")
+
+    def finalize(self):
+        try:
+            self._parser.finalize()
+        except MultipartParseError as e:
+            raise UploadRejected(f"multipart 格式错误: {e}")
+        if self._in_file or self._field_value is not None:
+            raise UploadRejected("请求体不完整")
+
+    def abort(self):
+        """请求中断时关闭并删除写了一半的文件"""
+        self._discard_file()
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[bytes(self._header_field).lower()] = bytes(self._header_value)
+        self._header_field.clear()
+        self._header_value.clear()
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        filename = options.get(b"filename")
+        if filename is None:
+            self._field_name = name
+            self._field_value = bytearray()
+            return
+
+        index = self.total_files
+        self.total_files += 1
+        self._in_file = True
+        filename = filename.decode("utf-8", "replace")
+        relative_path = str(self.path_list[index]) if index < len(self.path_list) else filename
+        try:
+            self._file_rel = safe_relative_path(relative_path)
+            self._file_path = os.path.join(self.upload_dir, *self._file_rel.split("/"))
+            parent = os.path.dirname(self._file_path)
+            if parent not in self._made_dirs:
+                os.makedirs(parent, exist_ok=True)
+                self._made_dirs.add(parent)
+            if self.blob_store is not None:
+                self._file, self._temp_path = self.blob_store.new_temp()
+                self._sha256 = hashlib.sha256()
+            else:
+                self._file = open(self._file_path, "wb")
+        except (OSError, ValueError) as e:
+            self._file = None
+            self.errors.append({"path": relative_path, "error": str(e)})
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._in_file:
+            if self._file is None:
+                return
+            try:
+                # memoryview 切片不复制数据
+                view = memoryview(data)[start:end]
+                self._file.write(view)
+                if self._sha256 is not None:
+                    self._sha256.update(view)
+                self.bytes_written += end - start
+            except OSError as e:
+                self.errors.append({"path": self._file_rel, "error": str(e)})
+                self._discard_file()
+        elif self._field_value is not None:
+            if len(self._field_value) + end - start > MAX_FIELD_SIZE:
+                raise UploadRejected(f"字段 {self._field_name} 超过 {MAX_FIELD_SIZE} 字节")
+            self._field_value += data[start:end]
+
+    def _on_part_end(self):
+        if self._in_file:
+            self._in_file = False
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                if self._temp_path is not None:
+                    try:
+                        if self.blob_store.adopt(self._temp_path, self._file_path, self._sha256.hexdigest()):
+                            self.deduplicated_files += 1
+                    except OSError as e:
+                        self.errors.append({"path": self._file_rel, "error": str(e)})
+                        self.blob_store.discard_temp(self._temp_path)
+                        return
+                    finally:
+                        self._temp_path, self._sha256 = None, None
+                self.saved_files.append(self._file_rel)
+            return
+
+        name, value = self._field_name, bytes(self._field_value or b"").decode("utf-8", "replace")
+        self._field_name, self._field_value = None, None
+        if name == "paths" and value:
+            try:
+                self.path_list = parse_paths_field(value)
+            except ValueError as e:
+                print(f"解析路径信息失败: {str(e)}")
+            if self.total_files:
+                print(f"警告: paths 字段出现在 {self.total_files} 个文件之后，这些文件已按 filename 保存")
+
+    def _discard_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            try:
+                os.remove(self._temp_path or self._file_path)
+            except OSError:
+                pass
+            self._temp_path, self._sha256 = None, None
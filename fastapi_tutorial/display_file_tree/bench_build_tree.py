@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+build_tree 基准测试：对比原递归实现（os.listdir + isdir/isfile/getsize）与 tree_walker 的 scandir 实现
+
+在临时目录下生成一棵合成目录树，分别统计：
+- 文件系统调用次数（stat/lstat/listdir/scandir/DirEntry.stat，按 Python 层调用计数）
+- 多轮运行的最短耗时
+
+用法:
+    python bench_build_tree.py
+    python bench_build_tree.py --width 8 --depth 4 --files 20 --rounds 5 --fan-out 16
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, Dict
+
+import tree_walker
+
+
+def legacy_build_tree(base_path: str, current_path: str, max_depth: int = 3, include_files: bool = True, current_depth: int = 0) -> Dict[str, Any]:
+    """原 file_tree_api.build_tree 的递归实现，仅作为对比基线"""
+    format_size = tree_walker.format_size
+    try:
+        name = os.path.basename(current_path) or os.path.basename(os.path.abspath(current_path))
+    except:
+        name = os.path.basename(str(current_path))
+
+    try:
+        relative_path = os.path.relpath(current_path, base_path)
+    except (ValueError, OSError):
+        relative_path = str(current_path)
+
+    if current_depth > max_depth:
+        return {
+            "name": name,
+            "type": "directory",
+            "path": relative_path.replace("\\", "/"),
+            "max_depth_reached": True,
+            "children": []
+        }
+
+    if os.path.isdir(current_path):
+        try:
+            children = []
+            items = sorted(os.listdir(current_path))
+
+            dirs = []
+            files = []
+            for item in items:
+                item_path = os.path.join(current_path, item)
+                if os.path.isdir(item_path):
+                    dirs.append(item)
+                elif os.path.isfile(item_path) and include_files:
+                    files.append(item)
+
+            for item in dirs:
+                item_path = os.path.join(current_path, item)
+                children.append(legacy_build_tree(base_path, item_path, max_depth, include_files, current_depth + 1))
+
+            if include_files:
+                for item in files:
+                    item_path = os.path.join(current_path, item)
+                    try:
+                        size_bytes = os.path.getsize(item_path)
+                        children.append({
+                            "name": item,
+                            "type": "file",
+                            "path": os.path.relpath(item_path, base_path).replace("\\", "/"),
+                            "size": format_size(size_bytes),
+                            "size_bytes": size_bytes
+                        })
+                    except (PermissionError, OSError) as e:
+                        children.append({
+                            "name": item,
+                            "type": "file",
+                            "path": os.path.relpath(item_path, base_path).replace("\\", "/"),
+                            "error": "无法访问: " + str(e)
+                        })
+
+            return {
+                "name": name,
+                "type": "directory",
+                "path": relative_path.replace("\\", "/"),
+                "children": children
+            }
+        except PermissionError:
+            return {
+                "name": name,
+                "type": "directory",
+                "path": relative_path.replace("\\", "/"),
+                "error": "权限不足",
+                "children": []
+            }
+    elif os.path.isfile(current_path):
+        try:
+            size_bytes = os.path.getsize(current_path)
+            return {
+                "name": name,
+                "type": "file",
+                "path": relative_path.replace("\\", "/"),
+                "size": format_size(size_bytes),
+                "size_bytes": size_bytes
+            }
+        except (PermissionError, OSError) as e:
+            return {
+                "name": name,
+                "type": "file",
+                "path": relative_path.replace("\\", "/"),
+                "error": "无法访问: " + str(e)
+            }
+    else:
+        return {
+            "name": name,
+            "type": "unknown",
+            "path": relative_path.replace("\\", "/"),
+            "error": "未知文件类型"
+        }
+
+
+def make_tree(root: str, width: int, depth: int, files: int) -> int:
+    """生成合成目录树：每层 width 个子目录、每个目录 files 个文件，返回创建的条目数"""
+    count = 0
+    stack = [(root, 0)]
+    while stack:
+        path, level = stack.pop()
+        for i in range(files):
+            with open(os.path.join(path, f"file_{i:04d}.txt"), "wb") as f:
+                f.write(b"x" * (i * 37 % 4096))
+            count += 1
+        if level < depth:
+            for i in range(width):
+                sub = os.path.join(path, f"dir_{i:03d}")
+                os.mkdir(sub)
+                count += 1
+                stack.append((sub, level + 1))
+    return count
+
+
+class SyscallCounter:
+    """替换 os 模块中的文件系统函数以统计调用次数，DirEntry.stat() 通过包装 scandir 返回的目录项统计"""
+
+    NAMES = ("stat", "lstat", "listdir", "scandir")
+
+    def __init__(self):
+        self.counts = {name: 0 for name in self.NAMES}
+        self.counts["DirEntry.stat"] = 0
+        self._originals = {}
+
+    def __enter__(self):
+        for name in self.NAMES:
+            original = getattr(os, name)
+            self._originals[name] = original
+            setattr(os, name, self._wrap(name, original))
+        return self
+
+    def __exit__(self, *exc):
+        for name, original in self._originals.items():
+            setattr(os, name, original)
+
+    def _wrap(self, name, original):
+        counter = self
+
+        if name == "scandir":
+            def scandir(*args, **kwargs):
+                counter.counts[name] += 1
+                return _CountingScandir(original(*args, **kwargs), counter)
+            return scandir
+
+        def wrapper(*args, **kwargs):
+            counter.counts[name] += 1
+            return original(*args, **kwargs)
+        return wrapper
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+
+class _CountingScandir:
+    def __init__(self, iterator, counter: SyscallCounter):
+        self._it = iterator
+        self._counter = counter
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._it.close()
+
+    def __iter__(self):
+        for entry in self._it:
+            yield _CountingEntry(entry, self._counter)
+
+
+class _CountingEntry:
+    def __init__(self, entry: os.DirEntry, counter: SyscallCounter):
+        self._entry = entry
+        self._counter = counter
+        self.name = entry.name
+        self.path = entry.path
+
+    def is_dir(self, **kwargs):
+        return self._entry.is_dir(**kwargs)
+
+    def is_file(self, **kwargs):
+        return self._entry.is_file(**kwargs)
+
+    def is_symlink(self):
+        return self._entry.is_symlink()
+
+    def stat(self, **kwargs):
+        self._counter.counts["DirEntry.stat"] += 1
+        return self._entry.stat(**kwargs)
+
+
+def best_time(func, rounds: int, *args) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build_tree 基准测试")
+    parser.add_argument("--width", type=int, default=6, help="每个目录下的子目录数")
+    parser.add_argument("--depth", type=int, default=4, help="目录层数")
+    parser.add_argument("--files", type=int, default=15, help="每个目录下的文件数")
+    parser.add_argument("--max-depth", type=int, default=10, help="build_tree 的 max_depth 参数")
+    parser.add_argument("--rounds", type=int, default=3, help="计时轮数，取最短耗时")
+    parser.add_argument("--fan-out", type=int, default=8, help="build_tree_parallel 的线程数")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="bench_build_tree_")
+    try:
+        entries = make_tree(root, args.width, args.depth, args.files)
+        print(f"合成目录树: {root}, 共 {entries} 个条目")
+
+        legacy = legacy_build_tree(root, root, args.max_depth, True)
+        current = tree_walker.build_tree(root, root, args.max_depth, True)
+        same = json.dumps(legacy, ensure_ascii=False) == json.dumps(current, ensure_ascii=False)
+        print(f"输出一致: {same}")
+
+        results = {}
+        for label, func in (("legacy", legacy_build_tree), ("scandir", tree_walker.build_tree)):
+            with SyscallCounter() as counter:
+                func(root, root, args.max_depth, True)
+            elapsed = best_time(func, args.rounds, root, root, args.max_depth, True)
+            results[label] = (counter, elapsed)
+            detail = ", ".join(f"{k}={v}" for k, v in counter.counts.items() if v)
+            print(f"{label:>8}: 文件系统调用 {counter.total:>8} ({detail}), 耗时 {elapsed * 1000:.1f} ms")
+
+        legacy_counter, legacy_time = results["legacy"]
+        scandir_counter, scandir_time = results["scandir"]
+        print(f"系统调用减少: {legacy_counter.total / max(scandir_counter.total, 1):.1f}x, "
+              f"耗时加速: {legacy_time / max(scandir_time, 1e-9):.1f}x")
+
+        # 并行扫描在本地磁盘上受 GIL 限制，收益主要体现在网络文件系统等高延迟存储上
+        parallel = tree_walker.build_tree_parallel(root, root, args.max_depth, True, args.fan_out)
+        same = json.dumps(parallel, ensure_ascii=False) == json.dumps(current, ensure_ascii=False)
+        elapsed = best_time(tree_walker.build_tree_parallel, args.rounds, root, root, args.max_depth, True, args.fan_out)
+        print(f"parallel(fan_out={args.fan_out}): 输出一致: {same}, 耗时 {elapsed * 1000:.1f} ms")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+目录分页读取（懒加载）
+
+一次只返回一个目录层级的一页子项，前端展开节点时再按需请求。
+- 游标分页：after=<上一页最后一个子项的名称>，顺序与文件树一致（目录在前、文件在后，各自按名称排序）
+- 目录的排序结果按 (目录路径, include_files) 缓存，并用目录 mtime 校验；翻页时只需一次 stat 加二分定位，
+  每页的开销只与 limit 有关，与目录大小无关。mtime 距离现在不到 MTIME_RACY_WINDOW_NS 的目录不缓存，
+  同一时间粒度内的后续变化可能不改变 mtime
+- 每个子目录附带 has_children（读到第一个子项就停止），前端据此显示是否可展开；
+  需要子项数时传 child_count_limit，最多只读 child_count_limit + 1 个目录项，超过时 child_count_more 为 True。
+  每页的开销因此不超过 limit × (child_count_limit + 1) 个目录项，不随子目录的大小增长
+"""
+import os
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+
+from tree_walker import MTIME_RACY_WINDOW_NS, join_relative, scan_dir, stat_file_node
+
+# 缓存的目录排序结果个数
+LISTING_CACHE_SIZE = 64
+
+
+class DirListing:
+    __slots__ = ("mtime_ns", "dirs", "files", "index")
+
+    def __init__(self, mtime_ns: int, dirs: List[str], files: List[str]):
+        self.mtime_ns = mtime_ns
+        self.dirs = dirs
+        self.files = files
+        # 名称 -> 在合并序列（目录在前）中的位置
+        self.index = {name: i for i, name in enumerate(dirs)}
+        self.index.update({name: len(dirs) + i for i, name in enumerate(files)})
+
+    def __len__(self):
+        return len(self.dirs) + len(self.files)
+
+    def position_after(self, after: Optional[str]) -> int:
+        """游标之后第一个子项在合并序列中的位置"""
+        if not after:
+            return 0
+        if after in self.index:
+            return self.index[after] + 1
+        # 游标对应的子项已被删除：按名称落在目录段还是文件段近似定位
+        pos = bisect_right(self.dirs, after)
+        if pos < len(self.dirs):
+            return pos
+        return len(self.dirs) + bisect_right(self.files, after)
+
+    def item(self, pos: int) -> Tuple[str, bool]:
+        """返回 (名称, 是否目录)"""
+        if pos < len(self.dirs):
+            return self.dirs[pos], True
+        return self.files[pos - len(self.dirs)], False
+
+
+_listings: "OrderedDict[Tuple[str, bool], DirListing]" = OrderedDict()
+_listings_lock = threading.Lock()
+
+
+def get_listing(dir_path: str, include_files: bool) -> DirListing:
+    """获取目录的排序结果，目录 mtime 未变时复用缓存（mtime 太新时每次重新读取）"""
+    mtime_ns = os.stat(dir_path).st_mtime_ns
+    key = (dir_path, include_files)
+    with _listings_lock:
+        listing = _listings.get(key)
+        if listing is not None and listing.mtime_ns == mtime_ns:
+            _listings.move_to_end(key)
+            return listing
+
+    dirs, files = scan_dir(dir_path, include_files)
+    listing = DirListing(mtime_ns, [e.name for e in dirs], [e.name for e in files])
+    if time.time_ns() - mtime_ns < MTIME_RACY_WINDOW_NS:
+        return listing
+    with _listings_lock:
+        _listings[key] = listing
+        _listings.move_to_end(key)
+        while len(_listings) > LISTING_CACHE_SIZE:
+            _listings.popitem(last=False)
+    return listing
+
+
+def count_children(dir_path: str, include_files: bool, limit: int = 0) -> int:
+    """
+    统计目录下会被列出的子项数，只读目录项不做 stat
+
+    数到 limit + 1 个就停止，返回值大于 limit 表示子项多于 limit 个；limit 为 0 时只判断是否有子项
+    """
+    count = 0
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir() or (include_files and entry.is_file()):
+                    count += 1
+                    if count > limit:
+                        break
+            except OSError:
+                continue
+    return count
+
+
+def resolve_dir(base_path: str, relative_dir: str) -> Tuple[str, str]:
+    """把请求中的相对目录解析为 (绝对路径, 规范化的相对路径)，不允许跳出 base_path"""
+    relative_dir = relative_dir.replace("\\", "/").strip("/")
+    if not relative_dir or relative_dir == ".":
+        return base_path, "."
+    normalized = os.path.normpath(relative_dir)
+    if os.path.isabs(normalized) or normalized == ".." or normalized.startswith(".." + os.sep):
+        raise ValueError(f"目录不在基础路径下: {relative_dir}")
+    return os.path.join(base_path, normalized), normalized.replace("\\", "/")
+
+
+def list_dir_page(base_path: str, relative_dir: str = "", after: Optional[str] = None, limit: int = 200,
+                  include_files: bool = True, child_count_limit: int = 0) -> Dict[str, Any]:
+    """
+    读取目录的一页子项
+
+    参数:
+        base_path: 基础路径
+        relative_dir: 要展开的目录，相对 base_path，留空表示 base_path 本身
+        after: 游标，上一页最后一个子项的名称
+        limit: 每页最多返回的子项数
+        include_files: 是否包含文件
+        child_count_limit: 子目录的 child_count 最多数到多少，0 表示只返回 has_children
+
+    返回:
+        {"path", "total", "children", "next_after"}，next_after 为 None 表示没有下一页
+    """
+    dir_path, dir_rel = resolve_dir(base_path, relative_dir)
+    listing = get_listing(dir_path, include_files)
+
+    start = listing.position_after(after)
+    end = min(start + limit, len(listing))
+    children = []
+    for pos in range(start, end):
+        name, is_dir = listing.item(pos)
+        child_path = os.path.join(dir_path, name)
+        child_rel = join_relative(dir_rel, name)
+        if is_dir:
+            node = {"name": name, "type": "directory", "path": child_rel}
+            try:
+                count = count_children(child_path, include_files, child_count_limit)
+            except PermissionError:
+                node["error"] = "权限不足"
+                count = 0
+            except OSError as e:
+                node["error"] = "无法访问: " + str(e)
+                count = 0
+            node["has_children"] = count > 0
+            if child_count_limit:
+                node["child_count"] = min(count, child_count_limit)
+                if count > child_count_limit:
+                    node["child_count_more"] = True
+            children.append(node)
+        else:
+            children.append(stat_file_node(name, child_rel, partial(os.stat, child_path)))
+
+    return {
+        "path": dir_rel,
+        "total": len(listing),
+        "children": children,
+        "next_after": children[-1]["name"] if end < len(listing) else None,
+    }
+
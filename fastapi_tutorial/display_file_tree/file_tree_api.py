@@ -2,144 +2,24 @@
 import os
 import sys
 import json
+import time
 from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Union
+from itertools import islice
+from typing import List, Dict, Any, AsyncIterator, Iterator, Optional, Union
 from datetime import datetime
 
-# 获取文件大小的格式化函数
-def format_size(size_bytes: int) -> str:
-    """将字节大小转换为人类可读的格式"""
-    if size_bytes < 1024:
-        return f"{size_bytes} B"
-    elif size_bytes < 1024 * 1024:
-        return f"{size_bytes / 1024:.2f} KB"
-    elif size_bytes < 1024 * 1024 * 1024:
-        return f"{size_bytes / (1024 * 1024):.2f} MB"
-    else:
-        return f"{size_bytes / (1024 * 1024 * 1024):.2f} GB"
+from tree_walker import format_size, build_tree, build_tree_parallel, iter_tree, shutdown_subtree_executor
+from scan_pool import ScanQueueFull, scan_pool
+from tree_cache import tree_cache
+from dir_pager import list_dir_page
+from size_index import SIZES_APPROXIMATE, SizeIndex, get_size_index, iter_nodes
 
-# 递归构建文件树结构函数
-def build_tree(base_path: str, current_path: str, max_depth: int = 3, include_files: bool = True, current_depth: int = 0) -> Dict[str, Any]:
-    """
-    递归构建文件树结构
-    
-    参数:
-        base_path: 基础路径，用于计算相对路径
-        current_path: 当前处理的路径
-        max_depth: 最大递归深度
-        include_files: 是否包含文件
-        current_depth: 当前递归深度
-    
-    返回:
-        包含文件树结构的字典
-    """
-    # 获取路径的最后一部分作为名称
-    try:
-        name = os.path.basename(current_path) or os.path.basename(os.path.abspath(current_path))
-    except:
-        name = os.path.basename(str(current_path))
-    
-    # 计算相对路径
-    try:
-        relative_path = os.path.relpath(current_path, base_path)
-    except (ValueError, OSError):
-        # 处理不同驱动器的情况
-        relative_path = str(current_path)
-    
-    # 如果已达到最大深度
-    if current_depth > max_depth:
-        return {
-            "name": name, 
-            "type": "directory", 
-            "path": relative_path.replace("\\", "/"),
-            "max_depth_reached": True,
-            "children": []
-        }
-    
-    # 如果是目录
-    if os.path.isdir(current_path):
-        try:
-            children = []
-            items = sorted(os.listdir(current_path))
-            
-            # 分离目录和文件，并按名称排序
-            dirs = []
-            files = []
-            for item in items:
-                item_path = os.path.join(current_path, item)
-                if os.path.isdir(item_path):
-                    dirs.append(item)
-                elif os.path.isfile(item_path) and include_files:
-                    files.append(item)
-            
-            # 先处理目录
-            for item in dirs:
-                item_path = os.path.join(current_path, item)
-                children.append(build_tree(base_path, item_path, max_depth, include_files, current_depth + 1))
-            
-            # 再处理文件
-            if include_files:
-                for item in files:
-                    item_path = os.path.join(current_path, item)
-                    try:
-                        size_bytes = os.path.getsize(item_path)
-                        children.append({
-                            "name": item,
-                            "type": "file",
-                            "path": os.path.relpath(item_path, base_path).replace("\\", "/"),
-                            "size": format_size(size_bytes),
-                            "size_bytes": size_bytes
-                        })
-                    except (PermissionError, OSError) as e:
-                        children.append({
-                            "name": item,
-                            "type": "file",
-                            "path": os.path.relpath(item_path, base_path).replace("\\", "/"),
-                            "error": "无法访问: " + str(e)
-                        })
-            
-            return {
-                "name": name,
-                "type": "directory",
-                "path": relative_path.replace("\\", "/"),
-                "children": children
-            }
-        except PermissionError:
-            return {
-                "name": name,
-                "type": "directory",
-                "path": relative_path.replace("\\", "/"),
-                "error": "权限不足",
-                "children": []
-            }
-    # 如果是文件
-    elif os.path.isfile(current_path):
-        try:
-            size_bytes = os.path.getsize(current_path)
-            return {
-                "name": name,
-                "type": "file",
-                "path": relative_path.replace("\\", "/"),
-                "size": format_size(size_bytes),
-                "size_bytes": size_bytes
-            }
-        except (PermissionError, OSError) as e:
-            return {
-                "name": name,
-                "type": "file",
-                "path": relative_path.replace("\\", "/"),
-                "error": "无法访问: " + str(e)
-            }
-    else:
-        return {
-            "name": name,
-            "type": "unknown",
-            "path": relative_path.replace("\\", "/"),
-            "error": "未知文件类型"
-        }
+# 流式返回时每次从扫描线程池取出的行数
+NDJSON_BATCH_SIZE = 500
 
 # 创建FastAPI应用
 app = FastAPI(title="文件目录树API", description="提供文件目录树结构的API服务")
@@ -158,7 +38,12 @@ app.add_middleware(
 async def get_file_tree(
     path: str = Query("", description="要获取树结构的目录路径，留空表示当前目录"),
     max_depth: int = Query(3, description="最大递归深度，默认为3", ge=1, le=10),
-    include_files: bool = Query(True, description="是否包含文件，默认为True")
+    include_files: bool = Query(True, description="是否包含文件，默认为True"),
+    response_format: str = Query("json", alias="format", pattern="^(json|ndjson)$",
+                                 description="返回格式: json 一次性返回整棵树; ndjson 流式返回，每行一个节点"),
+    fan_out: int = Query(1, description="并行扫描的线程数，1 表示单线程扫描（仅 json 格式生效）", ge=1, le=32),
+    use_cache: bool = Query(True, description="是否使用缓存的扫描结果（仅 json 格式生效）"),
+    aggregate_sizes: bool = Query(False, description="是否为目录附加子树总大小 total_size_bytes 和文件数 file_count")
 ):
     """获取指定路径的文件目录树结构"""
     # 检查是否有默认路径环境变量
@@ -172,29 +57,180 @@ async def get_file_tree(
             # 确保路径存在
             base_path = os.path.abspath(path)
         
-        if not os.path.exists(base_path):
+        meta = {
+            "base_path": base_path,
+            "max_depth": max_depth,
+            "include_files": include_files,
+            "fan_out": fan_out,
+            "aggregate_sizes": aggregate_sizes,
+            "timestamp": datetime.now().isoformat()
+        }
+        
+        # 目录汇总大小随索引刷新变化，不走结果缓存
+        use_cache = use_cache and response_format == "json" and tree_cache.enabled and not aggregate_sizes
+        
+        # 命中缓存：已被监听的缓存项直接返回；监听不可用时先在扫描线程中做 mtime 校验
+        if use_cache:
+            entry = tree_cache.get((base_path, max_depth, include_files))
+            if entry is not None and (tree_cache.is_watched(entry) or await scan_pool.run(tree_cache.validate, entry)):
+                tree_cache.record_hit()
+                meta["cached"] = True
+                meta["snapshot_timestamp"] = entry.snapshot_time
+                return Response(content=tree_response_body(meta, entry.body), media_type="application/json")
+        
+        # 文件系统调用全部放到扫描线程池执行，不阻塞事件循环
+        if not await scan_pool.run(os.path.exists, base_path):
             raise HTTPException(status_code=404, detail=f"路径不存在: {base_path}")
         
-        # 获取文件树结构
-        tree = build_tree(base_path, base_path, max_depth, include_files)
+        # 增量刷新目录大小索引（同一目录在刷新间隔内直接读索引）
+        size_index = None
+        if aggregate_sizes:
+            size_index = get_size_index()
+            refresh = await scan_pool.run(size_index.refresh, base_path)
+            meta["size_index_refreshed_at"] = datetime.fromtimestamp(refresh["refreshed_at"]).isoformat()
+            # 已有文件原地改写的大小变化要等所在目录下次有增删时才会反映
+            meta["size_approximate"] = SIZES_APPROXIMATE
         
-        # 添加元数据
-        result = {
-            "status": "success",
-            "meta": {
-                "base_path": base_path,
-                "max_depth": max_depth,
-                "include_files": include_files,
-                "timestamp": datetime.now().isoformat()
-            },
-            "tree": tree
-        }
+        # 流式返回：边遍历边输出，服务端不保存整棵树
+        if response_format == "ndjson":
+            return StreamingResponse(
+                ndjson_tree_lines(base_path, max_depth, include_files, meta, size_index),
+                media_type="application/x-ndjson"
+            )
         
-        return result
+        # 获取文件树结构并序列化，大树的 JSON 编码同样耗时，一并放到扫描线程池
+        meta["cached"] = False
+        body = await scan_pool.run(render_tree_json, base_path, max_depth, include_files, fan_out, meta, use_cache,
+                                  size_index)
+        return Response(content=body, media_type="application/json")
     except HTTPException:
         raise
+    except ScanQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"处理请求时出错: {str(e)}")
+
+@app.get("/get_dir_children")
+async def get_dir_children(
+    path: str = Query("", description="基础目录路径，留空表示当前目录"),
+    relative_dir: str = Query("", alias="dir", description="要展开的目录，相对基础路径，留空表示基础目录本身"),
+    limit: int = Query(200, description="每页最多返回的子项数", ge=1, le=5000),
+    after: Optional[str] = Query(None, description="游标：上一页返回的 next_after，留空表示第一页"),
+    include_files: bool = Query(True, description="是否包含文件，默认为True"),
+    child_count_limit: int = Query(0, description="子目录的 child_count 最多数到多少，0 表示只返回 has_children",
+                                   ge=0, le=10000)
+):
+    """懒加载接口：分页返回单个目录层级的子项，子目录附带 has_children（可选有上限的 child_count）以便前端按需展开"""
+    default_path = os.environ.get("DEFAULT_PATH", "")
+    base_path = os.path.abspath(path) if path else (default_path or os.getcwd())
+    
+    try:
+        page = await scan_pool.run(list_dir_page, base_path, relative_dir, after, limit, include_files,
+                                   child_count_limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"路径不存在: {os.path.join(base_path, relative_dir)}")
+    except NotADirectoryError:
+        raise HTTPException(status_code=400, detail=f"不是目录: {os.path.join(base_path, relative_dir)}")
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="权限不足")
+    except ScanQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"处理请求时出错: {str(e)}")
+    
+    return {
+        "status": "success",
+        "meta": {
+            "base_path": base_path,
+            "dir": page["path"],
+            "limit": limit,
+            "after": after,
+            "child_count_limit": child_count_limit,
+            "timestamp": datetime.now().isoformat()
+        },
+        **page
+    }
+
+@app.get("/scan_stats")
+async def scan_stats():
+    """扫描线程池状态：并发上限、运行中和排队中的任务数等"""
+    return scan_pool.stats()
+
+@app.get("/cache_stats")
+async def cache_stats():
+    """文件树缓存状态：缓存项数、占用字节数、命中/失效/淘汰次数和正在监听的目录"""
+    return tree_cache.stats()
+
+@app.on_event("shutdown")
+def shutdown_scan_pool():
+    scan_pool.shutdown()
+    shutdown_subtree_executor()
+    tree_cache.shutdown()
+
+def dump_json(content: Any) -> bytes:
+    """与 JSONResponse 相同的编码参数"""
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+def tree_response_body(meta: Dict[str, Any], tree_body: bytes) -> bytes:
+    """把元数据和已编码的树拼接为完整响应，结构为 {"status", "meta", "tree"}"""
+    return b'{"status":"success","meta":' + dump_json(meta) + b',"tree":' + tree_body + b'}'
+
+def render_tree_json(base_path: str, max_depth: int, include_files: bool, fan_out: int,
+                     meta: Dict[str, Any], use_cache: bool = False, size_index: Optional[SizeIndex] = None) -> bytes:
+    """
+    构建文件树并编码为 JSON（在扫描线程中执行）
+
+    use_cache 为 True 时把编码后的树写入缓存；传入 size_index 时为目录节点附加汇总大小
+    """
+    # 缓存的 mtime 在遍历读取每个目录之前记录，扫描期间的变化会在下次校验时发现
+    dir_mtimes = None
+    if use_cache:
+        generation = tree_cache.begin(base_path)
+        scan_started = time.monotonic()
+        dir_mtimes = {}
+    
+    if fan_out > 1:
+        tree = build_tree_parallel(base_path, base_path, max_depth, include_files, fan_out, dir_mtimes=dir_mtimes)
+    else:
+        tree = build_tree(base_path, base_path, max_depth, include_files, dir_mtimes=dir_mtimes)
+    if size_index is not None:
+        size_index.annotate(base_path, iter_nodes(tree))
+    tree_body = dump_json(tree)
+    
+    if use_cache:
+        tree_cache.put((base_path, max_depth, include_files), tree_body, dir_mtimes,
+                       generation, scan_started, meta["timestamp"])
+    
+    return tree_response_body(meta, tree_body)
+
+def take_lines(nodes: Iterator[Dict[str, Any]], count: int, base_path: str = "",
+               size_index: Optional[SizeIndex] = None) -> List[str]:
+    """从节点迭代器中取出最多 count 个节点并序列化为 NDJSON 行（在扫描线程中执行）"""
+    batch = list(islice(nodes, count))
+    if size_index is not None:
+        size_index.annotate(base_path, batch)
+    return [json.dumps(node, ensure_ascii=False) + "\n" for node in batch]
+
+async def ndjson_tree_lines(base_path: str, max_depth: int, include_files: bool, meta: Dict[str, Any],
+                            size_index: Optional[SizeIndex] = None) -> AsyncIterator[str]:
+    """
+    生成 NDJSON 格式的文件树：第一行为元数据，之后每行一个节点（带 id/parent_id）
+
+    遍历按批次在扫描线程池中推进，事件循环只负责发送数据。
+    响应头发出后无法再修改状态码，遍历中途出错时输出一行 {"status": "error"} 后结束。
+    """
+    yield json.dumps({"status": "success", "meta": meta}, ensure_ascii=False) + "\n"
+    nodes = iter_tree(base_path, base_path, max_depth, include_files)
+    try:
+        while True:
+            lines = await scan_pool.run(take_lines, nodes, NDJSON_BATCH_SIZE, base_path, size_index)
+            if not lines:
+                break
+            yield "".join(lines)
+    except Exception as e:
+        yield json.dumps({"status": "error", "detail": f"处理请求时出错: {str(e)}"}, ensure_ascii=False) + "\n"
 
 # 提供静态文件访问（用于访问前端页面）
 app.mount("/", StaticFiles(directory=".", html=True), name="static")
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+事件循环阻塞负载测试
+
+启动一个 uvicorn 单进程服务，生成合成目录树，然后：
+1. 空载时连续请求轻量接口（/scan_stats 和静态页面），记录延迟
+2. 同时发起若干个深度扫描 /get_file_tree 请求，再次记录轻量接口的延迟
+输出两种情况下的 p50/p99 延迟。扫描在线程池中执行时，扫描负载不应明显拉高轻量接口的延迟。
+
+用法:
+    python load_test_scan.py
+    python load_test_scan.py --scanners 8 --probes 500 --workers 2
+"""
+import argparse
+import http.client
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import List
+from urllib.parse import urlencode
+
+from bench_build_tree import make_tree
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(port: int, timeout: float = 15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/scan_stats")
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("服务启动超时")
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def probe(port: int, count: int) -> List[float]:
+    """串行请求轻量接口，返回每次请求的延迟（毫秒）"""
+    latencies = []
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    for i in range(count):
+        target = "/scan_stats" if i % 2 == 0 else "/file_tree.html"
+        start = time.perf_counter()
+        conn.request("GET", target)
+        conn.getresponse().read()
+        latencies.append((time.perf_counter() - start) * 1000)
+    conn.close()
+    return latencies
+
+
+def scanner(port: int, tree_root: str, stop: threading.Event, counter: List[int]):
+    """循环发起深度扫描请求直到 stop 被设置"""
+    query = urlencode({"path": tree_root, "max_depth": 10, "include_files": "true"})
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    while not stop.is_set():
+        conn.request("GET", f"/get_file_tree?{query}")
+        conn.getresponse().read()
+        counter[0] += 1
+    conn.close()
+
+
+def report(label: str, latencies: List[float]):
+    print(f"{label:>10}: p50={percentile(latencies, 50):7.2f} ms  "
+          f"p99={percentile(latencies, 99):7.2f} ms  max={max(latencies):7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="扫描负载下的轻量接口延迟测试")
+    parser.add_argument("--scanners", type=int, default=4, help="并发扫描客户端数")
+    parser.add_argument("--probes", type=int, default=300, help="轻量接口请求次数")
+    parser.add_argument("--workers", type=int, default=4, help="SCAN_WORKERS 扫描线程数")
+    parser.add_argument("--width", type=int, default=6)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--files", type=int, default=15)
+    args = parser.parse_args()
+
+    tree_root = tempfile.mkdtemp(prefix="load_test_scan_")
+    port = free_port()
+    env = dict(os.environ, SCAN_WORKERS=str(args.workers))
+    here = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "file_tree_api:app", "--host", "127.0.0.1",
+         "--port", str(port), "--log-level", "warning"],
+        cwd=here, env=env,
+    )
+    try:
+        entries = make_tree(tree_root, args.width, args.depth, args.files)
+        print(f"合成目录树: {entries} 个条目, 扫描线程数: {args.workers}, 并发扫描: {args.scanners}")
+        wait_ready(port)
+
+        report("idle", probe(port, args.probes))
+
+        stop = threading.Event()
+        counter = [0]
+        threads = [threading.Thread(target=scanner, args=(port, tree_root, stop, counter), daemon=True)
+                   for _ in range(args.scanners)]
+        for t in threads:
+            t.start()
+        time.sleep(0.5)
+        report("scanning", probe(port, args.probes))
+        stop.set()
+        for t in threads:
+            t.join()
+        print(f"测试期间完成扫描请求: {counter[0]}")
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(tree_root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+目录扫描线程池
+
+文件系统遍历是阻塞调用，直接在 async 路由中执行会卡住整个事件循环，
+同一 worker 上的其他请求（包括静态文件）都要排队。这里把扫描放到独立的有界线程池中执行：
+- 并发上限 SCAN_WORKERS（环境变量，默认4），超过的任务排队
+- 排队上限 SCAN_MAX_QUEUE（环境变量，默认64），队列满时直接拒绝，避免请求无限堆积
+- 记录运行中/排队中/已完成/被拒绝的任务数，供监控接口查询
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+
+class ScanQueueFull(Exception):
+    """扫描队列已满"""
+
+
+class ScanPool:
+    def __init__(self, max_workers: int = 4, max_queue: int = 64):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="file-tree-scan")
+        self._lock = threading.Lock()
+        self.running = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _submit_check(self):
+        with self._lock:
+            if self.max_queue and self.queued >= self.max_queue:
+                self.rejected += 1
+                raise ScanQueueFull(f"扫描任务过多，当前排队 {self.queued} 个")
+            self.queued += 1
+
+    def _wrap(self, func: Callable, *args) -> Any:
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+
+    def _on_done(self, future):
+        # 还在排队时就被取消（如客户端断开），_wrap 不会执行，需要在这里归还排队计数
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    async def run(self, func: Callable, *args) -> Any:
+        """在扫描线程池中执行 func(*args)，不阻塞事件循环"""
+        self._submit_check()
+        future = self._executor.submit(self._wrap, func, *args)
+        future.add_done_callback(self._on_done)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self.running,
+                "queued": self.queued,
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+scan_pool = ScanPool(
+    max_workers=int(os.environ.get("SCAN_WORKERS", "4")),
+    max_queue=int(os.environ.get("SCAN_MAX_QUEUE", "64")),
+)
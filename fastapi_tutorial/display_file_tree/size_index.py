@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+目录大小索引
+
+build_tree 只给出单个文件的 size_bytes，目录的总大小需要遍历整棵子树才能得到。
+这里把每个目录的统计结果持久化到 SQLite，按目录 mtime 增量更新：
+- 目录 mtime 未变（没有增删改名）时，直接复用索引中该目录自身文件的大小和子目录列表，不再读取目录
+- mtime 变化的目录才重新读取并 stat 其中的文件，被删除的子目录连同其子树从索引中移除；
+  读取时 mtime 距离现在不到 MTIME_RACY_WINDOW_NS 的目录记为 -2，下次刷新时重新读取
+  （同一时间粒度内的后续增删可能不改变 mtime）
+- 汇总值（total_size/file_count）自底向上重新累加，只写回有变化的行
+- 同一根目录在 SIZE_INDEX_REFRESH_SECONDS 秒内（默认60）只刷新一次，期间的查询直接读索引
+
+统计口径类似 du --apparent-size：不跟随符号链接，文件大小取 st_size。
+注意：目录 mtime 只在目录项增删改名时变化，已有文件原地改写导致的大小变化要等该目录下次有增删时才会反映。
+逐个 stat 未变目录中的文件等于每次都完整遍历，索引不做这种校验，汇总值因此是近似值（SIZES_APPROXIMATE），
+接口在 meta 中标明 size_approximate。
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from tree_walker import MTIME_RACY_WINDOW_NS, format_size
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL,
+    own_size INTEGER NOT NULL,
+    own_files INTEGER NOT NULL,
+    total_size INTEGER NOT NULL DEFAULT 0,
+    file_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS roots (
+    path TEXT PRIMARY KEY,
+    refreshed_at REAL NOT NULL
+);
+"""
+
+# 汇总值不反映未变目录中文件的原地改写，只是近似值
+SIZES_APPROXIMATE = True
+
+# 批量按路径查询时每条 SQL 的参数个数上限
+QUERY_CHUNK = 500
+
+
+def like_prefix(path: str) -> str:
+    """构造匹配 path 下所有子路径的 LIKE 模式"""
+    escaped = path.rstrip(os.sep).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped + os.sep.replace("\\", "\\\\") + "%"
+
+
+def read_own(dir_path: str) -> Tuple[int, int, List[str]]:
+    """读取目录自身：返回 (直属文件总大小, 直属文件数, 子目录路径列表)，不跟随符号链接"""
+    own_size = 0
+    own_files = 0
+    subdirs = []
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    own_size += entry.stat(follow_symlinks=False).st_size
+                    own_files += 1
+            except OSError:
+                continue
+    return own_size, own_files, subdirs
+
+
+class PendingWrites:
+    """遍历期间收集的索引修改，遍历结束后在一个短事务中统一写入"""
+
+    def __init__(self):
+        self.deleted_subtrees: List[str] = []
+        self.upserts: List[Tuple[str, Optional[str], int, int, int]] = []
+        self.totals: List[Tuple[int, int, str]] = []
+
+    def apply(self, conn: sqlite3.Connection):
+        # 先删除已不存在的子树，再写入目录自身的数据，最后更新汇总值（新插入的行也需要）
+        for path in self.deleted_subtrees:
+            SizeIndex._delete_subtree(conn, path)
+        conn.executemany(
+            "INSERT INTO dirs (path, parent, mtime_ns, own_size, own_files) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET mtime_ns = excluded.mtime_ns, "
+            "own_size = excluded.own_size, own_files = excluded.own_files",
+            self.upserts,
+        )
+        conn.executemany("UPDATE dirs SET total_size = ?, file_count = ? WHERE path = ?", self.totals)
+
+
+class SizeIndex:
+    def __init__(self, db_path: str, refresh_seconds: float = 60):
+        self.db_path = db_path
+        self.refresh_seconds = refresh_seconds
+        self._local = threading.local()
+        # 写事务互斥（只在写入阶段持有）；同一根目录的刷新由各自的锁串行化，不同根目录的遍历可以并发
+        self._write_lock = threading.Lock()
+        self._root_locks: Dict[str, List[Any]] = {}
+        self._root_locks_guard = threading.Lock()
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _root_lock(self, root: str):
+        """根目录的锁，没有刷新在等待时移除，锁的个数不随查询过的根目录增长"""
+        with self._root_locks_guard:
+            entry = self._root_locks.get(root)
+            if entry is None:
+                entry = self._root_locks[root] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._root_locks_guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._root_locks[root]
+
+    def _fresh(self, conn: sqlite3.Connection, root: str, force: bool) -> Optional[float]:
+        """root 在刷新间隔内刷新过时返回刷新时间"""
+        row = conn.execute("SELECT refreshed_at FROM roots WHERE path = ?", (root,)).fetchone()
+        if row and not force and time.time() - row[0] < self.refresh_seconds:
+            return row[0]
+        return None
+
+    def refresh(self, root: str, force: bool = False) -> Dict[str, Any]:
+        """
+        增量刷新 root 下的索引（阻塞调用，应在扫描线程中执行）
+
+        遍历只读取索引（WAL 下不阻塞其他查询），修改先收集在内存中，最后在一个短写事务中写入，
+        刷新一个根目录不会让其他根目录的刷新和查询等待整个遍历。同一根目录的并发刷新只执行一次。
+        返回本次刷新的统计信息：是否实际刷新、访问的目录数、重新读取的目录数、刷新时间
+        """
+        root = root.rstrip(os.sep) or os.sep
+        conn = self._conn()
+        refreshed_at = self._fresh(conn, root, force)
+        if refreshed_at is not None:
+            return {"refreshed": False, "refreshed_at": refreshed_at}
+
+        with self._root_lock(root):
+            # 等待期间可能已被其他请求刷新
+            refreshed_at = self._fresh(conn, root, force)
+            if refreshed_at is not None:
+                return {"refreshed": False, "refreshed_at": refreshed_at}
+
+            stats = {"refreshed": True, "dirs_visited": 0, "dirs_rescanned": 0}
+            writes = PendingWrites()
+            new = self._walk(conn, root, stats, writes)
+            with self._write_lock, conn:
+                # 在写事务内读取旧的汇总值：嵌套的根目录同时刷新时，祖先只累加尚未写入的变化量
+                old = conn.execute("SELECT total_size, file_count FROM dirs WHERE path = ?", (root,)).fetchone()
+                writes.apply(conn)
+                self._propagate(conn, root, old or (0, 0), new or (0, 0))
+                stats["refreshed_at"] = time.time()
+                conn.execute("INSERT OR REPLACE INTO roots (path, refreshed_at) VALUES (?, ?)",
+                             (root, stats["refreshed_at"]))
+            return stats
+
+    def _walk(self, conn: sqlite3.Connection, root: str, stats: Dict[str, Any],
+              writes: PendingWrites) -> Optional[Tuple[int, int]]:
+        """后序遍历：先确定每个目录自身的数据和子目录，再自底向上累加汇总值，返回 root 的汇总值"""
+        totals: Dict[str, Tuple[int, int]] = {}
+        # 栈元素: (路径, 是否已展开, 展开后的数据)
+        stack: List[Tuple[str, bool, Any]] = [(root, False, None)]
+
+        while stack:
+            path, expanded, data = stack.pop()
+            if expanded:
+                own_size, own_files, subdirs, old_total = data
+                total_size, file_count = own_size, own_files
+                for sub in subdirs:
+                    sub_size, sub_files = totals.pop(sub, (0, 0))
+                    total_size += sub_size
+                    file_count += sub_files
+                totals[path] = (total_size, file_count)
+                if old_total != (total_size, file_count):
+                    writes.totals.append((total_size, file_count, path))
+                continue
+
+            stats["dirs_visited"] += 1
+            row = conn.execute("SELECT mtime_ns, own_size, own_files, total_size, file_count FROM dirs WHERE path = ?",
+                               (path,)).fetchone()
+            try:
+                mtime_ns = os.stat(path, follow_symlinks=False).st_mtime_ns
+            except OSError:
+                # 目录已不存在或无法访问：从索引中移除整棵子树
+                writes.deleted_subtrees.append(path)
+                continue
+
+            if row is not None and row[0] == mtime_ns:
+                own_size, own_files = row[1], row[2]
+                subdirs = [r[0] for r in conn.execute("SELECT path FROM dirs WHERE parent = ?", (path,))]
+            else:
+                stats["dirs_rescanned"] += 1
+                try:
+                    own_size, own_files, subdirs = read_own(path)
+                except OSError:
+                    # 无法读取（如权限不足）：记为 -1，下次刷新时重试
+                    own_size, own_files, subdirs, mtime_ns = 0, 0, [], -1
+                if mtime_ns >= 0 and time.time_ns() - mtime_ns < MTIME_RACY_WINDOW_NS:
+                    mtime_ns = -2
+                old_subdirs = {r[0] for r in conn.execute("SELECT path FROM dirs WHERE parent = ?", (path,))}
+                writes.deleted_subtrees.extend(old_subdirs.difference(subdirs))
+                parent = os.path.dirname(path) if path != os.path.dirname(path) else None
+                writes.upserts.append((path, parent, mtime_ns, own_size, own_files))
+
+            old_total = (row[3], row[4]) if row is not None else None
+            stack.append((path, True, (own_size, own_files, subdirs, old_total)))
+            stack.extend((sub, False, None) for sub in subdirs)
+
+        return totals.get(root)
+
+    @staticmethod
+    def _propagate(conn: sqlite3.Connection, root: str, old: Tuple[int, int], new: Tuple[int, int]):
+        """单独刷新子目录时，把汇总值的变化量同步给索引中已有的祖先目录"""
+        delta_size, delta_files = new[0] - old[0], new[1] - old[1]
+        if not delta_size and not delta_files:
+            return
+        ancestors = []
+        path = root
+        while os.path.dirname(path) != path:
+            path = os.path.dirname(path)
+            ancestors.append(path)
+        for i in range(0, len(ancestors), QUERY_CHUNK):
+            chunk = ancestors[i:i + QUERY_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            conn.execute(f"UPDATE dirs SET total_size = total_size + ?, file_count = file_count + ? "
+                         f"WHERE path IN ({placeholders})", (delta_size, delta_files, *chunk))
+
+    @staticmethod
+    def _delete_subtree(conn: sqlite3.Connection, path: str):
+        conn.execute("DELETE FROM dirs WHERE path = ? OR path LIKE ? ESCAPE '\\'", (path, like_prefix(path)))
+
+    def lookup(self, paths: Iterable[str]) -> Dict[str, Tuple[int, int]]:
+        """批量查询目录的 (total_size, file_count)"""
+        conn = self._conn()
+        paths = list(paths)
+        result = {}
+        for i in range(0, len(paths), QUERY_CHUNK):
+            chunk = paths[i:i + QUERY_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            for path, total_size, file_count in conn.execute(
+                    f"SELECT path, total_size, file_count FROM dirs WHERE path IN ({placeholders})", chunk):
+                result[path] = (total_size, file_count)
+        return result
+
+    def annotate(self, base_path: str, nodes: Iterable[Dict[str, Any]]):
+        """给目录节点加上 total_size_bytes/total_size/file_count，索引中没有的目录（如符号链接目录）不加"""
+        by_path = {}
+        for node in nodes:
+            if node.get("type") == "directory":
+                rel = node["path"]
+                by_path[base_path.rstrip(os.sep) if rel == "." else os.path.join(base_path, rel)] = node
+        for path, (total_size, file_count) in self.lookup(by_path).items():
+            node = by_path[path]
+            node["total_size_bytes"] = total_size
+            node["total_size"] = format_size(total_size)
+            node["file_count"] = file_count
+
+
+def iter_nodes(tree: Dict[str, Any]):
+    """遍历嵌套树中的所有节点"""
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(node.get("children", ()))
+
+
+_size_index: Optional[SizeIndex] = None
+_size_index_lock = threading.Lock()
+
+
+def get_size_index() -> SizeIndex:
+    """首次使用时才创建索引数据库"""
+    global _size_index
+    with _size_index_lock:
+        if _size_index is None:
+            _size_index = SizeIndex(
+                os.environ.get("SIZE_INDEX_DB", "size_index.sqlite3"),
+                float(os.environ.get("SIZE_INDEX_REFRESH_SECONDS", "60")),
+            )
+        return _size_index
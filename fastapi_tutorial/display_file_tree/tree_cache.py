@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+文件树结果缓存
+
+看板会每隔几秒轮询同一个目录，每次都全量重新扫描并不划算。这里按 (path, max_depth, include_files)
+缓存已编码好的 JSON 树（bytes），命中时直接拼接响应，不再遍历也不再序列化。
+
+失效策略：
+- 优先使用 watchfiles（Linux 上为 inotify）监听缓存过的根目录，收到变更后只失效包含该路径、
+  且变更位置在其可见深度内的缓存项，其他目录的缓存不受影响
+- 监听不可用（未安装 watchfiles、inotify 数量超限等）或监听尚未就绪时，回退为 mtime 校验：
+  命中前逐个比较扫描时记录的目录 mtime（遍历在读取每个目录之前记录，见 tree_walker.record_mtime），
+  目录内有增删改名时失效。注意 mtime 校验发现不了已有文件内容（大小）的变化
+- 失效的粒度是整个缓存项：某个子目录变化时，整棵树下次请求时重新扫描，而不是只重新扫描变化的子树。
+  缓存的是编码好的 JSON，局部替换需要保存并重新编码节点树，对轮询场景收益不大
+
+内存上限：按缓存的 JSON 字节数做 LRU 淘汰，环境变量 TREE_CACHE_MAX_BYTES 控制（默认 256MB，0 表示关闭缓存）。
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+try:
+    from watchfiles import watch
+except ImportError:  # 未安装 watchfiles 时只使用 mtime 校验
+    watch = None
+
+CacheKey = Tuple[str, int, bool]
+
+
+class CacheEntry:
+    __slots__ = ("key", "body", "dir_mtimes", "scan_started", "snapshot_time")
+
+    def __init__(self, key: CacheKey, body: bytes, dir_mtimes: Dict[str, int], scan_started: float, snapshot_time: str):
+        self.key = key
+        self.body = body
+        self.dir_mtimes = dir_mtimes
+        self.scan_started = scan_started
+        self.snapshot_time = snapshot_time
+
+
+class DirWatcher:
+    """在后台线程中监听一个根目录，变更通过 on_changes(root, paths) 回调"""
+
+    def __init__(self, root: str, on_changes, debounce_ms: int = 200):
+        self.root = root
+        self.on_changes = on_changes
+        self.debounce_ms = debounce_ms
+        self.stop_event = threading.Event()
+        # 第一次从 watch() 返回时监听已经建立，此后开始的扫描才能完全依赖监听
+        self.ready_at: Optional[float] = None
+        self.alive = True
+        self.thread = threading.Thread(target=self._run, name=f"tree-cache-watch:{root}", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            for changes in watch(self.root, watch_filter=None, debounce=self.debounce_ms, rust_timeout=200,
+                                 yield_on_timeout=True, stop_event=self.stop_event, raise_interrupt=False,
+                                 ignore_permission_denied=True):
+                if self.ready_at is None:
+                    self.ready_at = time.monotonic()
+                if changes:
+                    self.on_changes(self.root, [path for _, path in changes])
+        except Exception:
+            pass
+        finally:
+            # 监听异常退出后，该根目录下的缓存项回退为 mtime 校验
+            self.alive = False
+
+    @property
+    def ready(self) -> bool:
+        return self.alive and self.ready_at is not None
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def path_depth(root: str, path: str) -> Optional[int]:
+    """path 相对 root 的层数（root 自身为 0），不在 root 下时返回 None"""
+    if path == root:
+        return 0
+    prefix = root.rstrip(os.sep) + os.sep
+    if not path.startswith(prefix):
+        return None
+    return path[len(prefix):].count(os.sep) + 1
+
+
+class TreeCache:
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, use_watch: bool = True, debounce_ms: int = 200):
+        self.max_bytes = max_bytes
+        self.use_watch = use_watch and watch is not None
+        self.debounce_ms = debounce_ms
+        self._entries: "OrderedDict[CacheKey, CacheEntry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._watchers: Dict[str, DirWatcher] = {}
+        self._generations: Dict[str, int] = defaultdict(int)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: CacheKey) -> Optional[CacheEntry]:
+        """查找缓存项（不访问文件系统），未命中返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def is_watched(self, entry: CacheEntry) -> bool:
+        """缓存项是否由监听保证有效（扫描开始前监听已就绪），是则无需 mtime 校验"""
+        watcher = self._watchers.get(entry.key[0])
+        return watcher is not None and watcher.ready and watcher.ready_at <= entry.scan_started
+
+    def validate(self, entry: CacheEntry) -> bool:
+        """mtime 校验（会访问文件系统，应在扫描线程中调用），失效时移除缓存项"""
+        for path, mtime in entry.dir_mtimes.items():
+            try:
+                current = os.stat(path).st_mtime_ns
+            except OSError:
+                current = -1
+            if current != mtime:
+                self._remove(entry.key, invalidated=True)
+                return False
+        return True
+
+    def record_hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def begin(self, root: str) -> int:
+        """开始扫描前调用：确保根目录已被监听，返回当前的变更代数，put 时用于丢弃扫描期间已过期的结果"""
+        if self.use_watch:
+            with self._lock:
+                watcher = self._watchers.get(root)
+                if watcher is None or not watcher.alive:
+                    self._watchers[root] = DirWatcher(root, self._on_changes, self.debounce_ms)
+        with self._lock:
+            return self._generations[root]
+
+    def put(self, key: CacheKey, body: bytes, dir_mtimes: Dict[str, int], generation: int,
+            scan_started: float, snapshot_time: str) -> bool:
+        size = len(body)
+        if not self.enabled or size > self.max_bytes:
+            return False
+        with self._lock:
+            if self._generations[key[0]] != generation:
+                return False
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.body)
+            self._entries[key] = CacheEntry(key, body, dir_mtimes, scan_started, snapshot_time)
+            self._bytes += size
+            evicted_roots = set()
+            while self._bytes > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.body)
+                self.evictions += 1
+                evicted_roots.add(evicted_key[0])
+            self._stop_unused_watchers(evicted_roots)
+        return True
+
+    def _remove(self, key: CacheKey, invalidated: bool = False):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= len(entry.body)
+                if invalidated:
+                    self.invalidations += 1
+
+    def _on_changes(self, root: str, paths: Iterable[str]):
+        """监听回调：只失效变更位置在其可见深度内的缓存项"""
+        with self._lock:
+            for key in list(self._entries):
+                cached_root, max_depth, _ = key
+                for path in paths:
+                    depth = path_depth(cached_root, path)
+                    # max_depth 层的目录会列出其直接子项，因此 max_depth + 1 层的变化也可见
+                    if depth is not None and depth <= max_depth + 1:
+                        entry = self._entries.pop(key)
+                        self._bytes -= len(entry.body)
+                        self.invalidations += 1
+                        break
+            for watched_root in self._generations:
+                if any(path_depth(watched_root, path) is not None for path in paths):
+                    self._generations[watched_root] += 1
+
+    def _stop_unused_watchers(self, roots: Iterable[str]):
+        """LRU 淘汰后，停止已经没有缓存项的根目录的监听（调用方持有锁）"""
+        remaining = {key[0] for key in self._entries}
+        for root in roots:
+            if root not in remaining and root in self._watchers:
+                self._watchers.pop(root).stop()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "watching": [root for root, w in self._watchers.items() if w.ready],
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            for watcher in self._watchers.values():
+                watcher.stop()
+            self._watchers.clear()
+
+
+tree_cache = TreeCache(max_bytes=int(os.environ.get("TREE_CACHE_MAX_BYTES", str(256 * 1024 * 1024))))
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+文件树遍历引擎
+
+基于 os.scandir 实现，替代原先 os.listdir + os.path.isdir/isfile/getsize 的递归实现：
+- DirEntry.is_dir()/is_file() 在 Linux/Windows 上直接使用目录项自带的类型信息，不额外触发 stat
+- 每个文件只调用一次 DirEntry.stat()（结果被 DirEntry 缓存）
+- 相对路径由父节点路径拼接得到，不再每个条目调用两次 os.path.relpath
+- 使用显式栈代替 Python 递归，深层目录不会触发递归深度限制
+
+返回的 JSON 结构与原 build_tree 完全一致。
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# build_tree_parallel 共用的子目录读取线程数上限（环境变量 SCAN_SUBTREE_WORKERS，默认16），
+# 多个并行扫描同时进行时，对磁盘的并发读取总数不超过这个值
+SUBTREE_WORKERS = int(os.environ.get("SCAN_SUBTREE_WORKERS", "16"))
+
+# 目录 mtime 距离现在不到这个时间（纳秒）时不信任它，见 record_mtime
+MTIME_RACY_WINDOW_NS = 2 * 10 ** 9
+
+_subtree_executor: Optional[ThreadPoolExecutor] = None
+_subtree_executor_lock = threading.Lock()
+
+
+def subtree_executor() -> ThreadPoolExecutor:
+    """build_tree_parallel 共用的有界线程池，第一次使用时创建"""
+    global _subtree_executor
+    with _subtree_executor_lock:
+        if _subtree_executor is None:
+            _subtree_executor = ThreadPoolExecutor(max_workers=SUBTREE_WORKERS,
+                                                   thread_name_prefix="file-tree-subtree")
+        return _subtree_executor
+
+
+def shutdown_subtree_executor():
+    global _subtree_executor
+    with _subtree_executor_lock:
+        if _subtree_executor is not None:
+            _subtree_executor.shutdown(wait=False, cancel_futures=True)
+            _subtree_executor = None
+
+
+# 获取文件大小的格式化函数
+def format_size(size_bytes: int) -> str:
+    """将字节大小转换为人类可读的格式"""
+    if size_bytes < 1024:
+        return f"{size_bytes} B"
+    elif size_bytes < 1024 * 1024:
+        return f"{size_bytes / 1024:.2f} KB"
+    elif size_bytes < 1024 * 1024 * 1024:
+        return f"{size_bytes / (1024 * 1024):.2f} MB"
+    else:
+        return f"{size_bytes / (1024 * 1024 * 1024):.2f} GB"
+
+
+def join_relative(parent_rel: str, name: str) -> str:
+    """拼接相对路径，根节点的相对路径为 '.'"""
+    return name if parent_rel == "." else f"{parent_rel}/{name}"
+
+
+def scan_dir(dir_path: str, include_files: bool = True) -> Tuple[List[os.DirEntry], List[os.DirEntry]]:
+    """
+    读取单个目录，返回按名称排序的 (子目录列表, 文件列表)
+
+    与原实现一致：符号链接按其指向的目标分类，既不是目录也不是文件的条目（如失效的链接）被忽略。
+    权限不足时抛出 PermissionError，由调用方处理。
+    """
+    dirs = []
+    files = []
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    dirs.append(entry)
+                elif include_files and entry.is_file():
+                    files.append(entry)
+            except OSError:
+                continue
+    dirs.sort(key=lambda e: e.name)
+    files.sort(key=lambda e: e.name)
+    return dirs, files
+
+
+def file_node(entry: os.DirEntry, relative_path: str) -> Dict[str, Any]:
+    """根据目录项构建文件节点，stat 结果由 DirEntry 缓存"""
+    return stat_file_node(entry.name, relative_path, entry.stat)
+
+
+def stat_file_node(name: str, relative_path: str, stat: Callable[[], os.stat_result]) -> Dict[str, Any]:
+    """构建文件节点，stat 为获取文件状态的函数"""
+    try:
+        size_bytes = stat().st_size
+        return {
+            "name": name,
+            "type": "file",
+            "path": relative_path,
+            "size": format_size(size_bytes),
+            "size_bytes": size_bytes
+        }
+    except (PermissionError, OSError) as e:
+        return {
+            "name": name,
+            "type": "file",
+            "path": relative_path,
+            "error": "无法访问: " + str(e)
+        }
+
+
+def node_name_and_path(base_path: str, current_path: str) -> Tuple[str, str]:
+    """计算起始节点的名称和相对路径"""
+    try:
+        name = os.path.basename(current_path) or os.path.basename(os.path.abspath(current_path))
+    except:
+        name = os.path.basename(str(current_path))
+
+    try:
+        relative_path = os.path.relpath(current_path, base_path)
+    except (ValueError, OSError):
+        # 处理不同驱动器的情况
+        relative_path = str(current_path)
+
+    return name, relative_path.replace("\\", "/")
+
+
+def build_tree(base_path: str, current_path: str, max_depth: int = 3, include_files: bool = True, current_depth: int = 0,
+               dir_mtimes: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """
+    构建文件树结构（迭代实现）
+
+    参数:
+        base_path: 基础路径，用于计算相对路径
+        current_path: 当前处理的路径
+        max_depth: 最大遍历深度
+        include_files: 是否包含文件
+        current_depth: current_path 所在的深度
+        dir_mtimes: 传入字典时记录每个展开目录在读取前的 mtime（见 record_mtime）
+
+    返回:
+        包含文件树结构的字典
+    """
+    name, relative_path = node_name_and_path(base_path, current_path)
+
+    if current_depth > max_depth:
+        return {
+            "name": name,
+            "type": "directory",
+            "path": relative_path,
+            "max_depth_reached": True,
+            "children": []
+        }
+
+    if not os.path.isdir(current_path):
+        if os.path.isfile(current_path):
+            try:
+                size_bytes = os.path.getsize(current_path)
+                return {
+                    "name": name,
+                    "type": "file",
+                    "path": relative_path,
+                    "size": format_size(size_bytes),
+                    "size_bytes": size_bytes
+                }
+            except (PermissionError, OSError) as e:
+                return {
+                    "name": name,
+                    "type": "file",
+                    "path": relative_path,
+                    "error": "无法访问: " + str(e)
+                }
+        return {
+            "name": name,
+            "type": "unknown",
+            "path": relative_path,
+            "error": "未知文件类型"
+        }
+
+    # 目录节点先只写入 name/type/path，展开时再补上 children（或 error），保持原有的键顺序
+    root = {"name": name, "type": "directory", "path": relative_path}
+    stack = [(root, current_path, current_depth)]
+
+    while stack:
+        node, dir_path, depth = stack.pop()
+        pending = expand_dir(node, dir_path, depth, max_depth, include_files, dir_mtimes)
+        # 逆序入栈，使遍历顺序与递归实现一致（先序、按名称）
+        stack.extend(reversed(pending))
+
+    return root
+
+
+def record_mtime(dir_mtimes: Dict[str, int], dir_path: str):
+    """
+    在读取目录之前记录它的 mtime（纳秒），缓存校验时与当前 mtime 比较
+
+    先 stat 再读取，读取期间的增删改名会让之后的 mtime 与记录的不同；读取后才 stat 会把扫描期间的
+    变化当作已经包含在结果里。mtime 距离现在不到 MTIME_RACY_WINDOW 时，之后同一时间粒度内的变化可能
+    不改变 mtime，记为 -2，使下一次校验失败并重新扫描
+    """
+    try:
+        mtime = os.stat(dir_path).st_mtime_ns
+    except OSError:
+        mtime = -1
+    if mtime >= 0 and time.time_ns() - mtime < MTIME_RACY_WINDOW_NS:
+        mtime = -2
+    dir_mtimes[dir_path] = mtime
+
+
+def expand_dir(node: Dict[str, Any], dir_path: str, depth: int, max_depth: int, include_files: bool,
+               dir_mtimes: Optional[Dict[str, int]] = None) -> List[Tuple[Dict[str, Any], str, int]]:
+    """
+    展开一个目录节点：读取目录并填充 node["children"]（或 node["error"]）
+
+    子目录节点按顺序放入 children 时只有 name/type/path，返回待展开的 (子节点, 路径, 深度) 列表；
+    超过 max_depth 的子目录直接标记 max_depth_reached，不再返回。
+    """
+    if dir_mtimes is not None:
+        record_mtime(dir_mtimes, dir_path)
+    try:
+        dirs, files = scan_dir(dir_path, include_files)
+    except PermissionError:
+        node["error"] = "权限不足"
+        node["children"] = []
+        return []
+
+    children = []
+    pending = []
+    for entry in dirs:
+        child = {"name": entry.name, "type": "directory", "path": join_relative(node["path"], entry.name)}
+        if depth + 1 > max_depth:
+            child["max_depth_reached"] = True
+            child["children"] = []
+        else:
+            pending.append((child, entry.path, depth + 1))
+        children.append(child)
+
+    for entry in files:
+        children.append(file_node(entry, join_relative(node["path"], entry.name)))
+
+    node["children"] = children
+    return pending
+
+
+def build_tree_parallel(base_path: str, current_path: str, max_depth: int = 3, include_files: bool = True,
+                        fan_out: int = 8, current_depth: int = 0,
+                        dir_mtimes: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """
+    并行构建文件树结构，同级子目录分发到共用的子目录线程池（subtree_executor）中读取
+
+    适合网络文件系统等单次目录读取延迟高的场景。fan_out 是本次扫描同时提交的目录数上限，
+    所有并行扫描的线程总数由 SUBTREE_WORKERS 限制。子节点在父目录展开时就按名称顺序占好位置，
+    因此无论各线程完成顺序如何，结果都与 build_tree 完全一致。
+    """
+    if fan_out <= 1 or current_depth > max_depth or not os.path.isdir(current_path):
+        return build_tree(base_path, current_path, max_depth, include_files, current_depth, dir_mtimes)
+
+    name, relative_path = node_name_and_path(base_path, current_path)
+    root = {"name": name, "type": "directory", "path": relative_path}
+
+    executor = subtree_executor()
+    pending = deque([(root, current_path, current_depth)])
+    running = set()
+    try:
+        while pending or running:
+            while pending and len(running) < fan_out:
+                node, dir_path, depth = pending.popleft()
+                running.add(executor.submit(expand_dir, node, dir_path, depth, max_depth, include_files, dir_mtimes))
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.extend(future.result())
+    finally:
+        # 出错时取消本次扫描还没开始的任务
+        for future in running:
+            future.cancel()
+
+    return root
+
+
+def iter_tree(base_path: str, current_path: str, max_depth: int = 3, include_files: bool = True, current_depth: int = 0) -> Iterator[Dict[str, Any]]:
+    """
+    逐个产出文件树节点（扁平结构，用于流式输出）
+
+    每个节点带有 id 和 parent_id（根节点的 parent_id 为 None），不包含 children 字段，
+    其余字段与 build_tree 的节点一致。父节点总是先于子节点产出；同一目录下文件先于子目录产出，
+    子目录之间、文件之间仍按名称排序。
+
+    内存占用只与待处理的目录栈（深度 x 宽度）相关，与整棵树的大小无关。
+    """
+    name, relative_path = node_name_and_path(base_path, current_path)
+    next_id = 0
+
+    if current_depth <= max_depth and not os.path.isdir(current_path):
+        node = build_tree(base_path, current_path, max_depth, include_files, current_depth)
+        yield {"id": next_id, "parent_id": None, **node}
+        return
+
+    # 栈元素: (父节点 id, 名称, 绝对路径, 相对路径, 深度)
+    stack = [(None, name, current_path, relative_path, current_depth)]
+
+    while stack:
+        parent_id, dir_name, dir_path, dir_rel, depth = stack.pop()
+        node_id = next_id
+        next_id += 1
+        node = {"id": node_id, "parent_id": parent_id, "name": dir_name, "type": "directory", "path": dir_rel}
+
+        if depth > max_depth:
+            node["max_depth_reached"] = True
+            yield node
+            continue
+
+        try:
+            dirs, files = scan_dir(dir_path, include_files)
+        except PermissionError:
+            node["error"] = "权限不足"
+            yield node
+            continue
+
+        yield node
+
+        for entry in files:
+            child = file_node(entry, join_relative(dir_rel, entry.name))
+            yield {"id": next_id, "parent_id": node_id, **child}
+            next_id += 1
+
+        # 逆序入栈，使子目录按名称顺序出栈
+        for entry in reversed(dirs):
+            stack.append((node_id, entry.name, entry.path, join_relative(dir_rel, entry.name), depth + 1))
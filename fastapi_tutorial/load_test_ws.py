@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+WebSocket 聊天服务负载测试
+
+启动（或连接已运行的）official_websocket_server / _v2 / _v3，打开 N 个客户端，每个客户端按固定速率发送消息，统计：
+- 建立连接的速率（连接/秒）和失败数
+- 发送、接收的消息吞吐量（条/秒）；v3 的每条消息会广播给房间内所有客户端，接收量约为发送量的 N 倍
+- 端到端延迟 p50/p90/p99：消息内容中带发送时间，收到服务端的回显/广播时计算
+- 服务端 RSS（读取 /proc，仅 Linux）：空载、连接建立后、测试期间的峰值
+
+结果保存为 JSON，可以用 --baseline 与之前的结果比较，吞吐量下降或 p99 延迟上升超过 --max-regression 时以非零状态退出，
+用于发现 ConnectionManager 等改动带来的性能回退。
+客户端全部运行在本进程的一个事件循环中，v3 的广播量很大时（每秒数万条）客户端自身也可能成为瓶颈，
+可以观察本进程的 CPU 占用，或在多台机器上分别运行。
+
+用法:
+    python load_test_ws.py --server v3 --clients 200 --rate 2 --duration 10 --output ws_v3.json
+    python load_test_ws.py --server v1 --clients 1000 --rate 5
+    python load_test_ws.py --server v3 --query batch=1 --baseline ws_v3.json
+    python load_test_ws.py --server v3 --url ws://127.0.0.1:8000 --pid 12345   # 测试已运行的服务
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import websockets
+
+# 各服务的模块名和 WebSocket 路径。每条消息都会收到一条带原消息内容的回复，v3 另外广播给房间内所有客户端
+SERVERS = {
+    "v1": {"module": "official_websocket_server", "path": "/ws"},
+    "v2": {"module": "official_websocket_server_v2", "path": "/items/{client_id}/ws?token=load-test"},
+    "v3": {"module": "official_websocket_server_v3", "path": "/ws/{client_id}?room=load-test"},
+}
+
+MARKER = "lt"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def rss_kb(pid: int) -> Optional[int]:
+    """进程及其子进程（uvicorn 多 worker）的 RSS 之和，非 Linux 返回 None"""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            if current == pid:
+                return None
+    return total
+
+
+def raise_fd_limit(clients: int):
+    """每个客户端占用一个文件描述符，尽量提高软限制"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = clients + 256
+    if soft < wanted:
+        new_soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+        if new_soft < wanted:
+            print(f"警告: 文件描述符上限 {new_soft}，可能无法打开 {clients} 个连接")
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.rss_peak = 0
+        self.measuring = False
+
+
+def parse_messages(text: str) -> List[str]:
+    """v3 批量模式（?batch=1）下一帧是消息的 JSON 数组"""
+    if text.startswith("["):
+        try:
+            items = json.loads(text)
+            return [item for item in items if isinstance(item, str)]
+        except ValueError:
+            pass
+    return [text]
+
+
+async def client_receiver(ws, stats: Stats):
+    try:
+        async for frame in ws:
+            if isinstance(frame, bytes):
+                continue
+            now = time.perf_counter_ns()
+            for text in parse_messages(frame):
+                # 消息内容为 lt:<发送者>:<序号>:<发送时间ns>，可能带服务端加的前缀
+                index = text.find(MARKER + ":")
+                if index < 0:
+                    continue
+                parts = text[index:].split(":")
+                if len(parts) < 4:
+                    continue
+                try:
+                    sent_ns = int(parts[3].split(",")[0])
+                except ValueError:
+                    continue
+                if stats.measuring:
+                    stats.received += 1
+                    stats.latencies.append((now - sent_ns) / 1e6)
+    except websockets.ConnectionClosed:
+        pass
+
+
+async def client_sender(ws, client_id: int, rate: float, stop_at: float, stats: Stats):
+    interval = 1 / rate
+    # 各客户端错开发送时间，避免所有客户端同时发送
+    await asyncio.sleep(random.random() * interval)
+    seq = 0
+    next_send = time.perf_counter()
+    while next_send < stop_at:
+        try:
+            await ws.send(f"{MARKER}:{client_id}:{seq}:{time.perf_counter_ns()}")
+        except websockets.ConnectionClosed:
+            stats.errors += 1
+            return
+        stats.sent += 1
+        seq += 1
+        next_send += interval
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def sample_rss(pid: Optional[int], stats: Stats, stop: asyncio.Event):
+    while not stop.is_set() and pid is not None:
+        rss = rss_kb(pid)
+        if rss is not None:
+            stats.rss_peak = max(stats.rss_peak, rss)
+        try:
+            await asyncio.wait_for(stop.wait(), 0.2)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run(url: str, server: str, clients: int, rate: float, duration: float, concurrency: int,
+              query: str, pid: Optional[int]) -> Dict[str, Any]:
+    spec = SERVERS[server]
+    path = spec["path"]
+    if query:
+        path += ("&" if "?" in path else "?") + query
+    stats = Stats()
+    result: Dict[str, Any] = {"rss_kb": {"idle": rss_kb(pid) if pid else None}}
+
+    # 建立连接
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = 0
+
+    async def open_client(client_id: int):
+        nonlocal failed
+        async with semaphore:
+            try:
+                return await websockets.connect(url + path.format(client_id=client_id),
+                                                max_queue=None, ping_interval=None, open_timeout=30)
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+                failed += 1
+                return None
+
+    start = time.perf_counter()
+    connections = [ws for ws in await asyncio.gather(*(open_client(i) for i in range(clients))) if ws is not None]
+    connect_seconds = time.perf_counter() - start
+    result["connect"] = {
+        "clients": clients,
+        "connected": len(connections),
+        "failed": failed,
+        "seconds": round(connect_seconds, 3),
+        "per_second": round(len(connections) / connect_seconds, 1) if connect_seconds else None,
+    }
+    result["rss_kb"]["connected"] = rss_kb(pid) if pid else None
+
+    receivers = [asyncio.create_task(client_receiver(ws, stats)) for ws in connections]
+    stop_sampling = asyncio.Event()
+    sampler = asyncio.create_task(sample_rss(pid, stats, stop_sampling))
+
+    # 发送阶段
+    stats.measuring = True
+    start = time.perf_counter()
+    await asyncio.gather(*(client_sender(ws, i, rate, start + duration, stats) for i, ws in enumerate(connections)))
+    send_seconds = time.perf_counter() - start
+    # 等待在途消息
+    await asyncio.sleep(min(2.0, max(0.5, duration / 5)))
+    elapsed = time.perf_counter() - start
+    stats.measuring = False
+
+    stop_sampling.set()
+    await sampler
+    for ws in connections:
+        await ws.close()
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    expected_per_message = 1 + (len(connections) if server == "v3" else 0)
+    result["messages"] = {
+        "sent": stats.sent,
+        "received": stats.received,
+        "expected": stats.sent * expected_per_message,
+        "send_errors": stats.errors,
+        "sent_per_second": round(stats.sent / send_seconds, 1) if send_seconds else None,
+        "received_per_second": round(stats.received / elapsed, 1) if elapsed else None,
+    }
+    result["latency_ms"] = {
+        name: (round(value, 3) if value is not None else None)
+        for name, value in (("p50", percentile(stats.latencies, 50)),
+                            ("p90", percentile(stats.latencies, 90)),
+                            ("p99", percentile(stats.latencies, 99)),
+                            ("max", max(stats.latencies) if stats.latencies else None))
+    }
+    result["rss_kb"]["peak"] = stats.rss_peak or None
+    return result
+
+
+def wait_ready(port: int, timeout: float = 15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("服务启动超时")
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """返回超过阈值的回退项"""
+    problems = []
+    old = baseline["messages"]["received_per_second"]
+    new = result["messages"]["received_per_second"]
+    if old and new is not None and new < old * (1 - max_regression):
+        problems.append(f"接收吞吐量 {old} -> {new} 条/秒")
+    old = baseline["latency_ms"]["p99"]
+    new = result["latency_ms"]["p99"]
+    if old and new is not None and new > old * (1 + max_regression):
+        problems.append(f"p99 延迟 {old} -> {new} ms")
+    old = baseline["connect"]["per_second"]
+    new = result["connect"]["per_second"]
+    if old and new is not None and new < old * (1 - max_regression):
+        problems.append(f"连接速率 {old} -> {new} 连接/秒")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WebSocket 聊天服务负载测试")
+    parser.add_argument("--server", choices=sorted(SERVERS), default="v3")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=1.0, help="每个客户端每秒发送的消息数")
+    parser.add_argument("--duration", type=float, default=10.0, help="发送阶段的时长（秒）")
+    parser.add_argument("--concurrency", type=int, default=100, help="同时进行的连接握手数")
+    parser.add_argument("--query", default="", help="附加到 WebSocket 地址的查询参数，如 batch=1")
+    parser.add_argument("--workers", type=int, default=1, help="自动启动服务时的 uvicorn worker 数")
+    parser.add_argument("--url", help="测试已运行的服务，如 ws://127.0.0.1:8000；不指定时自动启动")
+    parser.add_argument("--pid", type=int, help="已运行服务的进程号，用于统计 RSS")
+    parser.add_argument("--output", help="结果保存到的 JSON 文件")
+    parser.add_argument("--baseline", help="与之前保存的 JSON 结果比较")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="允许的回退比例，默认 0.2")
+    args = parser.parse_args()
+
+    raise_fd_limit(args.clients)
+    server = None
+    url, pid = args.url, args.pid
+    if url is None:
+        port = free_port()
+        here = os.path.dirname(os.path.abspath(__file__))
+        # 所有客户端都来自本机，放宽 v3 的连接数上限
+        env = dict(os.environ)
+        for name in ("WS_MAX_CONNECTIONS", "WS_MAX_CONNECTIONS_PER_IP"):
+            env.setdefault(name, str(max(args.clients, 1000)))
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", f"{SERVERS[args.server]['module']}:app", "--host", "127.0.0.1",
+             "--port", str(port), "--workers", str(args.workers), "--log-level", "warning"],
+            cwd=here, env=env,
+        )
+        url, pid = f"ws://127.0.0.1:{port}", server.pid
+    try:
+        if server is not None:
+            wait_ready(int(url.rsplit(":", 1)[1]))
+            time.sleep(0.5)
+        result = asyncio.run(run(url, args.server, args.clients, args.rate, args.duration,
+                                 args.concurrency, args.query, pid))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "server": args.server,
+        "clients": args.clients,
+        "rate": args.rate,
+        "duration": args.duration,
+        "query": args.query,
+        "workers": args.workers if server is not None else None,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        **result,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        problems = compare(report, baseline, args.max_regression)
+        for problem in problems:
+            print(f"性能回退: {problem}")
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
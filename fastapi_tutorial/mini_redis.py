@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+本地测试用的 Redis 替身：只实现 PING / AUTH / SELECT / PUBLISH / SUBSCRIBE / UNSUBSCRIBE / QUIT
+
+没有安装 Redis 时，用它验证 ws_pubsub.RedisPubSub 的跨进程广播：
+
+    python mini_redis.py --port 6379
+    WS_PUBSUB_BACKEND=redis WS_REDIS_URL=redis://localhost:6379 python official_websocket_server_v3.py
+
+不做持久化，也不支持其他命令，不能用于生产。
+"""
+import argparse
+import asyncio
+from typing import Dict, Set
+
+from ws_pubsub import RedisError, encode_command, read_reply
+
+
+def bulk(value: bytes) -> bytes:
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class MiniRedis:
+    def __init__(self):
+        self.channels: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        subscribed: Set[bytes] = set()
+        try:
+            while True:
+                try:
+                    command = await read_reply(reader)
+                except RedisError:
+                    writer.write(b"-ERR protocol error\r\n")
+                    break
+                if not isinstance(command, list) or not command:
+                    writer.write(b"-ERR protocol error\r\n")
+                    break
+                name = command[0].upper()
+                args = command[1:]
+                if name == b"PING":
+                    writer.write(b"+PONG\r\n")
+                elif name in (b"AUTH", b"SELECT"):
+                    writer.write(b"+OK\r\n")
+                elif name == b"PUBLISH" and len(args) == 2:
+                    receivers = self.channels.get(args[0], ())
+                    message = encode_command(b"message", args[0], args[1])
+                    for receiver in receivers:
+                        receiver.write(message)
+                    writer.write(b":%d\r\n" % len(receivers))
+                elif name == b"SUBSCRIBE" and args:
+                    for channel in args:
+                        self.channels.setdefault(channel, set()).add(writer)
+                        subscribed.add(channel)
+                        writer.write(b"*3\r\n$9\r\nsubscribe\r\n" + bulk(channel)
+                                     + b":%d\r\n" % len(subscribed))
+                elif name == b"UNSUBSCRIBE":
+                    for channel in args or list(subscribed):
+                        self._remove(channel, writer)
+                        subscribed.discard(channel)
+                        writer.write(b"*3\r\n$11\r\nunsubscribe\r\n" + bulk(channel)
+                                     + b":%d\r\n" % len(subscribed))
+                elif name == b"QUIT":
+                    writer.write(b"+OK\r\n")
+                    break
+                else:
+                    writer.write(b"-ERR unknown command '%s'\r\n" % name)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for channel in subscribed:
+                self._remove(channel, writer)
+            writer.close()
+
+    def _remove(self, channel: bytes, writer: asyncio.StreamWriter):
+        receivers = self.channels.get(channel)
+        if receivers is not None:
+            receivers.discard(writer)
+            if not receivers:
+                del self.channels[channel]
+
+
+async def serve(host: str, port: int) -> asyncio.AbstractServer:
+    return await asyncio.start_server(MiniRedis().handle, host, port)
+
+
+async def main(host: str, port: int):
+    server = await serve(host, port)
+    print(f"mini redis 监听 {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="本地测试用的 Redis pub/sub 替身")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+    asyncio.run(main(args.host, args.port))
@@ -30,6 +30,7 @@ Query
 """
 
 from fastapi import (
+    Body,
     Cookie,
     Depends,
     FastAPI,
@@ -41,8 +42,22 @@ from fastapi import (
 from fastapi.responses import HTMLResponse
 import uvicorn
 
+import asyncio
+import os
+
+from ws_auth import validator_from_env
+
 app = FastAPI()
 
+"""
+token 校验见 ws_auth.py：校验结果按 TTL 缓存（无效的 token 也缓存一段较短的时间），
+同一个 token 的并发校验只查询一次后端。连接期间由独立的任务每隔 REVALIDATE_INTERVAL 秒重新校验
+（与是否收到消息无关，空闲连接同样会被检查），校验通过的结果最多缓存 REVALIDATE_INTERVAL 秒；
+token 被吊销（POST /revoke_token）后，使用它的连接最迟在一个间隔后被关闭（1008）。
+"""
+REVALIDATE_INTERVAL = float(os.environ.get("WS_AUTH_REVALIDATE_INTERVAL", "30"))
+token_validator = validator_from_env(max_ttl=REVALIDATE_INTERVAL)
+
 html = """
 <!DOCTYPE html>
 <html>
@@ -101,7 +116,52 @@ async def get_cookie_or_token(
     if session is None and token is None:
         # 由于这是一个 WebSocket，抛出 HTTPException 并不是很合理，而是抛出 WebSocketException。
         raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION)
-    return session or token
+    cookie_or_token = session or token
+    try:
+        principal = await token_validator.validate(cookie_or_token)
+    except Exception:
+        # 认证后端不可用
+        raise WebSocketException(code=status.WS_1011_INTERNAL_ERROR)
+    if principal is None:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION)
+    return cookie_or_token
+
+
+@app.get("/auth_stats")
+async def auth_stats():
+    """token 缓存命中情况"""
+    return token_validator.stats()
+
+
+@app.post("/revoke_token")
+async def revoke_token(token: Annotated[str, Body(embed=True)]):
+    """吊销 token：清除缓存，使用该 token 的连接在下一次重新校验时被关闭"""
+    token_validator.revoke(token)
+    return {"revoked": token}
+
+
+async def revalidate_token(cookie_or_token: str):
+    """每隔 REVALIDATE_INTERVAL 秒重新校验一次，token 失效时返回"""
+    while True:
+        await asyncio.sleep(REVALIDATE_INTERVAL)
+        try:
+            principal = await token_validator.validate(cookie_or_token)
+        except Exception:
+            # 认证后端暂时不可用时保持连接，下一个间隔再试
+            continue
+        if principal is None:
+            return
+
+
+async def echo_messages(websocket: WebSocket, item_id: str, q: int | None, cookie_or_token: str):
+    while True:
+        data = await websocket.receive_text()
+        await websocket.send_text(
+            f"Session cookie or query token value is: {cookie_or_token}"
+        )
+        if q is not None:
+            await websocket.send_text(f"Query parameter q is: {q}")
+        await websocket.send_text(f"Message text was: {data}, for item ID: {item_id}")
 
 
 @app.websocket("/items/{item_id}/ws")
@@ -113,14 +173,19 @@ async def websocket_endpoint(
         cookie_or_token: Annotated[str, Depends(get_cookie_or_token)],
 ):
     await websocket.accept()
-    while True:
-        data = await websocket.receive_text()
-        await websocket.send_text(
-            f"Session cookie or query token value is: {cookie_or_token}"
-        )
-        if q is not None:
-            await websocket.send_text(f"Query parameter q is: {q}")
-        await websocket.send_text(f"Message text was: {data}, for item ID: {item_id}")
+    revalidate_task = asyncio.create_task(revalidate_token(cookie_or_token))
+    echo_task = asyncio.create_task(echo_messages(websocket, item_id, q, cookie_or_token))
+    try:
+        await asyncio.wait({revalidate_task, echo_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (revalidate_task, echo_task):
+            task.cancel()
+        await asyncio.gather(revalidate_task, echo_task, return_exceptions=True)
+    if revalidate_task.done() and not revalidate_task.cancelled():
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="token revoked")
+        return
+    # 客户端断开（WebSocketDisconnect）等异常照常抛出
+    echo_task.result()
 
 
 # run method 1:
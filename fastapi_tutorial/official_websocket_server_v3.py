@@ -18,11 +18,16 @@ FastAPI 直接提供了相同的 WebSocket，只是为了方便开发人员。
 https://www.starlette.io/websockets/
 https://www.starlette.io/endpoints/#websocketendpoint
 """
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Query, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse
 
+import os
+import tempfile
+
 import uvicorn
 
+from ws_manager import DEFAULT_ROOM, TEXT, ConnectionRejected, manager_from_env
+
 app = FastAPI()
 
 html = """
@@ -33,7 +38,7 @@ html = """
     </head>
     <body>
         <h1>WebSocket Chat</h1>
-        <h2>Your ID: <span id="ws-id"></span></h2>
+        <h2>Your ID: <span id="ws-id"></span>, Room: <span id="ws-room"></span></h2>
         <form action="" onsubmit="sendMessage(event)">
             <input type="text" id="messageText" autocomplete="off"/>
             <button>Send</button>
@@ -42,14 +47,23 @@ html = """
         </ul>
         <script>
             var client_id = Date.now()
+            // 通过页面地址的 ?room=xxx 选择房间，?batch=1 开启批量接收
+            var params = new URLSearchParams(location.search)
+            var room = params.get("room") || "lobby"
+            var batch = params.get("batch") === "1"
             document.querySelector("#ws-id").textContent = client_id;
-            var ws = new WebSocket(`ws://localhost:8000/ws/${client_id}`);
+            document.querySelector("#ws-room").textContent = room;
+            var ws = new WebSocket(`ws://localhost:8000/ws/${client_id}?room=${encodeURIComponent(room)}&batch=${batch ? 1 : 0}`);
             ws.onmessage = function(event) {
                 var messages = document.getElementById('messages')
-                var message = document.createElement('li')
-                var content = document.createTextNode(event.data)
-                message.appendChild(content)
-                messages.appendChild(message)
+                // 批量模式下每一帧是消息的 JSON 数组
+                var items = batch ? JSON.parse(event.data) : [event.data]
+                items.forEach(function(item) {
+                    var message = document.createElement('li')
+                    var content = document.createTextNode(item)
+                    message.appendChild(content)
+                    messages.appendChild(message)
+                })
             };
             function sendMessage(event) {
                 var input = document.getElementById("messageText")
@@ -67,26 +81,21 @@ html = """
 当 WebSocket 连接关闭时，await websocket.receive_text() 将引发 WebSocketDisconnect 异常，您可以捕获并处理该异常，就像本示例中的示例一样。
 """
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+"""
+ConnectionManager 见 ws_manager.py：连接按房间分组，broadcast 只把消息放入每个连接的发送队列，
+由各连接的写任务并发发送，慢客户端不会拖慢其他人。
+"""
+manager = manager_from_env()
 
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+@app.on_event("startup")
+async def start_manager():
+    await manager.start()
 
 
-manager = ConnectionManager()
+@app.on_event("shutdown")
+async def stop_manager():
+    await manager.stop()
 
 
 @app.get("/")
@@ -94,21 +103,49 @@ async def get():
     return HTMLResponse(html)
 
 
+@app.get("/ws_stats")
+async def ws_stats():
+    """连接数、各房间人数、排队/丢弃的消息数等"""
+    return manager.stats()
+
+
 @app.websocket("/ws/{client_id}")
-async def websocket_endpoint(websocket: WebSocket, client_id: int):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, client_id: int, room: str = DEFAULT_ROOM,
+                             frame_format: str = Query(TEXT, alias="format"), batch: bool = False):
+    # ?format=msgpack 或 ?format=cbor 时服务端发送二进制帧（客户端发送的仍是文本），需要安装 req.txt 中的 msgpack / cbor2
+    # ?batch=1 时短时间内的多条消息合并为一个数组帧发送
+    try:
+        connection = await manager.connect(websocket, client_id, room, frame_format, batch)
+    except ConnectionRejected as e:
+        # 帧格式不支持或连接数超限。还没有 accept，这里的 close 会让 uvicorn 以 HTTP 403 拒绝握手，
+        # 客户端看不到 e.code（1003 / 1013）和 e.reason
+        await websocket.close(code=e.code, reason=e.reason)
+        return
     try:
         while True:
-            data = await websocket.receive_text()
-            await manager.send_personal_message(f"You wrote: {data}", websocket)
-            await manager.broadcast(f"Client #{client_id} says: {data}")
+            # 连接被服务端 kick 后 receive_text 同样抛出 WebSocketDisconnect
+            data = await connection.receive_text()
+            manager.touch(connection)
+            await manager.send_personal_message(f"You wrote: {data}", connection)
+            await manager.broadcast(f"Client #{client_id} says: {data}", room)
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
-        await manager.broadcast(f"Client #{client_id} left the chat")
+        pass
+    finally:
+        # 客户端断开、被服务端 kick 或处理出错，都要移除连接并通知其他人
+        manager.disconnect(connection)
+        await manager.broadcast(f"Client #{client_id} left the chat", room)
 
 # run method 1:
 # uvicorn official_websocket_server:app --reload
 
+"""
+多 worker 时每个进程有自己的 manager，广播通过 WS_PUBSUB_BACKEND 指定的后端在进程之间转发：
+- 同一主机：WS_PUBSUB_BACKEND=unix WS_PUBSUB_DIR=/tmp/ws_chat_8000 uvicorn official_websocket_server_v3:app --workers 2
+  （WS_PUBSUB_DIR 是本实例专用的目录，同一主机上的其他实例要用不同的目录）
+- 多台主机：WS_PUBSUB_BACKEND=redis WS_REDIS_URL=redis://<host>:6379 uvicorn official_websocket_server_v3:app --workers 2
+  （本地没有 Redis 时可以先运行 python mini_redis.py）
+"""
+
 """
 Test:
 尝试以下操作：
@@ -128,4 +165,9 @@ if __name__ == '__main__':
     # cmd启动命令:
     # uvicorn run:app --host <api_ip> --port <api_port> --reload --workers 2
     # 程序启动方式
-    uvicorn.run('official_websocket_server_v3:app', host='0.0.0.0', port=8000, reload=True, workers=2)
+    # 多个 worker 之间默认通过 Unix 套接字转发广播（Windows 不支持，需改用 redis）
+    os.environ.setdefault("WS_PUBSUB_BACKEND", "unix")
+    os.environ.setdefault("WS_PUBSUB_DIR", os.path.join(tempfile.gettempdir(), "ws_pubsub_v3_8000"))
+    # 连接存活由协议层 ping/pong 检测（websockets 实现，wsproto 不支持这两个参数）
+    uvicorn.run('official_websocket_server_v3:app', host='0.0.0.0', port=8000, reload=True, workers=2,
+                ws_ping_interval=20, ws_ping_timeout=20)
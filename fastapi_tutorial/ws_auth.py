@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+WebSocket 的 token 校验：可替换的校验后端 + 带 TTL 的 LRU 缓存
+
+official_websocket_server_v2 的 get_cookie_or_token 只检查 token 是否存在。实际部署时 token 要到用户存储
+（数据库、认证服务）中校验，长连接期间还要定期重新校验（token 可能被吊销）。直接每次都查询会让认证后端
+承受和连接数、消息数成正比的压力，这里用 CachedTokenValidator 包装任意后端：
+- 校验通过的结果缓存 ttl 秒，被拒绝的 token 缓存 negative_ttl 秒（负缓存，防止无效 token 反复打到后端）
+- 缓存按 LRU 淘汰，最多 max_size 条
+- 同一个 token 同时有多个请求时只查询一次后端（single flight），其余请求等待同一个结果；
+  同时进行的后端查询数不超过 max_concurrency，连接风暴时后端的压力有上限
+- 后端出错时不缓存，异常交给调用方处理
+- revoke() 吊销 token 时同时清除缓存和正在进行的查询，下一次校验一定会重新查询后端
+
+后端只需实现 async def lookup(token) -> Optional[dict]，返回用户信息或 None（无效）。
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+Principal = Dict[str, Any]
+
+
+class TokenBackend:
+    async def lookup(self, token: str) -> Optional[Principal]:
+        raise NotImplementedError
+
+    def revoke(self, token: str):
+        """吊销 token；吊销记录由外部存储管理的后端不需要实现"""
+
+
+class StaticTokenBackend(TokenBackend):
+    """演示用的用户存储：tokens 为 None 时接受任何非空 token（与原来的示例行为一致），否则只接受给定的 token"""
+
+    def __init__(self, tokens: Optional[Iterable[str]] = None, latency: float = 0.0):
+        self.tokens = set(tokens) if tokens is not None else None
+        self.latency = latency
+        self.lookups = 0
+        self.revoked = set()
+
+    async def lookup(self, token: str) -> Optional[Principal]:
+        self.lookups += 1
+        if self.latency:
+            # 模拟查询数据库或认证服务的耗时
+            await asyncio.sleep(self.latency)
+        if not token or token in self.revoked:
+            return None
+        if self.tokens is not None and token not in self.tokens:
+            return None
+        return {"token": token}
+
+    def revoke(self, token: str):
+        self.revoked.add(token)
+
+
+class CallableTokenBackend(TokenBackend):
+    """用一个异步函数作为后端"""
+
+    def __init__(self, func: Callable[[str], Awaitable[Optional[Principal]]]):
+        self.func = func
+
+    async def lookup(self, token: str) -> Optional[Principal]:
+        return await self.func(token)
+
+
+class CachedTokenValidator:
+    def __init__(self, backend: TokenBackend, ttl: float = 60, negative_ttl: float = 10,
+                 max_size: int = 10000, max_concurrency: int = 16):
+        self.backend = backend
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        # token -> (过期时间, 用户信息或 None)
+        self._cache: "OrderedDict[str, Tuple[float, Optional[Principal]]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.backend_calls = 0
+        self.evictions = 0
+
+    async def validate(self, token: str) -> Optional[Principal]:
+        """返回用户信息，token 无效时返回 None；后端出错时抛出异常"""
+        now = time.monotonic()
+        entry = self._cache.get(token)
+        if entry is not None:
+            expires_at, principal = entry
+            if expires_at > now:
+                self._cache.move_to_end(token)
+                if principal is None:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                return principal
+            del self._cache[token]
+        self.misses += 1
+
+        future = self._inflight.get(token)
+        if future is not None:
+            # 已有相同 token 的查询在进行，等待它的结果
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[token] = future
+        try:
+            async with self._semaphore:
+                self.backend_calls += 1
+                principal = await self.backend.lookup(token)
+        except BaseException as e:
+            if isinstance(e, Exception):
+                future.set_exception(e)
+                # 没有其他等待者时避免 "exception was never retrieved" 警告
+                future.exception()
+            else:
+                future.cancel()
+            raise
+        else:
+            # 查询期间 token 被吊销时不缓存这次的结果
+            if self._inflight.get(token) is future:
+                self._store(token, principal)
+            future.set_result(principal)
+            return principal
+        finally:
+            if self._inflight.get(token) is future:
+                del self._inflight[token]
+
+    def _store(self, token: str, principal: Optional[Principal]):
+        ttl = self.ttl if principal is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+        self._cache[token] = (time.monotonic() + ttl, principal)
+        self._cache.move_to_end(token)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, token: str):
+        """token 被吊销时调用，下一次校验会重新查询后端（不复用吊销前发起的查询）"""
+        self._cache.pop(token, None)
+        self._inflight.pop(token, None)
+
+    def revoke(self, token: str):
+        """在后端吊销 token 并清除缓存"""
+        self.backend.revoke(token)
+        self.invalidate(token)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "backend_calls": self.backend_calls,
+            "evictions": self.evictions,
+            "inflight": len(self._inflight),
+        }
+
+
+def validator_from_env(max_ttl: Optional[float] = None) -> CachedTokenValidator:
+    """
+    WS_AUTH_TOKENS 为逗号分隔的有效 token 列表，不设置时接受任何非空 token
+
+    max_ttl 限制校验通过的结果的缓存时间：长连接按固定间隔重新校验时传入该间隔，
+    否则重新校验大多命中吊销之前缓存的结果。
+    """
+    ttl = float(os.environ.get("WS_AUTH_CACHE_TTL", "60"))
+    if max_ttl is not None:
+        ttl = min(ttl, max_ttl)
+    tokens = os.environ.get("WS_AUTH_TOKENS")
+    backend = StaticTokenBackend(
+        [token.strip() for token in tokens.split(",") if token.strip()] if tokens else None,
+        latency=float(os.environ.get("WS_AUTH_BACKEND_LATENCY_MS", "0")) / 1000,
+    )
+    return CachedTokenValidator(
+        backend,
+        ttl=ttl,
+        negative_ttl=float(os.environ.get("WS_AUTH_NEGATIVE_TTL", "10")),
+        max_size=int(os.environ.get("WS_AUTH_CACHE_SIZE", "10000")),
+        max_concurrency=int(os.environ.get("WS_AUTH_MAX_CONCURRENCY", "16")),
+    )
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+时间轮：用一个后台任务驱动所有连接的超时检查（如空闲断开）
+
+每个连接一个定时任务（或 asyncio.sleep 循环）在上万个连接时会有上万个 TimerHandle 和协程。
+时间轮把时间按 tick 分成若干个槽，每个槽是一个 set，schedule 把对象放入到期时间所在的槽，
+后台任务每个 tick 取出当前槽里的所有对象调用回调。schedule / cancel 都是 O(1)，精度为一个 tick，
+对空闲断开这种秒级的超时足够了。超过时间轮跨度的延迟按最大跨度处理，回调中应重新判断是否真的到期。
+"""
+import asyncio
+import math
+from typing import Any, Callable, Dict, List, Optional, Set
+
+
+class TimerWheel:
+    def __init__(self, callback: Callable[[Any], None], tick: float = 1.0, max_delay: float = 60.0):
+        self.callback = callback
+        self.tick = tick
+        self.slots: List[Set[Any]] = [set() for _ in range(max(2, math.ceil(max_delay / tick) + 1))]
+        self.cursor = 0
+        self._where: Dict[Any, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def schedule(self, item: Any, delay: float):
+        """delay 秒后（向上取整到 tick）调用 callback(item)，已安排的会被替换"""
+        self.cancel(item)
+        ticks = min(max(1, math.ceil(delay / self.tick)), len(self.slots) - 1)
+        index = (self.cursor + ticks) % len(self.slots)
+        self.slots[index].add(item)
+        self._where[item] = index
+
+    def cancel(self, item: Any):
+        index = self._where.pop(item, None)
+        if index is not None:
+            self.slots[index].discard(item)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def advance(self):
+        """前进一个 tick，处理到期的对象"""
+        self.cursor = (self.cursor + 1) % len(self.slots)
+        due = self.slots[self.cursor]
+        if not due:
+            return
+        self.slots[self.cursor] = set()
+        for item in due:
+            self._where.pop(item, None)
+        for item in due:
+            self.callback(item)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time() + self.tick
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            next_tick += self.tick
+            self.advance()
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+"""
+WebSocket 连接管理：房间 + 每连接发送队列
+
+official_websocket_server_v3 原来的 ConnectionManager.broadcast 逐个 await send_text，
+一个慢客户端（TCP 发送缓冲区满）会拖慢所有人；disconnect 用 list.remove，是 O(n) 的。
+这里改为：
+- 房间（频道）用 set 保存连接，加入/离开都是 O(1)
+- 每个连接有一个有界的发送队列和独立的写任务，broadcast 只把消息放入各连接的队列（不 await 网络发送），
+  各连接的写任务并发发送，广播耗时与最慢的客户端无关
+- 慢客户端的队列满时按策略处理（环境变量 WS_SLOW_CONSUMER_POLICY）：
+  drop_oldest 丢弃队列中最旧的消息（默认）；disconnect 断开该连接（关闭码 1008）
+- 队列长度由环境变量 WS_SEND_QUEUE_SIZE 控制（默认256）
+- 多个 worker / 多台主机时，broadcast 同时通过 pub/sub 后端（见 ws_pubsub.py）发布，
+  其他进程收到后发给各自的连接；需要在应用启动/关闭时调用 start()/stop()
+- 广播的消息只序列化一次：encode_frame 生成一个 Frame（其中是 ASGI websocket.send 消息），所有同格式的连接
+  共用同一个对象，写任务直接 websocket.send(frame.message)。消息可以是 str 或可 JSON 序列化的对象，每个连接可选帧格式：
+  text（默认，非 str 的消息编码为 JSON）；msgpack / cbor（二进制帧，依赖 req.txt 中的 msgpack / cbor2，
+  未安装时连接会被拒绝），二进制帧省去了服务端对每个连接的 UTF-8 编码
+- 可选的批量发送（连接时 batch=True，v3 中为 ?batch=1）：写任务空闲时收到第一条消息后，最多再等
+  batch_window 秒（环境变量 WS_BATCH_WINDOW_MS，默认10ms，也是批量带来的最大额外延迟）或攒够
+  batch_max_messages 条（WS_BATCH_MAX_MESSAGES，默认64），把这些消息合成一个数组帧发送：
+  text 格式为 JSON 数组（str 消息是数组中的字符串），msgpack / cbor 为对应格式的数组。
+  上一帧发送期间积压的消息不再等待，直接合并发送。高频聊天时帧数和系统调用次数按批量大小成比例下降
+- 连接存活检测使用 WebSocket 协议层的 ping/pong（uvicorn 的 --ws-ping-interval / --ws-ping-timeout，默认各20秒），
+  浏览器和其他客户端都会自动回复，half-open 的连接由 uvicorn 关闭，endpoint 收到 WebSocketDisconnect
+- 可选的空闲断开（见 ws_heartbeat.TimerWheel，所有连接共用一个后台任务），默认关闭：
+  idle_timeout（WS_IDLE_TIMEOUT，默认0即不限制）秒内没有发送过聊天消息的连接会被断开（关闭码 1001）。
+  没有应用层的心跳消息，所有文本帧都是聊天内容，不会和用户输入的文字冲突
+- 连接数上限：全局 max_connections（WS_MAX_CONNECTIONS，默认10000），每个 IP max_connections_per_ip
+  （WS_MAX_CONNECTIONS_PER_IP，默认1000），0 表示不限制。超出时 connect 抛出 ConnectionRejected，
+  此时还没有 accept，endpoint 关闭连接后客户端收到的是 HTTP 403（握手被拒绝），看不到关闭码
+"""
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Set
+
+from fastapi import WebSocket, WebSocketDisconnect, status
+
+from ws_heartbeat import TimerWheel
+from ws_pubsub import MemoryPubSub, PubSubBackend, backend_from_env
+
+try:
+    import msgpack
+except ImportError:  # 未安装时不支持 msgpack 帧格式
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # 未安装时不支持 cbor 帧格式
+    cbor2 = None
+
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+
+DEFAULT_ROOM = "lobby"
+
+TEXT = "text"
+MSGPACK = "msgpack"
+CBOR = "cbor"
+
+# 断开慢客户端时等待关闭握手的最长时间（秒）
+CLOSE_TIMEOUT = 5
+
+class ConnectionRejected(ValueError):
+    """拒绝建立连接，code 为对应的 WebSocket 关闭码（握手前关闭时客户端只会收到 HTTP 403）"""
+
+    def __init__(self, code: int, reason: str):
+        super().__init__(reason)
+        self.code = code
+        self.reason = reason
+
+
+def available_formats() -> Set[str]:
+    formats = {TEXT}
+    if msgpack is not None:
+        formats.add(MSGPACK)
+    if cbor2 is not None:
+        formats.add(CBOR)
+    return formats
+
+
+class Frame:
+    """
+    编码好的消息，多个连接共用，不能修改
+
+    message 是可以直接交给 websocket.send 的 ASGI 消息；
+    batch_item 是批量发送时作为数组元素的编码，第一次用到时计算并缓存
+    """
+    __slots__ = ("message", "_batch_item")
+
+    def __init__(self, message: Dict[str, Any], batch_item: Any = None):
+        self.message = message
+        self._batch_item = batch_item
+
+    @property
+    def batch_item(self):
+        if self._batch_item is None:
+            # 只有 text 格式的 str 消息需要另外编码为 JSON 字符串
+            self._batch_item = json.dumps(self.message["text"], ensure_ascii=False)
+        return self._batch_item
+
+
+def encode_frame(message: Any, frame_format: str = TEXT) -> Frame:
+    """把消息序列化一次，得到所有同格式连接共用的 Frame"""
+    if frame_format == TEXT:
+        if isinstance(message, str):
+            return Frame({"type": "websocket.send", "text": message})
+        text = json.dumps(message, ensure_ascii=False)
+        return Frame({"type": "websocket.send", "text": text}, text)
+    if frame_format == MSGPACK and msgpack is not None:
+        data = msgpack.packb(message)
+        return Frame({"type": "websocket.send", "bytes": data}, data)
+    if frame_format == CBOR and cbor2 is not None:
+        data = cbor2.dumps(message)
+        return Frame({"type": "websocket.send", "bytes": data}, data)
+    raise ValueError(f"不支持的帧格式: {frame_format}")
+
+
+def array_header(frame_format: str, length: int) -> bytes:
+    """msgpack / cbor 数组头，后面直接拼接各元素的编码就是完整的数组"""
+    if frame_format == MSGPACK:
+        if length < 16:
+            return bytes([0x90 | length])
+        if length < 0x10000:
+            return b"\xdc" + length.to_bytes(2, "big")
+        return b"\xdd" + length.to_bytes(4, "big")
+    if length < 24:
+        return bytes([0x80 | length])
+    if length < 0x100:
+        return bytes([0x98, length])
+    if length < 0x10000:
+        return b"\x99" + length.to_bytes(2, "big")
+    return b"\x9a" + length.to_bytes(4, "big")
+
+
+def encode_batch(frames: List[Frame], frame_format: str) -> Dict[str, Any]:
+    """把多条消息合成一个数组帧"""
+    if frame_format == TEXT:
+        return {"type": "websocket.send", "text": "[" + ",".join(f.batch_item for f in frames) + "]"}
+    return {"type": "websocket.send",
+            "bytes": array_header(frame_format, len(frames)) + b"".join(f.batch_item for f in frames)}
+
+
+class Connection:
+    """一个 WebSocket 连接：所属房间、发送队列和写任务"""
+
+    def __init__(self, manager: "ConnectionManager", websocket: WebSocket, client_id: Any, queue_size: int,
+                 frame_format: str = TEXT, batch: bool = False):
+        self.manager = manager
+        self.websocket = websocket
+        self.client_id = client_id
+        self.frame_format = frame_format
+        self.batch = batch
+        self.ip = websocket.client.host if websocket.client else None
+        # 最近一次收到聊天消息的时间
+        self.last_active = time.monotonic()
+        self.rooms: Set[str] = set()
+        self.queue: deque = deque()
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.closed = False
+        # 被服务端断开（kick）时的关闭码
+        self.close_code: int = status.WS_1000_NORMAL_CLOSURE
+        # 写任务空闲时等待的 future，比 asyncio.Event 少一些开销（广播时每个连接都要唤醒一次）
+        self._waiter: Optional[asyncio.Future] = None
+        # 批量模式下正在等待窗口结束，此时入队只在攒够一批时才唤醒写任务
+        self._collecting = False
+        self._writer: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write_loop())
+
+    async def receive_text(self) -> str:
+        """
+        读取客户端的文本消息，连接关闭后抛出 WebSocketDisconnect
+
+        连接被服务端 kick（空闲、慢客户端）后 websocket 已经 close，再调用 websocket.receive_text
+        会抛出 RuntimeError；kick 之前已经收到的消息也不再返回
+        """
+        if self.closed:
+            raise WebSocketDisconnect(self.close_code)
+        try:
+            data = await self.websocket.receive_text()
+        except RuntimeError:
+            if self.closed:
+                raise WebSocketDisconnect(self.close_code)
+            raise
+        if self.closed:
+            raise WebSocketDisconnect(self.close_code)
+        return data
+
+    def enqueue(self, frame: Frame) -> bool:
+        """把 encode_frame 生成的帧放入发送队列，不等待发送；队列已满时按策略处理，返回是否入队"""
+        if self.closed:
+            return False
+        if len(self.queue) >= self.queue_size:
+            if self.manager.slow_consumer_policy == DISCONNECT:
+                self.manager.kick(self, reason="slow consumer")
+                return False
+            self.queue.popleft()
+            self.dropped += 1
+            self.manager.dropped_messages += 1
+        self.queue.append(frame)
+        waiter = self._waiter
+        if waiter is not None and not waiter.done() and (not self._collecting
+                                                          or len(self.queue) >= self.manager.batch_max_messages):
+            waiter.set_result(None)
+        return True
+
+    async def _wait(self, timeout: Optional[float] = None):
+        loop = asyncio.get_running_loop()
+        self._waiter = waiter = loop.create_future()
+        timer = loop.call_later(timeout, self._wake, waiter) if timeout is not None else None
+        try:
+            await waiter
+        finally:
+            self._waiter = None
+            if timer is not None:
+                timer.cancel()
+
+    @staticmethod
+    def _wake(waiter: asyncio.Future):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    async def _write_loop(self):
+        manager = self.manager
+        try:
+            while True:
+                if not self.queue:
+                    await self._wait()
+                    if self.batch and len(self.queue) < manager.batch_max_messages:
+                        # 写任务原本空闲：等待窗口结束或攒够一批
+                        self._collecting = True
+                        try:
+                            await self._wait(manager.batch_window)
+                        finally:
+                            self._collecting = False
+                    if not self.queue:
+                        continue
+                if self.batch:
+                    count = min(len(self.queue), manager.batch_max_messages)
+                    frames = [self.queue.popleft() for _ in range(count)]
+                    await self.websocket.send(encode_batch(frames, self.frame_format))
+                else:
+                    await self.websocket.send(self.queue.popleft().message)
+                manager.frames_sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 发送失败说明连接已断开
+            self.manager.disconnect(self)
+
+    def stop(self):
+        self.closed = True
+        self.queue.clear()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+
+
+class ConnectionManager:
+    def __init__(self, queue_size: int = 256, slow_consumer_policy: str = DROP_OLDEST,
+                 backend: Optional[PubSubBackend] = None,
+                 batch_window: float = 0.01, batch_max_messages: int = 64,
+                 idle_timeout: float = 0,
+                 max_connections: int = 10000, max_connections_per_ip: int = 1000):
+        if slow_consumer_policy not in (DROP_OLDEST, DISCONNECT):
+            raise ValueError(f"未知的慢客户端策略: {slow_consumer_policy}")
+        if batch_max_messages < 1:
+            raise ValueError("batch_max_messages 至少为1")
+        self.queue_size = queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.batch_window = batch_window
+        self.batch_max_messages = batch_max_messages
+        self.backend = backend if backend is not None else MemoryPubSub()
+        self.rooms: Dict[str, Set[Connection]] = {}
+        self.active_connections: Set[Connection] = set()
+        self.dropped_messages = 0
+        self.frames_sent = 0
+        self.kicked_connections = 0
+
+        self.idle_timeout = idle_timeout
+        self.heartbeat = TimerWheel(self._check_idle, tick=1.0, max_delay=max(idle_timeout, 1))
+        self.reaped_connections = 0
+
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.ip_counts: Dict[str, int] = {}
+        # 已通过检查、正在握手的连接数
+        self._pending = 0
+        self.rejected_connections = 0
+
+    async def start(self):
+        await self.backend.start(self._fanout)
+        if self.idle_timeout:
+            self.heartbeat.start()
+
+    async def stop(self):
+        await self.heartbeat.stop()
+        await self.backend.stop()
+
+    def _admit(self, ip: Optional[str]):
+        if self.max_connections and len(self.active_connections) + self._pending >= self.max_connections:
+            self.rejected_connections += 1
+            raise ConnectionRejected(status.WS_1013_TRY_AGAIN_LATER, "服务器连接数已达上限")
+        if ip is not None:
+            count = self.ip_counts.get(ip, 0)
+            if self.max_connections_per_ip and count >= self.max_connections_per_ip:
+                self.rejected_connections += 1
+                raise ConnectionRejected(status.WS_1013_TRY_AGAIN_LATER, "该 IP 的连接数已达上限")
+            self.ip_counts[ip] = count + 1
+
+    def _release_ip(self, ip: Optional[str]):
+        if ip is None:
+            return
+        count = self.ip_counts.get(ip, 0) - 1
+        if count > 0:
+            self.ip_counts[ip] = count
+        else:
+            self.ip_counts.pop(ip, None)
+
+    async def connect(self, websocket: WebSocket, client_id: Any = None, room: str = DEFAULT_ROOM,
+                      frame_format: str = TEXT, batch: bool = False) -> Connection:
+        """接受连接并加入房间，格式不支持或连接数超限时抛出 ConnectionRejected（此时尚未 accept）"""
+        if frame_format not in available_formats():
+            raise ConnectionRejected(status.WS_1003_UNSUPPORTED_DATA, f"不支持的帧格式: {frame_format}")
+        ip = websocket.client.host if websocket.client else None
+        self._admit(ip)
+        self._pending += 1
+        try:
+            await websocket.accept()
+        except BaseException:
+            self._release_ip(ip)
+            raise
+        finally:
+            self._pending -= 1
+        connection = Connection(self, websocket, client_id, self.queue_size, frame_format, batch)
+        self.active_connections.add(connection)
+        self.join(connection, room)
+        connection.start()
+        if self.idle_timeout:
+            self.heartbeat.schedule(connection, self.idle_timeout)
+        return connection
+
+    def touch(self, connection: Connection):
+        """收到客户端的聊天消息时调用"""
+        connection.last_active = time.monotonic()
+
+    def _check_idle(self, connection: Connection):
+        """时间轮的回调：断开空闲的连接，没到期时按最近一次活动重新安排"""
+        if connection not in self.active_connections:
+            return
+        remaining = connection.last_active + self.idle_timeout - time.monotonic()
+        if remaining <= 0:
+            self.reaped_connections += 1
+            self.kick(connection, status.WS_1001_GOING_AWAY, "idle timeout")
+            return
+        self.heartbeat.schedule(connection, remaining)
+
+    def join(self, connection: Connection, room: str):
+        if room not in self.rooms:
+            self.rooms[room] = set()
+            self.backend.subscribe(room)
+        self.rooms[room].add(connection)
+        connection.rooms.add(room)
+
+    def leave(self, connection: Connection, room: str):
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(connection)
+            if not members:
+                del self.rooms[room]
+                self.backend.unsubscribe(room)
+        connection.rooms.discard(room)
+
+    def disconnect(self, connection: Connection):
+        """移除连接并停止其写任务，可重复调用"""
+        if connection not in self.active_connections:
+            return
+        self.active_connections.discard(connection)
+        for room in list(connection.rooms):
+            self.leave(connection, room)
+        self.heartbeat.cancel(connection)
+        self._release_ip(connection.ip)
+        connection.stop()
+
+    def kick(self, connection: Connection, code: int = status.WS_1008_POLICY_VIOLATION, reason: str = ""):
+        """服务端主动断开连接：立即从房间中移除，关闭握手在后台进行；之后 Connection.receive_text 抛出 WebSocketDisconnect"""
+        if connection not in self.active_connections:
+            return
+        self.kicked_connections += 1
+        connection.close_code = code
+        self.disconnect(connection)
+        asyncio.create_task(self._close(connection.websocket, code, reason))
+
+    @staticmethod
+    async def _close(websocket: WebSocket, code: int, reason: str):
+        try:
+            await asyncio.wait_for(websocket.close(code=code, reason=reason), CLOSE_TIMEOUT)
+        except Exception:
+            pass
+
+    async def send_personal_message(self, message: Any, connection: Connection):
+        connection.enqueue(encode_frame(message, connection.frame_format))
+
+    async def broadcast(self, message: Any, room: Optional[str] = None):
+        """发送给房间内的所有连接（包括其他 worker 上的），room 为 None 时发送给所有连接"""
+        self._fanout(room, message)
+        await self.backend.publish(room, message)
+
+    def _fanout(self, room: Optional[str], message: Any):
+        """只发给本进程的连接，也是 pub/sub 后端收到其他进程广播时的回调"""
+        targets = self.active_connections if room is None else self.rooms.get(room, ())
+        # 每种帧格式只编码一次
+        frames: Dict[str, Frame] = {}
+        # enqueue 可能因 disconnect 策略修改集合，先复制
+        for connection in list(targets):
+            frame = frames.get(connection.frame_format)
+            if frame is None:
+                frame = frames[connection.frame_format] = encode_frame(message, connection.frame_format)
+            connection.enqueue(frame)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "connections": len(self.active_connections),
+            "rooms": {room: len(members) for room, members in self.rooms.items()},
+            "queued_messages": sum(len(c.queue) for c in self.active_connections),
+            "dropped_messages": self.dropped_messages,
+            "kicked_connections": self.kicked_connections,
+            "slow_consumer_policy": self.slow_consumer_policy,
+            "queue_size": self.queue_size,
+            "frames_sent": self.frames_sent,
+            "reaped_connections": self.reaped_connections,
+            "rejected_connections": self.rejected_connections,
+            "client_ips": len(self.ip_counts),
+            "batch_window_ms": self.batch_window * 1000,
+            "batch_max_messages": self.batch_max_messages,
+            "pubsub": self.backend.stats(),
+        }
+
+
+def manager_from_env() -> ConnectionManager:
+    return ConnectionManager(
+        queue_size=int(os.environ.get("WS_SEND_QUEUE_SIZE", "256")),
+        slow_consumer_policy=os.environ.get("WS_SLOW_CONSUMER_POLICY", DROP_OLDEST),
+        backend=backend_from_env(),
+        batch_window=float(os.environ.get("WS_BATCH_WINDOW_MS", "10")) / 1000,
+        batch_max_messages=int(os.environ.get("WS_BATCH_MAX_MESSAGES", "64")),
+        idle_timeout=float(os.environ.get("WS_IDLE_TIMEOUT", "0")),
+        max_connections=int(os.environ.get("WS_MAX_CONNECTIONS", "10000")),
+        max_connections_per_ip=int(os.environ.get("WS_MAX_CONNECTIONS_PER_IP", "1000")),
+    )
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+WebSocket 广播的发布/订阅后端
+
+uvicorn 以多个 worker 启动时，每个进程有自己的 ConnectionManager，只认识连到本进程的客户端。
+ConnectionManager.broadcast 先发给本进程的连接，再通过后端发布给其他 worker / 其他主机，
+各进程收到后只发给自己的连接（自己发布的消息按 origin 忽略，不会重复发送）。
+
+可选后端（环境变量 WS_PUBSUB_BACKEND）：
+- memory：进程内，默认。同一进程中共享 group 的多个 MemoryPubSub 互相可见，主要用于测试
+- unix：同一主机的多个 worker，每个 worker 在共享目录（WS_PUBSUB_DIR，必须配置）下绑定一个 Unix 数据报套接字，
+  发布时向目录下所有套接字各发一个数据报，不需要额外的代理进程。新 worker 最多 PEER_REFRESH_INTERVAL 秒后被发现。
+  目录下的所有套接字都会收到广播，每个应用实例（如按端口区分）要使用自己的目录，不能与主机上的其他应用共用
+- redis：跨主机，使用 Redis 的 PUBLISH/SUBSCRIBE（WS_REDIS_URL，默认 redis://localhost:6379）。
+  这里直接实现了所需的一小部分 RESP 协议，不依赖 redis 包；本地测试可以用 mini_redis.py 代替 Redis
+
+广播只保证“尽力送达”：接收方缓冲区满、Redis 断线重连期间或 Redis 处理不过来（发送缓冲区超过
+MAX_PUBLISH_BUFFER）时的消息会被丢弃并计数，与 drop_oldest 策略一致，publish 不会因此阻塞或占用无限内存。
+"""
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import unquote, urlsplit
+
+# 收到其他进程的广播时调用：handler(room, message)，room 为 None 表示发给所有连接
+Handler = Callable[[Optional[str], Any], None]
+
+# Unix 数据报的最大长度，超过时发布失败（Linux 默认的套接字缓冲区约 208KB）
+MAX_DATAGRAM_SIZE = 64 * 1024
+# 重新扫描共享目录中其他 worker 套接字的间隔（秒）
+PEER_REFRESH_INTERVAL = 1.0
+# 发往 Redis 的数据在本地缓冲区中积压超过这个字节数时，新的广播直接丢弃
+MAX_PUBLISH_BUFFER = 1024 * 1024
+# Redis 断线后重连的等待时间（秒），逐次翻倍到上限
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 10
+
+
+class PubSubBackend:
+    """后端基类：start 后 publish 的消息会交给其他后端实例的 handler"""
+
+    name = "base"
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+        self.handler: Optional[Handler] = None
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+        self.last_error: Optional[str] = None
+
+    async def start(self, handler: Handler):
+        self.handler = handler
+
+    async def stop(self):
+        self.handler = None
+
+    async def publish(self, room: Optional[str], message: Any):
+        raise NotImplementedError
+
+    def subscribe(self, room: str):
+        """本进程的房间从无到有时调用，只关心部分房间的后端可以据此订阅"""
+
+    def unsubscribe(self, room: str):
+        """本进程的房间变空时调用"""
+
+    def encode(self, room: Optional[str], message: Any) -> bytes:
+        return json.dumps([self.origin, room, message], ensure_ascii=False).encode()
+
+    def dispatch(self, payload: bytes):
+        """处理收到的消息，忽略自己发布的"""
+        try:
+            origin, room, message = json.loads(payload)
+        except (ValueError, TypeError):
+            self.last_error = "无法解析的消息"
+            return
+        if origin == self.origin or self.handler is None:
+            return
+        self.received += 1
+        self.handler(room, message)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "published": self.published,
+            "received": self.received,
+            "dropped": self.dropped,
+            "last_error": self.last_error,
+        }
+
+
+class MemoryPubSub(PubSubBackend):
+    """进程内后端：传入同一个 group（list）的实例互相转发，不传时只有本进程"""
+
+    name = "memory"
+
+    def __init__(self, group: Optional[List["MemoryPubSub"]] = None):
+        super().__init__()
+        self.group = group if group is not None else []
+
+    async def start(self, handler: Handler):
+        await super().start(handler)
+        self.group.append(self)
+
+    async def stop(self):
+        if self in self.group:
+            self.group.remove(self)
+        await super().stop()
+
+    async def publish(self, room: Optional[str], message: Any):
+        self.published += 1
+        if len(self.group) < 2:
+            return
+        payload = self.encode(room, message)
+        loop = asyncio.get_running_loop()
+        for peer in self.group:
+            if peer is not self:
+                loop.call_soon(peer.dispatch, payload)
+
+
+class UnixSocketPubSub(PubSubBackend):
+    """同一主机的多个 worker：共享目录下每个 worker 一个 Unix 数据报套接字"""
+
+    name = "unix"
+
+    def __init__(self, directory: str):
+        super().__init__()
+        self.directory = directory
+        self.path = os.path.join(directory, f"{os.getpid()}-{self.origin[:8]}.sock")
+        self._sock: Optional[socket.socket] = None
+        self._peers: List[str] = []
+        self._peers_checked = 0.0
+
+    async def start(self, handler: Handler):
+        await super().start(handler)
+        # 只有当前用户可以访问，其他用户不能往里发送广播
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.bind(self.path)
+        self._sock = sock
+        asyncio.get_running_loop().add_reader(sock.fileno(), self._on_readable)
+
+    async def stop(self):
+        if self._sock is not None:
+            asyncio.get_running_loop().remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        await super().stop()
+
+    def _on_readable(self):
+        while self._sock is not None:
+            try:
+                payload = self._sock.recv(MAX_DATAGRAM_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.dispatch(payload)
+
+    def _peer_paths(self) -> List[str]:
+        now = time.monotonic()
+        if now - self._peers_checked > PEER_REFRESH_INTERVAL:
+            self._peers_checked = now
+            try:
+                names = os.listdir(self.directory)
+            except OSError:
+                names = []
+            self._peers = [os.path.join(self.directory, name) for name in names
+                           if name.endswith(".sock") and os.path.join(self.directory, name) != self.path]
+        return self._peers
+
+    async def publish(self, room: Optional[str], message: Any):
+        if self._sock is None:
+            return
+        self.published += 1
+        payload = self.encode(room, message)
+        if len(payload) > MAX_DATAGRAM_SIZE:
+            self.dropped += 1
+            self.last_error = f"消息超过 {MAX_DATAGRAM_SIZE} 字节，未发布"
+            return
+        for peer in list(self._peer_paths()):
+            try:
+                self._sock.sendto(payload, peer)
+            except BlockingIOError:
+                # 对方的接收缓冲区已满（处理不过来），丢弃
+                self.dropped += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 对方进程已退出，套接字文件是残留的
+                self._peers.remove(peer)
+                try:
+                    os.remove(peer)
+                except OSError:
+                    pass
+            except OSError as e:
+                self.dropped += 1
+                self.last_error = str(e)
+
+
+def encode_command(*args) -> bytes:
+    """编码为 RESP 数组"""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+class RedisError(Exception):
+    pass
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    """读取一个 RESP 回复，错误回复抛出 RedisError"""
+    line = await reader.readuntil(b"\r\n")
+    kind, body = line[:1], line[1:-2]
+    if kind == b"+":
+        return body
+    if kind == b"-":
+        raise RedisError(body.decode(errors="replace"))
+    if kind == b":":
+        return int(body)
+    if kind == b"$":
+        length = int(body)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        length = int(body)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise RedisError(f"无法识别的回复: {line!r}")
+
+
+class RedisPubSub(PubSubBackend):
+    """
+    跨主机后端：一个连接只用于 PUBLISH（流水线发送，回复由后台任务读取），
+    另一个连接用于 SUBSCRIBE。全局广播发布到频道 <prefix>，房间广播发布到 <prefix>:<room>，
+    每个 worker 只订阅本进程有连接的房间。断线后自动重连并重新订阅。
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str = "redis://localhost:6379", prefix: str = "chat"):
+        super().__init__()
+        parts = urlsplit(url)
+        if parts.scheme != "redis":
+            raise ValueError(f"不支持的 Redis 地址: {url}")
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else None
+        self.prefix = prefix
+        self.rooms: Set[str] = set()
+        self.connected = False
+        self._publisher: Optional[asyncio.StreamWriter] = None
+        self._subscriber: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def channel(self, room: Optional[str]) -> str:
+        return self.prefix if room is None else f"{self.prefix}:{room}"
+
+    async def start(self, handler: Handler):
+        await super().start(handler)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await super().stop()
+
+    async def _open(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password is not None:
+            writer.write(encode_command("AUTH", self.password))
+            await read_reply(reader)
+        return reader, writer
+
+    async def _run(self):
+        delay = RECONNECT_DELAY
+        while True:
+            writers = []
+            try:
+                pub_reader, self._publisher = await self._open()
+                writers.append(self._publisher)
+                sub_reader, self._subscriber = await self._open()
+                writers.append(self._subscriber)
+                channels = [self.channel(None)] + [self.channel(room) for room in self.rooms]
+                self._subscriber.write(encode_command("SUBSCRIBE", *channels))
+                self.connected = True
+                delay = RECONNECT_DELAY
+                drain = asyncio.create_task(self._drain_replies(pub_reader))
+                try:
+                    await self._read_messages(sub_reader)
+                finally:
+                    drain.cancel()
+            except (OSError, asyncio.IncompleteReadError, RedisError) as e:
+                self.last_error = str(e) or type(e).__name__
+            finally:
+                self.connected = False
+                self._publisher = self._subscriber = None
+                for writer in writers:
+                    writer.close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    async def _drain_replies(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                await read_reply(reader)
+        except (OSError, asyncio.IncompleteReadError, RedisError) as e:
+            self.last_error = str(e) or type(e).__name__
+            # 关闭订阅连接，让 _run 重连
+            if self._subscriber is not None:
+                self._subscriber.close()
+
+    async def _read_messages(self, reader: asyncio.StreamReader):
+        while True:
+            reply = await read_reply(reader)
+            if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                self.dispatch(reply[2])
+            # subscribe/unsubscribe 的确认无需处理
+
+    async def publish(self, room: Optional[str], message: Any):
+        self.published += 1
+        if self._publisher is None or self._publisher.is_closing():
+            self.dropped += 1
+            return
+        if self._publisher.transport.get_write_buffer_size() > MAX_PUBLISH_BUFFER:
+            # Redis 读得比发布慢，不等待 drain（会阻塞发消息的客户端），丢弃
+            self.dropped += 1
+            self.last_error = f"发送缓冲区超过 {MAX_PUBLISH_BUFFER} 字节，丢弃广播"
+            return
+        self._publisher.write(encode_command("PUBLISH", self.channel(room), self.encode(room, message)))
+
+    def subscribe(self, room: str):
+        self.rooms.add(room)
+        if self._subscriber is not None:
+            self._subscriber.write(encode_command("SUBSCRIBE", self.channel(room)))
+
+    def unsubscribe(self, room: str):
+        self.rooms.discard(room)
+        if self._subscriber is not None:
+            self._subscriber.write(encode_command("UNSUBSCRIBE", self.channel(room)))
+
+    def stats(self) -> Dict[str, Any]:
+        result = super().stats()
+        result["connected"] = self.connected
+        return result
+
+
+def backend_from_env() -> PubSubBackend:
+    kind = os.environ.get("WS_PUBSUB_BACKEND", "memory")
+    prefix = os.environ.get("WS_PUBSUB_CHANNEL", "chat")
+    if kind == "memory":
+        return MemoryPubSub()
+    if kind == "unix":
+        # 不提供默认目录：主机上其他使用同一目录的应用会互相收到广播
+        directory = os.environ.get("WS_PUBSUB_DIR")
+        if not directory:
+            raise ValueError("unix 后端需要用 WS_PUBSUB_DIR 指定本应用专用的套接字目录")
+        return UnixSocketPubSub(directory)
+    if kind == "redis":
+        return RedisPubSub(os.environ.get("WS_REDIS_URL", "redis://localhost:6379"), prefix)
+    raise ValueError(f"未知的 pub/sub 后端: {kind}")
@@ -0,0 +1,251 @@
+# -*- coding:utf-8 -*-
+"""
+HTTP 缓存中间件：ETag / Last-Modified 条件请求、按路由设置 Cache-Control、可选的进程内 LRU 响应缓存
+
+只处理匹配到缓存策略（按路径最长前缀匹配）的 GET 请求：
+- 响应体在发送前计算哈希作为 ETag，请求带 If-None-Match 且一致时返回 304 不带响应体；
+  没有 If-None-Match 时按 If-Modified-Since 与 Last-Modified（该 ETag 第一次出现的时间）比较
+- 策略的 ttl > 0 时，渲染好的响应（状态码、响应头、响应体）保存在 LRU 中，ttl 秒内的相同请求
+  直接由中间件返回 200 或 304，不再调用接口函数，也没有任何序列化的开销
+- 同一前缀下的非 GET 请求成功后，清除该前缀下缓存的响应（只对本进程有效，其他 worker 依赖 ttl 过期）
+
+LRU 同时受条目数（max_entries）和总字节数（max_bytes，响应体加响应头）限制，超出任意一个时淘汰最久未使用的条目。
+只缓冲有 Content-Length 且不超过 max_body_size 的 200 响应，StreamingResponse 等流式响应原样透传；
+已经带 ETag 的响应（如 StaticFiles）不处理；Cache-Control 为 no-store 的策略只加上该响应头，不缓存也没有 ETag。
+依赖请求头的接口在策略的 vary 中列出这些请求头，它们的值会加入缓存键，并在 Vary 响应头中声明。
+"""
+import hashlib
+import time
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+Headers = List[Tuple[bytes, bytes]]
+
+
+class CachePolicy:
+    def __init__(self, cache_control: str, ttl: float = 0, vary: Sequence[str] = ()):
+        """
+        :param cache_control: 返回给客户端的 Cache-Control
+        :param ttl: 进程内缓存渲染好的响应的秒数，0 表示不缓存响应体（仍然支持 ETag / 304）
+        :param vary: 影响响应内容的请求头
+        """
+        self.cache_control = cache_control
+        self.ttl = ttl
+        self.vary = tuple(header.lower() for header in vary)
+        self.no_store = "no-store" in cache_control.lower()
+
+
+class _Entry:
+    __slots__ = ("etag", "last_modified", "headers", "body", "expires_at", "size")
+
+    def __init__(self, etag: bytes, last_modified: float, headers: Headers, body: Optional[bytes], expires_at: float):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.headers = headers
+        self.body = body
+        self.expires_at = expires_at
+        self.size = len(body or b"") + sum(len(name) + len(value) for name, value in headers)
+
+
+def _etag_matches(if_none_match: bytes, etag: bytes) -> bool:
+    """If-None-Match 使用弱比较"""
+    if if_none_match.strip() == b"*":
+        return True
+    tag = etag[2:] if etag.startswith(b"W/") else etag
+    for candidate in if_none_match.split(b","):
+        candidate = candidate.strip()
+        if candidate.startswith(b"W/"):
+            candidate = candidate[2:]
+        if candidate == tag:
+            return True
+    return False
+
+
+def _not_modified_since(if_modified_since: bytes, last_modified: float) -> bool:
+    try:
+        since = parsedate_to_datetime(if_modified_since.decode("latin-1")).timestamp()
+    except (TypeError, ValueError):
+        return False
+    return int(last_modified) <= since
+
+
+class HTTPCacheMiddleware:
+    def __init__(self, app, policies: Dict[str, CachePolicy], max_entries: int = 1024,
+                 max_body_size: int = 1024 * 1024, max_bytes: int = 64 * 1024 * 1024):
+        self.app = app
+        # 最长的前缀优先匹配
+        self.policies = sorted(policies.items(), key=lambda item: len(item[0]), reverse=True)
+        self.max_entries = max_entries
+        self.max_body_size = max_body_size
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[tuple, _Entry]" = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.hits = 0
+        self.not_modified = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def match(self, path: str) -> Tuple[Optional[str], Optional[CachePolicy]]:
+        for prefix, policy in self.policies:
+            if path.startswith(prefix):
+                return prefix, policy
+        return None, None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        prefix, policy = self.match(scope["path"])
+        if policy is None:
+            await self.app(scope, receive, send)
+            return
+        if policy.no_store:
+            await self._call_no_store(scope, receive, send, policy)
+            return
+        if scope["method"] != "GET":
+            await self._call_and_invalidate(scope, receive, send, prefix)
+            return
+
+        request_headers = dict(scope["headers"])
+        key = (scope["path"], scope["query_string"], *(request_headers.get(name.encode()) for name in policy.vary))
+        entry = self.entries.get(key)
+        now = time.time()
+        if entry is not None and entry.body is not None and entry.expires_at > now:
+            self.entries.move_to_end(key)
+            if self._is_not_modified(request_headers, entry):
+                self.not_modified += 1
+                await self._send_not_modified(send, entry)
+            else:
+                self.hits += 1
+                await send({"type": "http.response.start", "status": 200, "headers": entry.headers})
+                await send({"type": "http.response.body", "body": entry.body})
+            return
+        self.misses += 1
+        await self._render(scope, receive, send, policy, key, request_headers)
+
+    async def _call_no_store(self, scope, receive, send, policy: CachePolicy):
+        """不缓存也不计算 ETag，只把策略的 Cache-Control 加到响应上，客户端和代理同样不保存"""
+        async def wrapped(message):
+            if message["type"] == "http.response.start":
+                headers = [(name, value) for name, value in message.get("headers", []) if name != b"cache-control"]
+                headers.append((b"cache-control", policy.cache_control.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, wrapped)
+
+    def _is_not_modified(self, request_headers: Dict[bytes, bytes], entry: _Entry) -> bool:
+        if_none_match = request_headers.get(b"if-none-match")
+        if if_none_match is not None:
+            return _etag_matches(if_none_match, entry.etag)
+        if_modified_since = request_headers.get(b"if-modified-since")
+        return if_modified_since is not None and _not_modified_since(if_modified_since, entry.last_modified)
+
+    async def _send_not_modified(self, send, entry: _Entry):
+        # 304 只带与缓存相关的响应头
+        headers = [(name, value) for name, value in entry.headers
+                   if name in (b"etag", b"last-modified", b"cache-control", b"vary")]
+        await send({"type": "http.response.start", "status": 304, "headers": headers})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def _render(self, scope, receive, send, policy: CachePolicy, key: tuple,
+                      request_headers: Dict[bytes, bytes]):
+        start: Dict[str, Any] = {}
+        chunks: List[bytes] = []
+        passthrough = False
+
+        async def capture(message):
+            nonlocal passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                headers = dict(message.get("headers", []))
+                length = headers.get(b"content-length")
+                if (message["status"] != 200 or b"etag" in headers or length is None
+                        or int(length) > self.max_body_size):
+                    passthrough = True
+                    await send(message)
+                    return
+                start.update(message)
+                return
+            if message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    await self._finish(send, policy, key, request_headers, start, b"".join(chunks))
+                return
+            await send(message)
+
+        await self.app(scope, receive, capture)
+
+    async def _finish(self, send, policy: CachePolicy, key: tuple, request_headers: Dict[bytes, bytes],
+                      start: Dict[str, Any], body: bytes):
+        etag = b'"' + hashlib.blake2b(body, digest_size=16).hexdigest().encode() + b'"'
+        now = time.time()
+        previous = self.entries.get(key)
+        # 内容没变时保留第一次出现的时间作为 Last-Modified
+        last_modified = previous.last_modified if previous is not None and previous.etag == etag else now
+        headers = [(name, value) for name, value in start.get("headers", [])
+                   if name not in (b"cache-control", b"last-modified", b"vary")]
+        headers += [
+            (b"etag", etag),
+            (b"last-modified", formatdate(last_modified, usegmt=True).encode()),
+            (b"cache-control", policy.cache_control.encode()),
+        ]
+        if policy.vary:
+            headers.append((b"vary", ", ".join(policy.vary).encode()))
+        entry = _Entry(etag, last_modified, headers, body if policy.ttl > 0 else None, now + policy.ttl)
+        self._store(key, entry)
+
+        if self._is_not_modified(request_headers, entry):
+            self.not_modified += 1
+            await self._send_not_modified(send, entry)
+            return
+        await send({**start, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    def _store(self, key: tuple, entry: _Entry):
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= previous.size
+        # 单个响应超过总预算时不缓存，也不为它清空其他条目
+        if entry.size > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.size += entry.size
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+            self.evictions += 1
+
+    async def _call_and_invalidate(self, scope, receive, send, prefix: str):
+        status = 0
+
+        async def capture(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        await self.app(scope, receive, capture)
+        if 200 <= status < 400:
+            self.invalidate(prefix)
+
+    def invalidate(self, prefix: str = "/"):
+        """清除路径以 prefix 开头的缓存"""
+        for key in [key for key in self.entries if key[0].startswith(prefix)]:
+            self.size -= self.entries.pop(key).size
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "evictions": self.evictions,
+            "hits": self.hits,
+            "not_modified": self.not_modified,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
@@ -10,6 +10,8 @@ import uvicorn
 
 from tutorial import app03, app04
 from devlab import lab00
+from coronavirus import application
+from http_cache import CachePolicy, HTTPCacheMiddleware
 
 # from tutorial.chapter03 import app03
 # from tutorial.chapter04 import app04
@@ -37,6 +39,23 @@ app.mount("/static", StaticFiles(directory="./static"), name="static")  # attent
 
 
 # middleware setting
+# HTTP 缓存：ETag / Last-Modified + 按路由的 Cache-Control，先添加的在内层，CORS 的响应头不会进入缓存
+# ch03 的 cookie / header 示例依赖请求头，不在缓存范围内；coronavirus 的数据可能被其他 worker 或后台导入修改，
+# 客户端每次都要验证（no-cache），进程内的响应只缓存 5 秒
+app.add_middleware(
+    HTTPCacheMiddleware,
+    policies={
+        "/lab00/enum/": CachePolicy("public, max-age=86400", ttl=3600),
+        "/ch03/path": CachePolicy("public, max-age=60", ttl=60),
+        "/ch03/city/": CachePolicy("public, max-age=60", ttl=60),
+        "/ch03/enum/": CachePolicy("public, max-age=60", ttl=60),
+        "/ch03/files/": CachePolicy("public, max-age=60", ttl=60),
+        "/ch03/query": CachePolicy("public, max-age=60", ttl=60),
+        "/coronavirus/": CachePolicy("no-cache", ttl=5),
+        "/coronavirus/import": CachePolicy("no-store"),
+        "/coronavirus/analytics_stats": CachePolicy("no-store"),
+    },
+)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -100,6 +119,7 @@ app.include_router(app04, prefix='/ch04', tags=['第四章 响应处理和FastAP
 # app.include_router(app08, prefix='/ch08', tags=['第八章 中间件、CORS、后台任务、测试用例'])
 
 app.include_router(lab00, prefix='/lab00', tags=['实验1 基本路由'])
+app.include_router(application, prefix='/coronavirus', tags=['新冠病毒疫情跟踪器API'])
 
 
 if __name__ == '__main__':